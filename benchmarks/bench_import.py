@@ -0,0 +1,41 @@
+"""
+Import-time benchmark: each import runs in a fresh interpreter, best of several runs is reported. Exits non-zero if an
+analysis-only import is slower than the limit or loads pythonnet, so it can guard against eager imports creeping back.
+Run with python benchmarks/bench_import.py [limit in seconds, default 1.0]
+"""
+import subprocess
+import sys
+
+MODULES = ['motormag', 'motormag.storage', 'motormag.draw', 'motormag.scan']
+PROBE = '''
+import sys, time
+t = time.perf_counter()
+import {module}
+print(time.perf_counter() - t, 'clr' in sys.modules)
+'''
+
+
+def import_time(module, repeat=5):
+    """
+    :return: best import time in seconds, whether pythonnet got loaded.
+    """
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', PROBE.format(module=module)], capture_output=True, text=True,
+                             check=True).stdout.split()
+        times.append(float(out[0]))
+    return min(times), out[1] == 'True'
+
+
+def main(limit=1.0):
+    failed = False
+    for module in MODULES:
+        seconds, clr = import_time(module)
+        ok = seconds < limit and not clr
+        failed |= not ok
+        print('%-18s %7.3f s%s%s' % (module, seconds, '  loads clr' if clr else '', '' if ok else '  FAIL'))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[float(a) for a in sys.argv[1:]]))
@@ -0,0 +1,33 @@
+"""
+Micro-benchmark: batch frame parsing versus the per-message regex parser.
+Run with python benchmarks/bench_parse.py
+"""
+import timeit
+import numpy as np
+from motormag import mag, sim
+
+
+def make_buffer(n, ch3600):
+    fields = np.random.normal(0, 1, (n, 3))
+    if ch3600:
+        return ''.join(sim.format_ch3600(f, [25.0] * 3) for f in fields).encode('ascii')
+    return ''.join(sim.format_ch330(f) for f in fields).encode('ascii')
+
+
+def per_message(buffer, ch3600):
+    return np.array([mag.parse_message(line.decode('ascii'), ch3600) for line in buffer.split(b'\n') if line.strip()])
+
+
+def main():
+    for ch3600 in (True, False):
+        for n in (10, 1000, 100000):
+            buffer = make_buffer(n, ch3600)
+            repeats = max(1, 20000 // n)
+            t_old = min(timeit.repeat(lambda: per_message(buffer, ch3600), number=repeats, repeat=3)) / repeats
+            t_new = min(timeit.repeat(lambda: mag.parse_frames(buffer, ch3600), number=repeats, repeat=3)) / repeats
+            print('%-6s %7d frames: per-message %8.2f us/frame, batch %7.3f us/frame, %5.1fx' % (
+                'CH3600' if ch3600 else 'CH330', n, t_old / n * 1e6, t_new / n * 1e6, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark: seconds per slice for writing every y slice of a scan as images. The baseline is the loop of
+src/motormag/snippet.py: draw.plot_strength_2d on the DataFrame for mag_x on y cuts with a fixed vmin/vmax, into the
+axes of 2x3 subplot figures, one file per figure. It is compared to render.render_slices with the same slices and
+color scale, reusing one figure, in this process and on a process pool.
+Run with python benchmarks/bench_render.py [n_processes]
+"""
+import sys
+import os
+import tempfile
+import time
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+from motormag import draw, grid, render
+
+
+PANELS = 6
+
+
+def make_scan(nx, ny, nz):
+    axes = [np.linspace(-10, 10, nx), np.linspace(-10, 10, ny), np.linspace(0, 5, nz)]
+    x, y, z = np.meshgrid(*axes, indexing='ij')
+    return grid.FieldGrid(axes, np.array([0.01 * x * z, 0.01 * y * z, 50 - 0.02 * (x ** 2 + y ** 2) + z])).to_dataframe()
+
+
+def snippet_loop(df, n_slices, directory, fmt):
+    plt = draw._pyplot()
+    for first in range(0, n_slices, PANELS):
+        f, axes = plt.subplots(2, 3)
+        axes = axes.flatten()
+        for i in range(first, min(first + PANELS, n_slices)):
+            draw.plot_strength_2d(df, 'y', i, field_axis='x', vmin=df.mag_x.min(), vmax=df.mag_x.max(),
+                                  ax=axes[i - first])
+        f.tight_layout()
+        f.savefig(os.path.join(directory, 'snippet_%03d.%s' % (first, fmt)))
+        plt.close(f)
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() or 1
+    for shape in [(50, 24, 20), (100, 48, 40)]:
+        df = make_scan(*shape)
+        specs = render.all_slices(df, 'y', field_axis='x')
+        limits = dict(vmin=df.mag_x.min(), vmax=df.mag_x.max())
+        for fmt in ('png', 'svg'):
+            with tempfile.TemporaryDirectory() as directory:
+                times = []
+                for run in (lambda: snippet_loop(df, len(specs), directory, fmt),
+                            lambda: render.render_slices(df, specs, directory, fmt, **limits),
+                            lambda: render.render_slices(df, specs, directory, fmt, processes=processes, **limits)):
+                    start = time.perf_counter()
+                    run()
+                    times.append((time.perf_counter() - start) / len(specs))
+            print('%3dx%3dx%2d %s: snippet loop %6.1f ms/slice, reused %6.1f ms/slice, %d processes %6.1f ms/slice' % (
+                shape + (fmt, times[0] * 1e3, times[1] * 1e3, processes, times[2] * 1e3)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+End-to-end scan benchmark against the simulator: the motor and mag modules run unchanged, G-code goes to
+sim.SimulatedController and the gaussmeter output through the frame parser, everything in real time.
+Compares path planning and settle strategies on a small grid with realistic speeds.
+Run with python benchmarks/bench_scan.py
+"""
+import time
+from motormag import scan, sim, _mode
+
+GRID = dict(x_range=[0, 15], y_range=[0, 15], z_range=0, step_size=5)
+STRATEGIES = [
+    ('raster, fixed reads', dict(path='raster', n_discards=1, n_reps=3)),
+    ('serpentine, fixed reads', dict(path='serpentine', n_discards=1, n_reps=3)),
+    ('serpentine, settle detection', dict(path='serpentine', settle_tolerance=0.002, target_error=0.001)),
+]
+
+
+def run(settings, ringing=(0.2, 0.05, 15.0), noise=0.001):
+    sim.simulate(field=sim.helmholtz_field(100, 1.0, 100, center=[7.5, 7.5, -20]), noise=noise, period=0.01,
+                 ringing=ringing, ch3600=True)
+    box = scan.BoxScan(**GRID, time_wait=0.0, speed=25, acceleration=0.3, test_corners=False, **settings)
+    start = time.monotonic()
+    df = box.run()
+    return time.monotonic() - start, box.throughput, df.reads.mean()
+
+
+def main():
+    _mode.CH3600 = True
+    for name, settings in STRATEGIES:
+        elapsed, throughput, reads = run(settings)
+        print('%-30s %6.1f s total, %6.1f points/min, %4.1f reads/point' % (name, elapsed, throughput, reads))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+Benchmark suite with stored baselines. Scan cases run box scans against the simulator in real time and report
+points/hour with the time split into travel, settle, read, bookkeeping and logging (see BoxScan.timings); analysis
+cases time dataframe_to_matrices, gradients, sub/interpolate_dataframes and 2-D plots across grid sizes.
+Every case is compared against benchmarks/baseline.json, the exit code is non-zero if any case got slower than
+baseline by more than the tolerance. Baselines are machine dependent, re-save them when switching machines.
+Run with python benchmarks/bench_suite.py [--save] [--only scan|analysis] [--tolerance 1.5]
+"""
+import argparse
+import contextlib
+import json
+import os
+import timeit
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from motormag import draw, grid, interp, log, scan, sim, spatial, _mode
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+SCAN_GRID = dict(x_range=[0, 15], y_range=[0, 15], z_range=0, step_size=5)
+SCANS = [
+    ('scan polled fixed reads', False, dict(time_wait=0.2, n_discards=1, n_reps=3)),
+    ('scan streaming fixed reads', True, dict(time_wait=0.2, n_discards=1, n_reps=3)),
+    ('scan streaming settle detection', True, dict(time_wait=0.0, settle_tolerance=0.002, target_error=0.001)),
+]
+GRID_SIZES = [(20, 20, 1), (50, 50, 10), (100, 100, 20)]
+# Slowdowns smaller than this many seconds are timer noise, not regressions.
+MIN_DIFFERENCE = 0.002
+
+
+def synthetic_scan(shape, step=1.0):
+    """
+    :return: box scan DataFrame of a smooth field on a grid of the given shape.
+    """
+    axes = [np.arange(n) * step for n in shape]
+    x, y, z = np.meshgrid(*axes, indexing='ij')
+    field = np.stack([np.sin(x / 10) + 0.1 * z, np.cos(y / 10), 1 + 0.01 * (x - y) * (1 + z / 10)])
+    return grid.FieldGrid(axes, field).to_dataframe()
+
+
+def run_scan(streaming, settings, ringing=(0.2, 0.05, 15.0), noise=0.001):
+    """
+    :return: dict of points_per_hour, seconds_per_point and the timings of BoxScan in seconds per point.
+    """
+    sim.simulate(field=sim.helmholtz_field(100, 1.0, 100, center=[7.5, 7.5, -20]), noise=noise, period=0.01,
+                 ringing=ringing, ch3600=True)
+    from motormag import mag
+    box = scan.BoxScan(**SCAN_GRID, speed=25, acceleration=0.3, test_corners=False, **settings)
+    # Log lines still get formatted and written, only not to the terminal.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if streaming:
+            mag.start_stream()
+        try:
+            box.run()
+        finally:
+            if streaming:
+                mag.stop_stream()
+            log.flush()
+    n = box.points_done
+    result = {'seconds_per_point': box.elapsed / n, 'points_per_hour': box.throughput * 60}
+    result.update({phase: seconds / n for phase, seconds in box.timings.items()})
+    return result
+
+
+def best_time(fn, setup=None, repeat=5):
+    """
+    :return: best time of fn() in seconds, setup() runs untimed before every call.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        times.append(timeit.timeit(fn, number=1))
+    return min(times)
+
+
+def quiet(fn):
+    """
+    :return: fn with its log output discarded.
+    """
+    def run():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            fn()
+            log.flush()
+    return run
+
+
+def analysis_cases(shape):
+    """
+    :return: list of (name, seconds) for one grid size.
+    """
+    df = synthetic_scan(shape)
+    shifted = df.copy()
+    shifted.loc[:, ['x', 'y']] += 0.5
+    label = 'x'.join(str(n) for n in shape)
+    halves = [df[df.x <= shape[0] // 2], df[df.x >= shape[0] // 2 - 1]]
+    directions = ''.join(ax for ax, n in zip('xyz', shape) if n > 1)
+    plt = draw._pyplot()
+    cases = [
+        ('dataframe_to_matrices', lambda: draw.dataframe_to_matrices(df), None),
+        ('mag_field_gradient', lambda: draw.mag_field_gradient(df, directions=directions), None),
+        ('sub matched', lambda: draw.sub(df, df), interp.clear_cache),
+        ('interpolate_dataframes shifted', lambda: draw.interpolate_dataframes(shifted, df), interp.clear_cache),
+        ('join_dataframes halves', quiet(lambda: draw.join_dataframes(halves)), None),
+        ('cut_plane oblique', lambda: spatial.cut_plane(df, df[['x', 'y', 'z']].mean(), [1, 1, 0], [0, 0.3, 1],
+                                                        np.linspace(-5, 5, 41), np.linspace(-2, 2, 17)),
+         spatial.clear_cache),
+        ('plot_strength_2d', lambda: plt.close(draw.plot_strength_2d(df, cut_axis='z')[0]), None),
+    ]
+    return [('%s %s' % (name, label), best_time(fn, setup)) for name, fn, setup in cases]
+
+
+def compare(name, seconds, baseline, tolerance):
+    """
+    Prints one result line against its baseline, seconds per point for scans.
+    :return: True if slower than baseline by more than tolerance and MIN_DIFFERENCE.
+    """
+    if name not in baseline:
+        print('%-44s %10.4f s   (no baseline)' % (name, seconds))
+        return False
+    ratio = seconds / baseline[name]
+    regressed = ratio > tolerance and seconds - baseline[name] > MIN_DIFFERENCE
+    print('%-44s %10.4f s   baseline %10.4f s   %5.2fx%s' % (name, seconds, baseline[name], ratio,
+                                                             '   REGRESSION' if regressed else ''))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='motormag benchmark suite')
+    parser.add_argument('--save', action='store_true', help='store results as the new baseline')
+    parser.add_argument('--only', choices=['scan', 'analysis'], help='run one group of cases only')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='slowdown versus baseline counted as regression')
+    args = parser.parse_args()
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    results = {}
+    regressions = []
+    if args.only != 'analysis':
+        _mode.CH3600 = True
+        for name, streaming, settings in SCANS:
+            result = run_scan(streaming, settings)
+            print('%s: %.0f points/hour, per point %.3f s travel, %.3f s settle, %.3f s read, %.4f s bookkeeping, '
+                  '%.4f s logging' % (name, result['points_per_hour'], result['travel'], result['settle'],
+                                      result['read'], result['bookkeeping'], result['logging']))
+            results[name] = result['seconds_per_point']
+            if compare(name, result['seconds_per_point'], baseline, args.tolerance):
+                regressions.append(name)
+    if args.only != 'scan':
+        for shape in GRID_SIZES:
+            for name, seconds in analysis_cases(shape):
+                results[name] = seconds
+                if compare(name, seconds, baseline, args.tolerance):
+                    regressions.append(name)
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Saved %d results to %s' % (len(results), BASELINE))
+    elif regressions:
+        print('%d regression(s): %s' % (len(regressions), ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
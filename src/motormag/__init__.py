@@ -1 +1,16 @@
+import importlib
 from motormag._top_level import *
+
+# Loaded on first use, so that e.g. draw does not pull in the controller DLL, and the package imports in no time.
+_SUBMODULES = ['aio', 'draw', 'envelope', 'grid', 'interp', 'live', 'log', 'mag', 'motion', 'motor', 'planner', 'render',
+               'scan', 'sim', 'spatial', 'storage', 'stream', 'trajectory']
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + _SUBMODULES)
@@ -1,19 +1,13 @@
-# import motormag.motor as motor
-# import motormag.mag as mag
-# import motormag.draw as draw
-# import motormag.scan as scan
-from . import motor
-from . import mag
-from . import draw
-from . import scan
+# Submodules are loaded on first attribute access, see __init__.
 
 
 def init(motor_port=8, mag_port=16):
+    from . import motor, mag
     motor.init(motor_port)
     mag.init(mag_port)
 
 
 def close():
+    from . import motor, mag
     motor.close()
     mag.close()
-
@@ -0,0 +1,225 @@
+"""
+asyncio front end for the stage and the gaussmeter, so one event loop can drive the stage, stream the meter, watch the
+limit switches and report progress at the same time.
+Blocking controller and serial calls run in a single-thread executor per device: they never block the loop, and
+calls to one device stay in order and never overlap, which the DLL does not cope with.
+Works on the motor and mag modules or on their simulated stand-ins, see simulated().
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+from . import log
+from . import motion
+from . import motor
+from . import sim
+
+
+# Kept here for code written against the asyncio layer first.
+LimitSwitchError = motor.LimitSwitchError
+
+
+class _Device(object):
+    def __init__(self, device, executor=None):
+        self.device = device
+        self.executor = ThreadPoolExecutor(max_workers=1) if executor is None else executor
+
+    async def call(self, fn, *args, **kwargs):
+        """
+        Runs a blocking device call in the device's executor.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class AsyncStage(_Device):
+    """
+    Stage with awaitable moves. Wraps the motor module by default, or anything offering its functions such as
+    sim.SimulatedStage.
+    """
+    def __init__(self, stage=None, executor=None):
+        """
+        :param stage: motor module if None.
+        :param executor: concurrent.futures executor for blocking calls, a private single thread if None.
+        """
+        if stage is None:
+            from . import motor as stage
+        super().__init__(stage, executor)
+        self._started = None
+        self._predicted = None
+        # Moves started so far and [dx, dy, dz] of the last one, for monitor_limits.
+        self._moves = 0
+        self._direction = None
+
+    async def get_position(self):
+        return await self.call(self.device.get_position)
+
+    async def is_running(self):
+        return await self.call(self.device.is_running)
+
+    async def get_input_state(self):
+        return await self.call(self.device.get_input_state)
+
+    async def stop(self):
+        """
+        Pauses the stage and quits the running G-code, keeping coordinates valid.
+        """
+        await self.call(self.device.pause)
+        await self.call(self.device.quit_gcode)
+
+    async def start_move(self, target, speed=25, acceleration=0.3, coordinated=True):
+        """
+        Issues an absolute move without waiting for it, see motor.multi_absolute_move.
+        :return: predicted duration in seconds.
+        """
+        start = await self.get_position()
+        self._predicted = motion.predict_move_time(start, target, speed, acceleration, coordinated)
+        self._started = time.monotonic()
+        self._direction = np.subtract(target, start)
+        self._moves += 1
+        await self.call(self.device.multi_absolute_move, target, speed=speed, acceleration=acceleration,
+                        coordinated=coordinated, block=False)
+        return self._predicted
+
+    async def wait(self, delay=0.0, callback=None):
+        """
+        Waits for the stage to stop without blocking the event loop. Stops the stage if cancelled.
+        :param delay: further wait after stopping.
+        :param callback: called with the motion.MoveRecord once stopped.
+        :return: motion.MoveRecord
+        """
+        try:
+            record = await motion.wait_for_stop_async(self.is_running, self._predicted, self._started, delay,
+                                                      callback)
+        except asyncio.CancelledError:
+            await self.stop()
+            raise
+        self._started = None
+        self._predicted = None
+        return record
+
+    async def move_to(self, target, speed=25, acceleration=0.3, coordinated=True, delay=0.0):
+        """
+        Absolute move, returns once the stage has stopped.
+        :return: motion.MoveRecord
+        """
+        await self.start_move(target, speed, acceleration, coordinated)
+        return await self.wait(delay)
+
+    async def monitor_limits(self, period=0.05):
+        """
+        Polls the limit switches until cancelled. If one trips, stops the stage and raises LimitSwitchError, so run it
+        as a task next to the moves, e.g. with asyncio.gather or scan_points. Switches already active on the first
+        poll of a move are ignored until they release if the move heads away from them, see motor.new_trips.
+        :param period: seconds between polls.
+        """
+        moves, check = None, None
+        while True:
+            if moves != self._moves:
+                moves, check = self._moves, motor.new_trips(direction=self._direction)
+            state = await self.get_input_state()
+            if check(state):
+                await self.stop()
+                error = LimitSwitchError(state)
+                log.fail(str(error))
+                raise error
+            await asyncio.sleep(period)
+
+
+class AsyncMeter(_Device):
+    """
+    Gaussmeter with awaitable reads. Wraps the mag module by default, or anything offering its functions such as
+    sim.SimulatedMeter.
+    """
+    def __init__(self, meter=None, executor=None):
+        """
+        :param meter: mag module if None.
+        :param executor: see AsyncStage.
+        """
+        if meter is None:
+            from . import mag as meter
+        super().__init__(meter, executor)
+
+    async def read_once(self):
+        return await self.call(self.device.read_once)
+
+    async def read_n_times(self, reps):
+        return await self.call(self.device.read_n_times, reps)
+
+    async def read_stream(self, period=0.05):
+        """
+        Async iterator over new readings as they arrive. With a streaming meter (mag.start_stream) yields every sample
+        from the ring buffer in batches, checked every period seconds, otherwise reads one at a time.
+        :param period: seconds between checks of the stream.
+        :return: async iterator of timestamps, (n, 6) values.
+        """
+        if self.device.streaming():
+            buffer = self.device.stream.buffer
+            count = buffer.count
+            while self.device.streaming():
+                await asyncio.sleep(period)
+                times, values = buffer.available(count)
+                count += len(times)
+                if len(times):
+                    yield times, values
+            return
+        while True:
+            value = await self.read_once()
+            yield np.array([time.monotonic()]), np.asarray(value).reshape(1, -1)
+
+
+def simulated(field=None, noise=0.0, period=0.0, limits=None):
+    """
+    Simulated async stage and meter for testing without hardware.
+    :param field: see sim.SimulatedMeter.
+    :param noise: see sim.SimulatedMeter.
+    :param period: see sim.SimulatedMeter.
+    :param limits: see sim.SimulatedStage.
+    :return: AsyncStage, AsyncMeter
+    """
+    stage = sim.SimulatedStage(limits=limits)
+    return AsyncStage(stage), AsyncMeter(sim.SimulatedMeter(stage, field, noise, period))
+
+
+async def scan_points(stage, meter, targets, time_wait=0.0, n_reps=3, speed=25, acceleration=0.3, limit_period=0.05,
+                      progress=None):
+    """
+    Measures at a list of positions while a limit switch monitor runs alongside. Tripping a limit switch stops the
+    stage and raises LimitSwitchError.
+    :param stage: AsyncStage.
+    :param meter: AsyncMeter.
+    :param targets: (n, 3) positions in mm, visited in order.
+    :param time_wait: settle time after each move.
+    :param n_reps: readings averaged per point.
+    :param limit_period: seconds between limit switch polls, None to not monitor.
+    :param progress: asyncio.Queue receiving (nth, total, position, averaged reading) after every point.
+    :return: pd.DataFrame with box_scan columns, rows in order of targets.
+    """
+    targets = np.asarray(targets, dtype=float).reshape(-1, 3)
+    values = np.zeros((len(targets), 6))
+
+    async def measure():
+        for nth, target in enumerate(targets):
+            await stage.move_to(target, speed, acceleration, delay=time_wait)
+            values[nth] = await meter.read_n_times(n_reps)
+            if progress is not None:
+                await progress.put((nth, len(targets), target, values[nth]))
+
+    measuring = asyncio.ensure_future(measure())
+    tasks = [measuring]
+    if limit_period is not None:
+        tasks.append(asyncio.ensure_future(stage.monitor_limits(limit_period)))
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    data = np.hstack([targets, values])
+    return pd.DataFrame(data, columns=['x', 'y', 'z', 'mag_x', 'mag_y', 'mag_z', 'temp_x', 'temp_y', 'temp_z'])
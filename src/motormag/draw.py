@@ -1,9 +1,15 @@
-import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-from scipy.interpolate import griddata
-from matplotlib.colors import LogNorm, Normalize
 from ._mode import cmap
+from . import interp
+from . import log
+from .grid import FieldGrid, as_grid
+
+
+def _pyplot():
+    # pyplot takes longer to import than everything else here, so analysis-only use does not pay for it.
+    import matplotlib.pyplot as plt
+    return plt
 
 
 def dataframe_to_matrices(data: pd.DataFrame, lengths=None):
@@ -29,68 +35,143 @@ def dataframe_to_matrices(data: pd.DataFrame, lengths=None):
     return {'x': x, 'y': y, 'z': z}, {'x': mag_x, 'y': mag_y, 'z': mag_z}
 
 
-def join_dataframes(dataframes):
-    pass
+# Joins index a dense array over the bounding lattice when it has at most this many cells per point, else they sort.
+DENSE_LATTICE_RATIO = 8
+
+
+def _lattice_spacing(dataframes, coordinates):
+    """
+    Per-axis lattice spacing: smallest step size in the scans' attrs, else the smallest gap between distinct coordinates.
+    NaN for axes with a single position.
+    """
+    spacing = np.full(3, np.nan)
+    for df in dataframes:
+        steps = np.abs(np.asarray(df.attrs.get('step_sizes', [np.nan] * 3), dtype=float))
+        spacing = np.fmin(spacing, np.where(steps > 0, steps, np.nan))
+    for i in np.flatnonzero(np.isnan(spacing)):
+        gaps = np.diff(np.unique(np.round(coordinates[:, i], 6)))
+        if len(gaps):
+            spacing[i] = gaps.min()
+    return spacing
+
+
+def join_dataframes(dataframes, spacing=None, tolerance=0.25):
+    """
+    Merges scans of overlapping or adjacent volumes, e.g. from several sessions or split to fit the stage travel. Points
+    are snapped to a common lattice and matched by lattice index, O(n) without interpolation. Points measured more than
+    once are averaged, weighted by 1 / std_error ** 2 if all scans have std_error, else equally.
+    :param dataframes: list of scan DataFrames with x, y, z, mag_x, mag_y, mag_z columns.
+    :param spacing: lattice spacing in mm, scalar or [x, y, z]. Defaults to the finest step size of the scans.
+    :param tolerance: fraction of spacing a point may be off the lattice before a warning is logged.
+    :return: DataFrame on lattice coordinates. If the points fill their bounding box it is in box_scan order with attrs
+    lengths and step_sizes, so it works with FieldGrid. Otherwise rows are in lattice order without lengths, and
+    attrs['holes'] lists the (k, 3) lattice positions inside the box that no scan covers, None if the points are too
+    sparse in it to list them.
+    """
+    dataframes = [df for df in dataframes if len(df)]
+    if not dataframes:
+        raise ValueError('Nothing to join')
+    fields = ['mag_x', 'mag_y', 'mag_z']
+    extra = [c for c in ['temp_x', 'temp_y', 'temp_z', 'reads'] if all(c in df for df in dataframes)]
+    weighted = all('std_error' in df for df in dataframes)
+    coordinates = np.vstack([df[['x', 'y', 'z']].to_numpy(dtype=float) for df in dataframes])
+    values = np.vstack([df[fields + extra].to_numpy(dtype=float) for df in dataframes])
+    if spacing is None:
+        spacing = _lattice_spacing(dataframes, coordinates)
+    spacing = np.broadcast_to(np.asarray(spacing, dtype=float), (3,))
+    origin = coordinates.min(axis=0)
+    step = np.where(np.isfinite(spacing) & (spacing > 0), spacing, 1.0)
+    position = (coordinates - origin) / step
+    indices = np.rint(position).astype(np.int64)
+    offset = np.abs(position - indices).max()
+    if offset > tolerance:
+        log.warn('Points up to %.2f lattice steps off the %s mm lattice, snapped to the nearest node.' % (
+            offset, spacing))
+    lengths = tuple(int(n) for n in indices.max(axis=0) + 1)
+    keys = np.ravel_multi_index(indices.T, lengths)
+    size = int(np.prod(lengths))
+
+    # Join on lattice index: dense bincount over the bounding lattice when it is small enough, sort otherwise.
+    if size <= DENSE_LATTICE_RATIO * len(keys):
+        counts = np.bincount(keys, minlength=size)
+        occupied = np.flatnonzero(counts)
+        slot = np.full(size, -1, dtype=np.int64)
+        slot[occupied] = np.arange(len(occupied))
+        group = slot[keys]
+    else:
+        occupied, group = np.unique(keys, return_inverse=True)
+    n = len(occupied)
+
+    if weighted:
+        error = np.concatenate([df['std_error'].to_numpy(dtype=float) for df in dataframes])
+        good = np.isfinite(error) & (error > 0)
+        # Points without a usable error estimate weigh like the best one measured.
+        floor = error[good].min() if np.any(good) else 1.0
+        weights = 1.0 / np.where(good, error, floor) ** 2
+    else:
+        weights = np.ones(len(keys))
+    total_weight = np.bincount(group, weights=weights, minlength=n)
+    data = {}
+    node_spacing = np.where(np.isfinite(spacing), spacing, 0.0)
+    node = np.array(np.unravel_index(occupied, lengths)).T * node_spacing + origin
+    for i, ax in enumerate('xyz'):
+        data[ax] = node[:, i]
+    for j, column in enumerate(fields + extra):
+        if column == 'reads':
+            data[column] = np.bincount(group, weights=values[:, j], minlength=n).astype(int)
+        else:
+            data[column] = np.bincount(group, weights=weights * values[:, j], minlength=n) / total_weight
+    if weighted:
+        data['std_error'] = np.sqrt(1.0 / total_weight)
+    df = pd.DataFrame(data)
+
+    overlapping = len(keys) - n
+    log.log('Joined %d scans, %d points onto %d lattice nodes, %d overlapping.' % (
+        len(dataframes), len(keys), n, overlapping))
+    if n == size:
+        df.attrs['lengths'] = list(lengths)
+        df.attrs['step_sizes'] = [float(s) if length > 1 else np.nan for s, length in zip(spacing, lengths)]
+    elif size <= DENSE_LATTICE_RATIO * len(keys):
+        df.attrs['holes'] = np.array(np.unravel_index(np.flatnonzero(counts == 0), lengths)).T * node_spacing + origin
+        log.warn('Joined scans do not fill a box: %d of %d lattice nodes not covered, see attrs["holes"].' % (
+            size - n, size))
+    else:
+        # Too sparse to list every empty node.
+        df.attrs['holes'] = None
+        log.warn('Joined scans are sparse in their bounding box: %d of %d lattice nodes not covered.' % (
+            size - n, size))
+    return df
 
 
 def calculate_mag_field_amplitude(data, axes='xyz'):
     """
     Returns [coordinates, 3-d scalar matrix] for magnetic field strength.
-    :param data: input DataFrame
+    :param data: input DataFrame or FieldGrid
     :param axes: output is the vector sum of specified components. 'xyz', 'xy', 'y', etc.
     :return: [coordinates, value]
     coordinates is a 3-matrix dict, values is a matrix.
     """
-    coordinates, mags = dataframe_to_matrices(data)
-    if len(axes) == 1:
-        return [coordinates, mags[axes]]
-    else:
-        return [coordinates, np.sqrt(sum([np.power(mags[ax], 2) for ax in axes]))]
+    grid = as_grid(data)
+    return [grid.coordinates, grid.amplitude(axes)]
 
 
 def mag_field_gradient(data, field_axes='xyz', directions='xyz'):
     """
     Calculates field gradients along specified axes.
-    :param data: input dataframe
+    :param data: input dataframe or FieldGrid
     :param field_axes: Which magnetic field components to calculate.
     :param directions: Which spatial directions to include, throws error if provided with size-1 array.
     :return: dict with structure d['bx']['y'] for dBx/dy etc.
     """
-    coords, mags = dataframe_to_matrices(data)
-    results = {}
-    for field_axis in field_axes:
-        results['b'+field_axis] = {}
-        step_size = data.attrs['step_sizes']['xyz'.index(field_axis)]
-        for direction in directions:
-            axis = 'xyz'.index(direction)
-            try:
-                results['b'+field_axis][direction] = np.gradient(mags[field_axis], step_size, axis=axis)
-            except ValueError:
-                raise ValueError('Gradient cannot be computed along axis %s' % direction)
-    return results
+    return as_grid(data).gradients(field_axes, directions)
 
 
 def field_gradient_squared(data, field_axes='xy', directions='xyz'):
-    gradients = mag_field_gradient(data, field_axes, directions)
-    components = []
-    for field_axis in field_axes:
-        for direction in directions:
-            components.append(gradients['b'+field_axis][direction] ** 2)
-    return sum(components)
+    return as_grid(data).gradient_squared(field_axes, directions)
 
 
 def relative_field_gradient_squared(data, field_axes='xy', directions='xyz', b_zero=None, center_position=None):
-    if center_position is None:
-        center_position = np.asarray(((data.max() + data.min()) / 2).loc[['x', 'y', 'z']])
-    if b_zero is None:
-        b_zero_components = griddata(data.loc[:, ['x', 'y', 'z']], data.loc[:, ['mag_x', 'mag_y', 'mag_z']], center_position)
-        b_zero_components = b_zero_components[0]
-        b_zero_squared = b_zero_components[0] ** 2 + b_zero_components[1] ** 2 + b_zero_components[2] ** 2
-    else:
-        b_zero_squared = b_zero ** 2
-    absolute_gradient_squared = field_gradient_squared(data, field_axes, directions)
-    relative_gradient_squared = absolute_gradient_squared / b_zero_squared
-    return relative_gradient_squared
+    return as_grid(data).relative_gradient_squared(field_axes, directions, b_zero, center_position)
 
 
 def _slice_2d_scalar(coordinates, values, cut_axis, cut_index=None, cut_position=None):
@@ -138,17 +219,19 @@ def determine_cut_indices(coordinates, cut_axis, indices, position):
 
 def determine_cut_index(coordinates, cut_axis, cut_index, cut_position):
     positions_slicer = tuple([slice(0, 1, 1) if ax != cut_axis else slice(None) for ax in 'xyz'])
-    values = coordinates[cut_axis][positions_slicer].flatten()
+    return _cut_index(coordinates[cut_axis][positions_slicer].flatten(), cut_index, cut_position)
+
+
+def _cut_index(values, cut_index, cut_position):
     if cut_index is not None:
         return cut_index, values[cut_index]
     elif cut_index is None and cut_position is None:
         return 0, values[0]
     else:
-        truth = np.isclose(values, cut_position)
-        for i, t in enumerate(truth):
-            if t:
-                return i, values[i]
-        raise ValueError("Requested cut plane position not in scanned data")
+        matches = np.flatnonzero(np.isclose(values, cut_position))
+        if len(matches) == 0:
+            raise ValueError("Requested cut plane position not in scanned data")
+        return int(matches[0]), values[matches[0]]
 
 
 def determine_1d_cut_axis(data_frame):
@@ -177,14 +260,15 @@ def determine_2d_cut_axis(data_frame):
 
 def plot_strength_1d(data_frame, cut_axis=None, cut_indices=None, cut_position=None, field_axis='xyz',
                      ax=None):
+    grid = as_grid(data_frame)
     if cut_axis is None:
-        cut_axis = determine_1d_cut_axis(data_frame)
-    coordinates, values = calculate_mag_field_amplitude(data_frame, axes=field_axis)
+        cut_axis = determine_1d_cut_axis(grid)
+    coordinates, values = grid.coordinates, grid.amplitude(field_axis)
     ci, cp = determine_cut_indices(coordinates, cut_axis, cut_indices, cut_position)
     x, y = slice_1d_scalar(coordinates, values, cut_axis, cut_indices)
     f = None
     if ax is None:
-        f, ax = plt.subplots(1)
+        f, ax = _pyplot().subplots(1)
     curve = ax.scatter(x, y)
     ax.set_ylabel('Field strength/mT')
     ax.set_xlabel('%s Position/mm' % cut_axis)
@@ -196,16 +280,16 @@ def plot_strength_1d(data_frame, cut_axis=None, cut_indices=None, cut_position=N
 
 def plot_relative_gradient_1d(data_frame, cut_axis=None, cut_indices=None, cut_position=None, field_axes='xy',
                               spatial_axes='xyz', b_zero=None, center_position=None, ax=None):
+    grid = as_grid(data_frame)
     if cut_axis is None:
-        cut_axis = determine_1d_cut_axis(data_frame)
-    coordinates, _ = dataframe_to_matrices(data_frame)
-    values = np.sqrt(relative_field_gradient_squared(data_frame, field_axes, directions=spatial_axes,
-                                                     b_zero=b_zero, center_position=center_position))
+        cut_axis = determine_1d_cut_axis(grid)
+    coordinates = grid.coordinates
+    values = np.sqrt(grid.relative_gradient_squared(field_axes, spatial_axes, b_zero, center_position))
     ci, cp = determine_cut_indices(coordinates, cut_axis, cut_indices, cut_position)
     x, y = slice_1d_scalar(coordinates, values, cut_axis, cut_indices)
     f = None
     if ax is None:
-        f, ax = plt.subplots(1)
+        f, ax = _pyplot().subplots(1)
     curve = ax.scatter(x, y)
     ax.set_ylabel('Relative field gradient/(1/mm)')
     ax.set_xlabel('%s Position/mm' % cut_axis)
@@ -216,15 +300,53 @@ def plot_relative_gradient_1d(data_frame, cut_axis=None, cut_indices=None, cut_p
     return f, ax, curve
 
 
+def _cut_grid(data, cut_axis, cut_index, cut_position, margin=0):
+    """
+    Grid to take a 2-D cut from. Of a storage.ScanFile only the cut plane and margin planes on either side are read.
+    :return: FieldGrid, cut_axis, index of the cut in the grid, index of the cut in the scan.
+    """
+    if not hasattr(data, 'planes'):
+        grid = as_grid(data)
+        if cut_axis is None:
+            cut_axis = determine_2d_cut_axis(grid)
+        cut_index, _ = determine_cut_index(grid.coordinates, cut_axis, cut_index, cut_position)
+        cut_index %= grid.shape['xyz'.index(cut_axis)]
+        return grid, cut_axis, cut_index, cut_index
+    if cut_axis is None:
+        cut_axis = determine_2d_cut_axis(data)
+    if cut_index is None:
+        cut_index, _ = _cut_index(data.axis(cut_axis), None, cut_position)
+    elif cut_index < 0:
+        cut_index += data.metadata['lengths']['xyz'.index(cut_axis)]
+    start = max(0, cut_index - margin)
+    return data.to_grid(cut_axis, start, cut_index + margin + 1), cut_axis, cut_index - start, cut_index
+
+
+def _planes_b_zero(scan_file, cut_axis, center_position=None):
+    """
+    |B| at center_position like FieldGrid.b_zero, reading only the planes around it from a storage.ScanFile.
+    """
+    k = 'xyz'.index(cut_axis)
+    positions = scan_file.axis(cut_axis)
+    center = (positions.max() + positions.min()) / 2 if center_position is None else center_position[k]
+    # Linear interpolation only looks at the two planes on either side.
+    nearest = np.sort(np.argsort(np.abs(positions - center))[:2])
+    grid = scan_file.to_grid(cut_axis, nearest[0], nearest[-1] + 1)
+    if center_position is None:
+        center_position = grid.center
+        center_position[k] = center
+    return np.sqrt(np.sum(grid.b_zero(center_position) ** 2))
+
+
 def plot_strength_2d(data_frame, cut_axis=None, cut_index=None, cut_position=None, field_axis='xyz',
                      vmin=None, vmax=None, norm=None, ax=None, cbar=True):
-    if cut_axis is None:
-        cut_axis = determine_2d_cut_axis(data_frame)
+    grid, cut_axis, grid_index, cut_index = _cut_grid(data_frame, cut_axis, cut_index, cut_position)
     cut_plane = [axis for axis in 'xyz' if axis != cut_axis]
-    coordinates, values = calculate_mag_field_amplitude(data_frame, axes=field_axis)
-    horizontal_matrix, vertical_matrix, values_matrix = _slice_2d_scalar(coordinates, values, cut_axis, cut_index, cut_position)
-    cut_index, cut_position = determine_cut_index(coordinates, cut_axis, cut_index, cut_position)
+    coordinates, values = grid.coordinates, grid.amplitude(field_axis)
+    horizontal_matrix, vertical_matrix, values_matrix = _slice_2d_scalar(coordinates, values, cut_axis, grid_index)
+    cut_position = grid.axes['xyz'.index(cut_axis)][grid_index]
     if norm is None:
+        from matplotlib.colors import Normalize
         norm = Normalize(vmin=vmin, vmax=vmax)
     f, ax, pcm = plot_scalar_matrix(horizontal_matrix, vertical_matrix, values_matrix, norm, ax, cbar)
     ax.set_title('Field: %s, cut position: %s=%.1f(i=%d) in mT' % (field_axis, cut_axis, cut_position, cut_index))
@@ -236,15 +358,16 @@ def plot_strength_2d(data_frame, cut_axis=None, cut_index=None, cut_position=Non
 def plot_relative_gradient_2d(data_frame, cut_axis=None, cut_index=None, cut_position=None, field_axes='xy',
                               spatial_axes='xyz', b_zero=None, center_position=None, vmin=1e-5, vmax=1e-1, norm=None,
                               ax=None, cbar=True):
-    if cut_axis is None:
-        cut_axis = determine_2d_cut_axis(data_frame)
-    coordinates, _ = dataframe_to_matrices(data_frame)
-    values = np.sqrt(relative_field_gradient_squared(data_frame, field_axes, directions=spatial_axes,
-                                                     b_zero=b_zero, center_position=center_position))
-    horizontal_matrix, vertical_matrix, values_matrix = _slice_2d_scalar(coordinates, values, cut_axis, cut_index,
-                                                                         cut_position)
-    cut_index, cut_position = determine_cut_index(coordinates, cut_axis, cut_index, cut_position)
+    # Gradients along cut_axis need the planes next to the cut.
+    grid, cut_axis, grid_index, cut_index = _cut_grid(data_frame, cut_axis, cut_index, cut_position, margin=1)
+    if b_zero is None and hasattr(data_frame, 'planes'):
+        b_zero = _planes_b_zero(data_frame, cut_axis, center_position)
+    coordinates = grid.coordinates
+    values = np.sqrt(grid.relative_gradient_squared(field_axes, spatial_axes, b_zero, center_position))
+    horizontal_matrix, vertical_matrix, values_matrix = _slice_2d_scalar(coordinates, values, cut_axis, grid_index)
+    cut_position = grid.axes['xyz'.index(cut_axis)][grid_index]
     if norm is None:
+        from matplotlib.colors import LogNorm
         norm = LogNorm(vmin=vmin, vmax=vmax)
     f, ax, pcm = plot_scalar_matrix(horizontal_matrix, vertical_matrix, values_matrix, norm, ax, cbar)
     contour_plot = ax.contour(horizontal_matrix, vertical_matrix, values_matrix, [2e-5, 5e-5, 1e-4, 2e-4, 0.0005],
@@ -256,15 +379,23 @@ def plot_relative_gradient_2d(data_frame, cut_axis=None, cut_index=None, cut_pos
 
 # noinspection PyTypeChecker
 def determine_fixed_axes(data_frame):
-    fixed = [all(data_frame.loc[:, 'x'] == data_frame.loc[0, 'x']),
-            all(data_frame.loc[:, 'y'] == data_frame.loc[0, 'y']),
-            all(data_frame.loc[:, 'z'] == data_frame.loc[0, 'z'])]
+    if isinstance(data_frame, FieldGrid):
+        return data_frame.fixed_axes
+    if hasattr(data_frame, 'planes'):
+        # storage.ScanFile, shape from its metadata.
+        return [ax for (ax, n) in zip('xyz', data_frame.metadata['lengths']) if n == 1]
+    lengths = data_frame.attrs.get('lengths')
+    if lengths is not None and np.prod(lengths) == len(data_frame):
+        # Box scans record their shape, an axis with one step is fixed. Filtered frames keep stale attrs, hence the check.
+        return [ax for (ax, n) in zip('xyz', lengths) if n == 1]
+    coords = data_frame[['x', 'y', 'z']].to_numpy()
+    fixed = np.all(coords == coords[0], axis=0)
     return [ax for (ax, t) in zip('xyz', fixed) if t]
 
 
 def plot_scalar_matrix(horizontal_matrix, vertical_matrix, values_matrix, norm=None, ax=None, cbar=True):
     if ax is None:
-        f, ax = plt.subplots(1)
+        f, ax = _pyplot().subplots(1)
     else:
         f = ax.figure
     ax.axis('equal')
@@ -297,15 +428,16 @@ def sub(field: pd.DataFrame, background: pd.DataFrame):
 
 def interpolate_dataframes(df_coords, df_values):
     """
-    Interpolates values in df_values onto coordinates in df_coords.
+    Interpolates values in df_values onto coordinates in df_coords. The interpolator for df_values' coordinates is
+    cached, so matching many fields against the same background only triangulates once, see interp.
     :param df_coords: Onto which positions to evaluate.
     :param df_values: Field values.
     :return: A new dataframe with positions in df_coords and data from df_values.
     """
     df_coords = df_coords.copy()
-    df_coords.loc[:, ['mag_x', 'mag_y', 'mag_z']] = griddata(df_values.loc[:, ['x', 'y', 'z']],
-                                                             df_values.loc[:, ['mag_x', 'mag_y', 'mag_z']],
-                                                             df_coords.loc[:, ['x', 'y', 'z']])
+    df_coords.loc[:, ['mag_x', 'mag_y', 'mag_z']] = interp.interpolate(df_values.loc[:, ['x', 'y', 'z']],
+                                                                       df_values.loc[:, ['mag_x', 'mag_y', 'mag_z']],
+                                                                       df_coords.loc[:, ['x', 'y', 'z']])
     return df_coords
 
 
@@ -324,8 +456,9 @@ def div(dividend, divisor):
 
 
 def average_gradient(displacement, geometry, data, field_axes='xy', spatial_axes='xyz'):
-    coordinates, _ = dataframe_to_matrices(data)
-    v = relative_field_gradient_squared(data, field_axes, directions=spatial_axes, b_zero=1e-2).flatten()
+    grid = as_grid(data)
+    coordinates = grid.coordinates
+    v = grid.relative_gradient_squared(field_axes, spatial_axes, b_zero=1e-2).flatten()
     x, y, z = coordinates['x'].flatten(), coordinates['y'].flatten(), coordinates['z'].flatten()
-    gradients = griddata(np.vstack([x, y, z]).T, v, geometry[['x', 'y', 'z']] + displacement)
+    gradients = interp.interpolate(np.vstack([x, y, z]).T, v, geometry[['x', 'y', 'z']] + displacement)
     return np.sum(gradients) / len(geometry)
\ No newline at end of file
@@ -0,0 +1,234 @@
+"""
+Software model of where the stage may go: travel limits, obstacle boxes and the extent of the probe holder around the
+stage position. A planned path is checked against it in one vectorized pass before anything moves, which replaces
+driving to the corners of every scan. trace_perimeter is the physical check for when one is still wanted.
+The envelope in use is set with use(), or loaded from ENVELOPE_FILE on first use if that exists.
+"""
+import json
+import os
+import numpy as np
+
+from . import log
+from . import motor
+
+
+ENVELOPE_FILE = os.environ.get('MOTORMAG_ENVELOPE', os.path.join(os.path.expanduser('~'), '.motormag',
+                                                                 'envelope.json'))
+_current = None
+_loaded = False
+
+
+class EnvelopeError(ValueError):
+    """
+    Raised when a path leaves the envelope. index is the first offending segment, segment i ending at point i.
+    """
+    def __init__(self, message, index):
+        super().__init__(message)
+        self.index = index
+
+
+def _box(low, high):
+    low, high = np.asarray(low, dtype=float), np.asarray(high, dtype=float)
+    if low.shape != (3,) or high.shape != (3,) or np.any(low > high):
+        raise ValueError('Box needs [x, y, z] low <= high, got %s, %s' % (low, high))
+    return low, high
+
+
+class Envelope(object):
+    """
+    Allowed stage positions. Coordinates are stage coordinates in mm as from motor.get_position.
+    """
+    def __init__(self, travel=None, obstacles=(), holder=None, margin=0.0):
+        """
+        :param travel: ([x, y, z] low, [x, y, z] high) positions the stage may reach, None for no limits.
+        :param obstacles: list of (low, high) or (low, high, name) boxes the probe holder must stay out of, e.g. the
+        magnet, in the coordinates the stage position would have with the probe tip at them.
+        :param holder: (low, high) extent of the probe holder relative to the stage position, None for a point.
+        :param margin: clearance in mm kept to obstacles.
+        """
+        self.travel = None if travel is None else _box(*travel)
+        self.obstacles = []
+        for n, obstacle in enumerate(obstacles):
+            low, high = _box(obstacle[0], obstacle[1])
+            self.obstacles.append((low, high, obstacle[2] if len(obstacle) > 2 else 'obstacle %d' % n))
+        self.holder = _box([0, 0, 0], [0, 0, 0]) if holder is None else _box(*holder)
+        self.margin = float(margin)
+
+    def _expanded(self):
+        """
+        :return: (k, 3) low and high of obstacles grown by holder and margin, as boxes the stage position must avoid.
+        """
+        if not self.obstacles:
+            return np.zeros((0, 3)), np.zeros((0, 3))
+        low = np.array([o[0] for o in self.obstacles]) - self.holder[1] - self.margin
+        high = np.array([o[1] for o in self.obstacles]) - self.holder[0] + self.margin
+        return low, high
+
+    def violations(self, points, start=(0.0, 0.0, 0.0), coordinated=True):
+        """
+        Checks the straight moves start -> points[0] -> points[1] ... Uncoordinated moves are checked by the box
+        spanned by their ends, which contains any path the axes take.
+        :param points: (n, 3) path.
+        :param start: where the stage is before the first move.
+        :param coordinated: move type.
+        :return: list of (segment index, reason), empty if the path is fine.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if len(points) == 0:
+            return []
+        begins = np.vstack([np.asarray(start, dtype=float).reshape(1, 3), points[:-1]])
+        found = []
+        if self.travel is not None:
+            outside = np.flatnonzero(np.any((points < self.travel[0]) | (points > self.travel[1]), axis=1))
+            found += [(i, 'outside travel limits at %s' % points[i]) for i in outside]
+        low, high = self._expanded()
+        if len(low):
+            hits = _segments_hit_boxes(begins, points, low, high) if coordinated else \
+                _boxes_overlap(np.minimum(begins, points), np.maximum(begins, points), low, high)
+            found += [(i, 'hits %s' % self.obstacles[k][2]) for i, k in zip(*np.nonzero(hits))]
+        return sorted(found, key=lambda v: v[0])
+
+    def check_path(self, points, start=(0.0, 0.0, 0.0), coordinated=True):
+        """
+        Raises EnvelopeError for the first segment of violations.
+        :return: None
+        """
+        found = self.violations(points, start, coordinated)
+        if found:
+            index, reason = found[0]
+            raise EnvelopeError('Path leaves machine envelope: move %d %s (%d violations).' % (
+                index, reason, len(found)), index)
+
+    def check_box(self, low, high):
+        """
+        Checks that everything inside a box is allowed, for scans whose path is not known in advance.
+        :return: None
+        """
+        low, high = _box(low, high)
+        if self.travel is not None and (np.any(low < self.travel[0]) or np.any(high > self.travel[1])):
+            raise EnvelopeError('Scan volume %s to %s exceeds travel limits.' % (low, high), 0)
+        hit = _boxes_overlap(low.reshape(1, 3), high.reshape(1, 3), *self._expanded())
+        if np.any(hit):
+            raise EnvelopeError('Scan volume %s to %s hits %s.' % (low, high, self.obstacles[np.argmax(hit[0])][2]),
+                                0)
+
+    def to_dict(self):
+        return {'travel': None if self.travel is None else [list(v) for v in self.travel],
+                'obstacles': [[list(o[0]), list(o[1]), o[2]] for o in self.obstacles],
+                'holder': [list(v) for v in self.holder], 'margin': self.margin}
+
+    def save(self, path=None):
+        """
+        :param path: JSON file, ENVELOPE_FILE by default.
+        """
+        path = ENVELOPE_FILE if path is None else path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=float)
+
+
+def _segments_hit_boxes(begins, ends, low, high):
+    """
+    Slab test of n segments against k boxes.
+    :return: (n, k) bool array.
+    """
+    begins, direction = begins[:, None, :], (ends - begins)[:, None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_low = (low[None] - begins) / direction
+        t_high = (high[None] - begins) / direction
+    t_near = np.where(direction == 0, np.where((begins >= low[None]) & (begins <= high[None]), -np.inf, np.inf),
+                      np.minimum(t_low, t_high))
+    t_far = np.where(direction == 0, np.where((begins >= low[None]) & (begins <= high[None]), np.inf, -np.inf),
+                     np.maximum(t_low, t_high))
+    enter = np.maximum(np.max(t_near, axis=2), 0.0)
+    leave = np.minimum(np.min(t_far, axis=2), 1.0)
+    return enter <= leave
+
+
+def _boxes_overlap(lows, highs, low, high):
+    """
+    :return: (n, k) bool array, True where box n overlaps box k.
+    """
+    return np.all((lows[:, None, :] <= high[None]) & (highs[:, None, :] >= low[None]), axis=2)
+
+
+def load(path=None):
+    """
+    :param path: JSON file written by Envelope.save, ENVELOPE_FILE by default.
+    :return: Envelope
+    """
+    with open(ENVELOPE_FILE if path is None else path) as f:
+        settings = json.load(f)
+    return Envelope(settings.get('travel'), settings.get('obstacles', []), settings.get('holder'),
+                    settings.get('margin', 0.0))
+
+
+def use(envelope):
+    """
+    Sets the envelope scans are checked against, None to check nothing.
+    """
+    global _current, _loaded
+    _current = envelope
+    _loaded = True
+
+
+def current():
+    """
+    :return: Envelope in use, loaded from ENVELOPE_FILE on first call if not set with use, None if there is none.
+    """
+    global _current, _loaded
+    if not _loaded:
+        _loaded = True
+        if os.path.exists(ENVELOPE_FILE):
+            _current = load(ENVELOPE_FILE)
+            log.log('Loaded machine envelope from %s.' % ENVELOPE_FILE)
+    return _current
+
+
+def check_path(points, start=(0.0, 0.0, 0.0), coordinated=True):
+    """
+    Envelope.check_path with the envelope in use, warns if there is none.
+    """
+    envelope = current()
+    if envelope is None:
+        log.warn('No machine envelope configured, path not checked. See envelope.use.')
+        return
+    envelope.check_path(points, start, coordinated)
+
+
+def check_box(low, high):
+    """
+    Envelope.check_box with the envelope in use, warns if there is none.
+    """
+    envelope = current()
+    if envelope is None:
+        log.warn('No machine envelope configured, scan volume not checked. See envelope.use.')
+        return
+    envelope.check_box(low, high)
+
+
+def perimeter(x_points, y_points, z_points):
+    """
+    :return: (8, 3) corners of the bounding box of the scan, in an order visiting each once along edges.
+    """
+    (x0, x1), (y0, y1), (z0, z1) = [(min(p), max(p)) for p in (x_points, y_points, z_points)]
+    return np.array([[x0, y0, z0], [x1, y0, z0], [x1, y1, z0], [x0, y1, z0],
+                     [x0, y1, z1], [x1, y1, z1], [x1, y0, z1], [x0, y0, z1]], dtype=float)
+
+
+def trace_perimeter(x_points, y_points, z_points, speed=25, acceleration=0.3, stage=motor):
+    """
+    Drives once along the edges of the scan volume through all 8 corners, at scan speed, and back to where it started.
+    Limit switches are read while moving (see motor.watch_limits and motor.limit_period), a tripped switch stops the
+    stage and raises motor.LimitSwitchError.
+    :param stage: motor module or a stand-in.
+    :return: None. Ctrl + C to abort.
+    """
+    start = stage.get_position()
+    corners = perimeter(x_points, y_points, z_points)
+    log.log('Tracing perimeter of scan volume.')
+    for corner in list(corners) + [start]:
+        stage.multi_absolute_move(list(corner), speed=speed, acceleration=acceleration, block=False)
+        stage.wait()
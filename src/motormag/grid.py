@@ -0,0 +1,171 @@
+"""
+Regular-grid container for box scans. Converting a scan DataFrame into matrices and computing gradients is done once
+per FieldGrid and memoized, so pass a FieldGrid instead of the DataFrame to draw functions when making many plots of
+the same scan.
+"""
+import numpy as np
+import pandas as pd
+
+from . import interp
+
+
+class FieldGrid(object):
+    """
+    Box scan as axis vectors plus one contiguous (3, nx, ny, nz) field array. Derived quantities are computed on first
+    use and cached, treat the arrays as read-only.
+    """
+    def __init__(self, axes, field, temperatures=None):
+        """
+        :param axes: [x_points, y_points, z_points], each sorted ascending or descending.
+        :param field: (3, nx, ny, nz) array of mag_x, mag_y, mag_z.
+        :param temperatures: optional (3, nx, ny, nz) array of temp_x, temp_y, temp_z.
+        """
+        self.axes = [np.asarray(a, dtype=float) for a in axes]
+        self.field = np.ascontiguousarray(field, dtype=float)
+        self.temperatures = temperatures
+        self.shape = tuple(len(a) for a in self.axes)
+        if self.field.shape != (3,) + self.shape:
+            raise ValueError('Field shape %s does not match axes %s' % (str(self.field.shape), str(self.shape)))
+        self._cache = {}
+
+    @classmethod
+    def from_dataframe(cls, data: pd.DataFrame, lengths=None):
+        """
+        :param data: as-scanned dataframe, rows in box_scan order.
+        :param lengths: number of steps in [x, y, z] directions. Tries to pull from df.attrs if not given.
+        :return: FieldGrid
+        """
+        if lengths is None:
+            try:
+                lengths = data.attrs['lengths']
+            except KeyError:
+                raise ValueError('no matrix size data available')
+        lengths = tuple(lengths)
+        x, y, z = [data[ax].to_numpy().reshape(lengths) for ax in 'xyz']
+        axes = [x[:, 0, 0], y[0, :, 0], z[0, 0, :]]
+        field = data[['mag_x', 'mag_y', 'mag_z']].to_numpy().T.reshape((3,) + lengths)
+        temperatures = None
+        if all(col in data for col in ['temp_x', 'temp_y', 'temp_z']):
+            temperatures = data[['temp_x', 'temp_y', 'temp_z']].to_numpy().T.reshape((3,) + lengths)
+        return cls(axes, field, temperatures)
+
+    def _memo(self, key, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    @property
+    def coordinates(self):
+        """
+        :return: dict of x, y, z coordinate matrices like dataframe_to_matrices, as broadcast views without copies.
+        """
+        def compute():
+            x, y, z = np.meshgrid(*self.axes, indexing='ij', sparse=True)
+            return {'x': np.broadcast_to(x, self.shape), 'y': np.broadcast_to(y, self.shape),
+                    'z': np.broadcast_to(z, self.shape)}
+        return self._memo('coordinates', compute)
+
+    @property
+    def mags(self):
+        """
+        :return: dict of mag_x, mag_y, mag_z matrices like dataframe_to_matrices, as views into field.
+        """
+        return {'x': self.field[0], 'y': self.field[1], 'z': self.field[2]}
+
+    @property
+    def fixed_axes(self):
+        return [ax for ax, a in zip('xyz', self.axes) if len(a) == 1]
+
+    @property
+    def center(self):
+        return np.array([(a.max() + a.min()) / 2 for a in self.axes])
+
+    @property
+    def spatial_index(self):
+        """
+        :return: spatial.SpatialIndex over the grid nodes, for nearest point, radius, interpolation and cut queries.
+        """
+        from . import spatial
+        return spatial.get_index(self)
+
+    def amplitude(self, axes='xyz'):
+        """
+        :param axes: vector sum of specified components. 'xyz', 'xy', 'y', etc.
+        :return: matrix
+        """
+        if len(axes) == 1:
+            return self.mags[axes]
+        return self._memo(('amplitude', axes),
+                          lambda: np.sqrt(sum([np.power(self.mags[ax], 2) for ax in axes])))
+
+    def gradient(self, field_axis, direction):
+        """
+        :return: dB_field_axis / d_direction matrix.
+        """
+        def compute():
+            axis = 'xyz'.index(direction)
+            try:
+                return np.gradient(self.mags[field_axis], self.axes[axis], axis=axis)
+            except (ValueError, IndexError):
+                raise ValueError('Gradient cannot be computed along axis %s' % direction)
+        return self._memo(('gradient', field_axis, direction), compute)
+
+    def gradients(self, field_axes='xyz', directions='xyz'):
+        """
+        :return: dict with structure d['bx']['y'] for dBx/dy etc.
+        """
+        return {'b' + field_axis: {direction: self.gradient(field_axis, direction) for direction in directions}
+                for field_axis in field_axes}
+
+    def gradient_squared(self, field_axes='xy', directions='xyz'):
+        return self._memo(('gradient_squared', field_axes, directions),
+                          lambda: sum([self.gradient(f, d) ** 2 for f in field_axes for d in directions]))
+
+    def b_zero(self, center_position=None):
+        """
+        Field at center_position, interpolated.
+        :param center_position: [x, y, z], defaults to center of scanned volume.
+        :return: [bx, by, bz]
+        """
+        if center_position is None:
+            center_position = self.center
+        key = ('b_zero', tuple(np.asarray(center_position, dtype=float)))
+        coordinates = self.coordinates
+        return self._memo(key, lambda: interp.interpolate(
+            np.vstack([coordinates[ax].ravel() for ax in 'xyz']).T, self.field.reshape(3, -1).T,
+            center_position)[0])
+
+    def relative_gradient_squared(self, field_axes='xy', directions='xyz', b_zero=None, center_position=None):
+        if b_zero is None:
+            b_zero_squared = np.sum(self.b_zero(center_position) ** 2)
+        else:
+            b_zero_squared = b_zero ** 2
+        return self.gradient_squared(field_axes, directions) / b_zero_squared
+
+    def to_dataframe(self):
+        """
+        :return: DataFrame in box_scan layout.
+        """
+        coordinates = self.coordinates
+        data = {ax: coordinates[ax].ravel() for ax in 'xyz'}
+        for i, ax in enumerate('xyz'):
+            data['mag_' + ax] = self.field[i].ravel()
+        if self.temperatures is not None:
+            for i, ax in enumerate('xyz'):
+                data['temp_' + ax] = self.temperatures[i].ravel()
+        df = pd.DataFrame(data)
+        df.attrs['lengths'] = list(self.shape)
+        df.attrs['step_sizes'] = [a[1] - a[0] if len(a) > 1 else np.nan for a in self.axes]
+        return df
+
+
+def as_grid(data):
+    """
+    :param data: FieldGrid, returned as is, a box scan DataFrame, or anything with to_grid() like storage.ScanFile.
+    :return: FieldGrid
+    """
+    if isinstance(data, FieldGrid):
+        return data
+    if hasattr(data, 'to_grid'):
+        return data.to_grid()
+    return FieldGrid.from_dataframe(data)
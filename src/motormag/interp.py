@@ -0,0 +1,110 @@
+"""
+Reusable interpolation of scan values onto other positions. Building a 3-D Delaunay triangulation of a scan is the
+expensive part of griddata, so interpolators are kept in a small LRU cache keyed on the source coordinates and reused
+by draw.sub, draw.div, draw.interpolate_dataframes and the gradient functions.
+"""
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+
+CACHE_SIZE = 8
+_cache = OrderedDict()
+
+
+def _as_grid(coords):
+    """
+    Checks if coords are a full box grid in any row order.
+    :return: (axis vectors, row order turning values into C-ordered grid) or None.
+    """
+    axes = [np.unique(coords[:, i]) for i in range(3)]
+    if np.prod([len(a) for a in axes]) != len(coords):
+        return None
+    order = np.lexsort([coords[:, 2], coords[:, 1], coords[:, 0]])
+    xm, ym, zm = np.meshgrid(*axes, indexing='ij')
+    if not np.array_equal(coords[order], np.vstack([xm.ravel(), ym.ravel(), zm.ravel()]).T):
+        return None
+    return axes, order
+
+
+class FieldInterpolator(object):
+    """
+    Linear interpolation from fixed source coordinates. Box grids use RegularGridInterpolator on the axis vectors
+    (scans with fixed axes included, which griddata cannot triangulate at all), anything else a Delaunay triangulation
+    built once. Positions outside the scanned volume get NaN, like griddata.
+    """
+    def __init__(self, coords):
+        """
+        :param coords: (n, 3) array of source x, y, z.
+        """
+        self.coords = np.ascontiguousarray(coords, dtype=float)
+        grid = _as_grid(self.coords)
+        if grid is not None:
+            self.kind = 'grid'
+            self.axes, self._order = grid
+            self._shape = tuple(len(a) for a in self.axes)
+            self._free = [i for i, a in enumerate(self.axes) if len(a) > 1]
+            self._fixed = [i for i, a in enumerate(self.axes) if len(a) == 1]
+        else:
+            # scipy is imported on first use, it dominates the import time of the package otherwise.
+            from scipy.spatial import Delaunay
+            self.kind = 'delaunay'
+            self._triangulation = Delaunay(self.coords)
+
+    def __call__(self, values, positions):
+        """
+        :param values: (n,) or (n, k) array of values at the source coordinates.
+        :param positions: (m, 3) array of positions to evaluate at.
+        :return: (m,) or (m, k) array.
+        """
+        values = np.asarray(values, dtype=float)
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        if positions.shape == self.coords.shape and np.array_equal(positions, self.coords):
+            return values.copy()
+        if self.kind == 'delaunay':
+            from scipy.interpolate import LinearNDInterpolator
+            return LinearNDInterpolator(self._triangulation, values)(positions)
+        grid_values = values[self._order].reshape(self._shape + values.shape[1:])
+        # Fixed axes are squeezed out, positions off their plane are outside the scan.
+        grid_values = grid_values.reshape([self._shape[i] for i in self._free] + list(values.shape[1:]))
+        off_plane = np.zeros(len(positions), dtype=bool)
+        for i in self._fixed:
+            off_plane |= ~np.isclose(positions[:, i], self.axes[i][0])
+        if self._free:
+            from scipy.interpolate import RegularGridInterpolator
+            interpolator = RegularGridInterpolator([self.axes[i] for i in self._free], grid_values,
+                                                   bounds_error=False, fill_value=np.nan)
+            result = interpolator(positions[:, self._free])
+        else:
+            result = np.broadcast_to(grid_values, (len(positions),) + grid_values.shape).copy()
+        result[off_plane] = np.nan
+        return result
+
+
+def get_interpolator(coords):
+    """
+    FieldInterpolator for coords, from cache if the same coordinates were seen recently.
+    :param coords: (n, 3) array of source x, y, z.
+    :return: FieldInterpolator
+    """
+    coords = np.ascontiguousarray(coords, dtype=float)
+    key = (coords.shape, hashlib.sha1(coords.tobytes()).hexdigest())
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    interpolator = FieldInterpolator(coords)
+    _cache[key] = interpolator
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return interpolator
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def interpolate(coords, values, positions):
+    """
+    Drop-in for griddata(coords, values, positions) with linear method, reusing cached interpolators.
+    """
+    return get_interpolator(coords)(values, positions)
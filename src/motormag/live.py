@@ -0,0 +1,189 @@
+"""
+Live field map while a scan runs. Points go into a preallocated field buffer as they arrive (push is cheap and thread
+safe, BoxScan calls it from its bookkeeping thread through observer), and one slice of it is shown as a pcolormesh.
+Frames are drawn at a bounded rate by blitting the mesh alone over a cached background, so neither the scan nor the
+axes, labels and colorbar get redrawn per point.
+start() renders on a background thread, which is fine for Agg and other non-GUI backends. With a GUI backend, call
+refresh() periodically from the GUI thread instead, e.g. with the scan running in a thread.
+"""
+import threading
+import time
+from collections import deque
+import numpy as np
+
+from ._mode import cmap
+from .grid import FieldGrid
+
+
+class LiveView(object):
+    """
+    Live slice of a box scan. Buffer layout follows the box scan: index i of a point is its row in box_scan order.
+    """
+    def __init__(self, x_points, y_points, z_points, cut_axis=None, cut_index=0, field_axis='xyz', fps=5.0,
+                 vmin=None, vmax=None, ax=None):
+        """
+        :param x_points: scan points along x, see scan.range_to_points.
+        :param y_points: see x.
+        :param z_points: see x.
+        :param cut_axis: normal of the slice shown, defaults to the axis with a single point, or z.
+        :param cut_index: which slice along cut_axis.
+        :param field_axis: amplitude of these field components is shown, 'xyz', 'z', etc.
+        :param fps: most frames drawn per second.
+        :param vmin: lower end of the color scale, follows the data if None.
+        :param vmax: upper end of the color scale, follows the data if None.
+        :param ax: axes to draw into, a new figure if None.
+        """
+        self.axes = [np.asarray(a, dtype=float) for a in (x_points, y_points, z_points)]
+        self.shape = tuple(len(a) for a in self.axes)
+        self.field = np.full((3,) + self.shape, np.nan)
+        if cut_axis is None:
+            single = [ax_name for ax_name, n in zip('xyz', self.shape) if n == 1]
+            cut_axis = single[0] if single else 'z'
+        self.field_axis = field_axis
+        self.interval = 1.0 / fps
+        self.vmin, self.vmax = vmin, vmax
+        self.points = 0
+        self.frames = 0
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_frame = 0.0
+        self.colorbar = None
+        if ax is None:
+            from . import draw
+            self.figure, self.ax = draw._pyplot().subplots(1)
+        else:
+            self.figure, self.ax = ax.figure, ax
+        self.canvas = self.figure.canvas
+        self.show(cut_axis, cut_index)
+
+    def show(self, cut_axis, cut_index=0):
+        """
+        Switches to another slice, redrawing the figure in full.
+        """
+        self.cut_axis = cut_axis
+        self.cut_index = cut_index
+        k = 'xyz'.index(cut_axis)
+        self._plane = [i for i in range(3) if i != k]
+        self._slicer = tuple(cut_index if i == k else slice(None) for i in range(3))
+        horizontal, vertical = [self.axes[i] for i in self._plane]
+        self.ax.clear()
+        self.ax.axis('equal')
+        self._limits = self._color_limits()
+        self.mesh = self.ax.pcolormesh(horizontal, vertical, np.ma.masked_invalid(self._slice().T), shading='auto',
+                                       cmap=cmap, vmin=self._limits[0], vmax=self._limits[1], animated=True)
+        if self.colorbar is None:
+            self.colorbar = self.figure.colorbar(self.mesh, ax=self.ax)
+        else:
+            self.colorbar.update_normal(self.mesh)
+        self.ax.set_title('Field: %s, cut position: %s=%.1f(i=%d) in mT' % (
+            self.field_axis, cut_axis, self.axes[k][cut_index], cut_index))
+        self.ax.set_xlabel('%s/mm' % 'xyz'[self._plane[0]])
+        self.ax.set_ylabel('%s/mm' % 'xyz'[self._plane[1]])
+        self._redraw()
+
+    def _slice(self):
+        return np.sqrt(sum(self.field['xyz'.index(ax)][self._slicer] ** 2 for ax in self.field_axis))
+
+    def _color_limits(self, headroom=0.0):
+        """
+        :param headroom: fraction of the data range added on both ends, so a growing scale is not redrawn every frame.
+        :return: low, high
+        """
+        values = np.sqrt(sum(self.field['xyz'.index(ax)] ** 2 for ax in self.field_axis))
+        low, high = (np.nanmin(values), np.nanmax(values)) if np.any(np.isfinite(values)) else (0.0, 1.0)
+        pad = max(high - low, 1e-9) * headroom
+        low, high = low - pad, max(high, low + 1e-9) + pad
+        return self.vmin if self.vmin is not None else low, self.vmax if self.vmax is not None else high
+
+    def _redraw(self):
+        """
+        Full draw of everything but the mesh, cached as the background to blit onto.
+        """
+        self.canvas.draw()
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._blit()
+
+    def _blit(self):
+        self.canvas.restore_region(self._background)
+        self.ax.draw_artist(self.mesh)
+        self.canvas.blit(self.ax.bbox)
+        self.canvas.flush_events()
+        self.frames += 1
+
+    def push(self, index, values):
+        """
+        Adds a measured point, to be drawn with the next frame. Cheap enough to call from the scan loop.
+        :param index: row of the point in box_scan order.
+        :param values: readings, the first three are mag_x, mag_y, mag_z.
+        """
+        self._pending.append((index, values[0], values[1], values[2]))
+
+    def refresh(self, force=False):
+        """
+        Moves pushed points into the buffer and draws a frame if any arrived and the last one is at least 1 / fps old.
+        :param force: draw regardless of the frame rate.
+        :return: True if a frame was drawn.
+        """
+        if not self._pending or (not force and time.monotonic() - self._last_frame < self.interval):
+            return False
+        with self._lock:
+            n = len(self._pending)
+            if n == 0:
+                return False
+            points = np.array([self._pending.popleft() for _ in range(n)])
+            grid_index = np.unravel_index(points[:, 0].astype(int), self.shape)
+            self.field[(slice(None),) + grid_index] = points[:, 1:].T
+            self.points += n
+            # Only the cells of new points in the shown slice change, written into the mesh's own array.
+            shown = grid_index['xyz'.index(self.cut_axis)] == self.cut_index
+            if np.any(shown):
+                amplitude = np.sqrt(np.sum(points[shown][:, [1 + 'xyz'.index(ax) for ax in self.field_axis]] ** 2,
+                                           axis=1))
+                data = self.mesh.get_array()
+                data[grid_index[self._plane[1]][shown], grid_index[self._plane[0]][shown]] = amplitude
+                self.mesh.set_array(data)
+            limits = self._color_limits()
+            if self.points == n or limits[0] < self._limits[0] or limits[1] > self._limits[1]:
+                # First points or color scale grew, the colorbar has to be redrawn with it.
+                limits = self._color_limits(headroom=0.1) if self.points > n else limits
+                self._limits = limits
+                self.mesh.set_clim(*limits)
+                self._redraw()
+            else:
+                self._blit()
+            self._last_frame = time.monotonic()
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.interval / 2)
+
+    def start(self):
+        """
+        Renders on a background thread until stop().
+        :return: self
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='motormag-live', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the render thread and draws whatever is still pending.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.refresh(force=True)
+
+    def to_grid(self):
+        """
+        :return: grid.FieldGrid of the points so far, NaN where not measured yet.
+        """
+        with self._lock:
+            return FieldGrid(self.axes, self.field.copy())
@@ -1,4 +1,15 @@
-from datetime import datetime
+"""
+Console logging. Messages are stamped when logged and written by a background thread, so a slow console never stalls
+the scan loop. Per-point progress goes through progress(), which prints at most one line per progress_interval with
+rate and ETA. With configure(json_path=...) every record, progress included, is also appended to a JSON lines file.
+"""
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
 from . import _mode
 
 
@@ -14,12 +25,93 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
+LEVELS = {None: 'info', bcolors.WARNING: 'warning', bcolors.FAIL: 'error', bcolors.OKCYAN: 'mock'}
+
+_background = True
+_progress_interval = 1.0
+_json_file = None
+_queue = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+_progress = {'total': None, 'done': 0, 'start': 0.0, 'first': 0, 'printed': 0.0}
+
+
+def configure(background=None, json_path=None, progress_interval=None):
+    """
+    :param background: write from a background thread (default) or synchronously.
+    :param json_path: file to append records to as JSON lines, '' to stop writing one, None to leave as is.
+    :param progress_interval: seconds between progress lines on the console, 0 to print every one.
+    :return: None
+    """
+    global _background, _progress_interval, _json_file
+    flush()
+    if background is not None:
+        _background = background
+    if progress_interval is not None:
+        _progress_interval = progress_interval
+    if json_path is not None:
+        if _json_file is not None:
+            _json_file.close()
+        _json_file = open(json_path, 'a') if json_path else None
+
+
+def _write(record):
+    color = record.pop('color', None)
+    if 'args' in record:
+        record['message'] = record['message'] % record['args']
+    if record.pop('console', True):
+        message = str(datetime.fromtimestamp(record['time'])) + ": " + record.pop('prefix', '') + record['message']
+        if color is None:
+            print(message)
+        else:
+            print(color + message + bcolors.ENDC)
+    if _json_file is not None:
+        _json_file.write(json.dumps(record, default=float) + '\n')
+
+
+def _run():
+    while True:
+        record = _queue.get()
+        try:
+            if record is not None:
+                _write(record)
+            elif _json_file is not None:
+                _json_file.flush()
+        except Exception as e:  # pragma: no cover
+            print('Logging failed: %r' % e, file=sys.stderr)
+        finally:
+            _queue.task_done()
+
+
+def _submit(record):
+    global _writer
+    if not _background:
+        _write(record)
+        return
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_run, name='motormag-log', daemon=True)
+                _writer.start()
+    _queue.put(record)
+
+
+def flush():
+    """
+    Blocks until all queued messages are written.
+    """
+    if _writer is not None:
+        _queue.put(None)
+        _queue.join()
+    elif _json_file is not None:
+        _json_file.flush()
+
+
+atexit.register(flush)
+
+
 def color_print(message, color=None):
-    message = str(datetime.now()) + ": " + message
-    if color is None:
-        print(message)
-    else:
-        print(color + message + bcolors.ENDC)
+    _submit({'time': time.time(), 'level': LEVELS.get(color, 'info'), 'message': message, 'color': color})
 
 
 def log(message):
@@ -28,6 +120,8 @@ def log(message):
 
 def fail(message):
     color_print(message, bcolors.FAIL)
+    # Failures usually precede an exception, keep them ahead of the traceback.
+    flush()
 
 
 def warn(message):
@@ -37,3 +131,31 @@ def warn(message):
 def mock(message):
     if _mode.log_mock:
         color_print('MOCK: ' + message, bcolors.OKCYAN)
+
+
+def progress(done, total, message, *args):
+    """
+    Per-step progress of a long loop. Printed at most once per progress_interval seconds plus on the last step, as
+    done/total with rate and ETA. The message is only formatted if it gets written.
+    :param done: steps done, a new run starts when this goes down or total changes.
+    :param total: total number of steps.
+    :param message: % format string for args, describing the last step.
+    :param args: values for message, also stored in the JSON lines record.
+    :return: None
+    """
+    now = time.time()
+    state = _progress
+    if total != state['total'] or done <= state['done']:
+        state.update(total=total, start=now, first=done, printed=0.0)
+    state['done'] = done
+    console = done == total or now - state['printed'] >= _progress_interval
+    if not console and _json_file is None:
+        return
+    rate = (done - state['first']) / (now - state['start']) if now > state['start'] else 0.0
+    record = {'time': now, 'level': 'progress', 'message': message, 'args': args, 'done': done, 'total': total,
+              'rate': rate, 'console': console}
+    if console:
+        state['printed'] = now
+        eta = timedelta(seconds=round((total - done) / rate)) if rate > 0 else '?'
+        record['prefix'] = '%d/%d, %.1f/min, ETA %s, ' % (done, total, rate * 60, eta)
+    _submit(record)
@@ -7,13 +7,16 @@ Created on Fri Sep  9 16:04:49 2022
 
 
 import numpy as np
-import serial
 import re
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 from . import log
 from . import _mode
+from .stream import StreamReader
 
 DEV = False
+COLUMNS = ['mag_x', 'mag_y', 'mag_z', 'temp_x', 'temp_y', 'temp_z']
 
 
 def parse_ch3600_serial(string):
@@ -28,67 +31,411 @@ def parse_ch330_serial(string):
     mag_x, mag_y, mag_z = re.findall(pattern, string)[0]
     return [mag_x, mag_y, mag_z, 0.0, 0.0, 0.0]
 
-def read_once(flush=True):
+
+def _to_array(mags_and_temps, ch3600=None):
+    if ch3600 is None:
+        ch3600 = _mode.CH3600
+    mags_and_temps_array = np.array([float(x) for x in mags_and_temps])
+    mags_and_temps_array[3:] = mags_and_temps_array[3:] / 10
+    if not ch3600:
+        mags_and_temps_array[0:3] = mags_and_temps_array[0:3] / 1e6
+    return mags_and_temps_array
+
+
+def parse_message(string, ch3600=None):
     """
-    Reads latest reading from CH330 or CH3600 gaussmeter.
-    :flush: if the serial port buffer should be flushed
-    :return: Length-6 ndarray, fields in x, y, z directions, followed by temp reading of x, y, z probes.
+    Parses one message of the configured gaussmeter model.
+    :param string: raw message
+    :param ch3600: message format, defaults to _mode.CH3600.
+    :return: Length-6 ndarray, see read_once.
     """
-    while True:
-        if _mode.MOCK:
-            log.mock('Read gaussmeter.')
-            raw_msg = r'#00000.0097/000/+0256;-00000.0003/000/+0256;-00000.0027/000/+256>'
+    if ch3600 is None:
+        ch3600 = _mode.CH3600
+    if ch3600:
+        return _to_array(parse_ch3600_serial(string), ch3600)
+    return _to_array(parse_ch330_serial(string), ch3600)
+
+
+# Lookup tables for parse_frames: bytes that may appear inside a frame, whitespace, and frame syntax mapped to blanks.
+_FRAME_CHARS = np.zeros(256, dtype=bool)
+_FRAME_CHARS[np.frombuffer(b'0123456789+-.#/;> \t\r\n', dtype=np.uint8)] = True
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[np.frombuffer(b' \t\r\n', dtype=np.uint8)] = True
+_BLANK_SYNTAX = np.arange(256, dtype=np.uint8)
+_BLANK_SYNTAX[np.frombuffer(b'#/;>', dtype=np.uint8)] = ord(' ')
+# Per model: '/' and ';' per frame, numbers per frame, columns of fields and temps among those numbers.
+_FRAME_LAYOUTS = {True: (6, 2, 9, [0, 3, 6], [2, 5, 8]),
+                  False: (2, 0, 3, [0, 1, 2], None)}
+
+
+def _count_in_frames(positions, starts, ends):
+    return np.searchsorted(positions, ends) - np.searchsorted(positions, starts)
+
+
+def parse_frames(buffer, ch3600=None):
+    """
+    Parses every complete '#...>' frame in a raw byte buffer in one go, without per-frame Python objects.
+    Equivalent to parse_message on each frame.
+    :param buffer: bytes from the serial port, any number of frames.
+    :param ch3600: frame format, defaults to _mode.CH3600.
+    :return: (n, 6) ndarray like read_once, number of malformed frames, and the unfinished trailing frame (bytes) to
+    be prepended to the next buffer.
+    """
+    if ch3600 is None:
+        ch3600 = _mode.CH3600
+    n_slashes, n_semicolons, width, field_columns, temp_columns = _FRAME_LAYOUTS[ch3600]
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    starts = np.flatnonzero(data == ord('#'))
+    ends = np.flatnonzero(data == ord('>'))
+    matched = np.searchsorted(ends, starts)
+    complete = matched < len(ends)
+    tail = b''
+    if len(starts) and not complete[-1]:
+        tail = bytes(buffer[starts[-1]:])
+        data = data[:starts[-1]]
+    starts, ends = starts[complete], ends[matched[complete]]
+    # A frame is cut short if the next one starts before its '>'.
+    whole = np.ones(len(starts), dtype=bool)
+    whole[:-1] = starts[1:] > ends[:-1]
+    fast = whole.copy()
+    fast &= _count_in_frames(np.flatnonzero(~_FRAME_CHARS[data]), starts, ends) == 0
+    fast &= _count_in_frames(np.flatnonzero(data == ord('/')), starts, ends) == n_slashes
+    fast &= _count_in_frames(np.flatnonzero(data == ord(';')), starts, ends) == n_semicolons
+    values = np.zeros((len(starts), 6))
+    parsed = fast.copy()
+    fast_starts, fast_ends = starts[fast], ends[fast]
+    if not np.all(fast) or np.count_nonzero(~_WHITESPACE[data]) != np.sum(fast_ends - fast_starts + 1):
+        # Only keep bytes of frames on the fast path, stray bytes outside frames included.
+        inside = np.zeros(len(data) + 1, dtype=np.int64)
+        inside[fast_starts] = 1
+        inside[fast_ends + 1] -= 1
+        data = data[np.cumsum(inside[:-1]) > 0]
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            numbers = np.fromstring(_BLANK_SYNTAX[data].tobytes(), sep=' ') if len(fast_starts) else np.zeros(0)
+    except (ValueError, DeprecationWarning):
+        numbers = None
+    if numbers is not None and len(numbers) == len(fast_starts) * width:
+        numbers = numbers.reshape(-1, width)
+        fast_values = np.zeros((len(numbers), 6))
+        fast_values[:, :3] = numbers[:, field_columns]
+        if ch3600:
+            fast_values[:, 3:] = numbers[:, temp_columns] / 10
         else:
+            fast_values[:, :3] /= 1e6
+        values[fast] = fast_values
+        slow = np.flatnonzero(whole & ~fast)
+    else:
+        # Something inside a frame is not a number after all, sort all frames out one by one.
+        parsed[:] = False
+        slow = np.flatnonzero(whole)
+    # Frames the byte checks reject, e.g. with unit or status text between fields, go through the regex parser.
+    for i in slow:
+        try:
+            values[i] = parse_message(bytes(buffer[starts[i]:ends[i] + 1]).decode(encoding='ascii'), ch3600)
+            parsed[i] = True
+        except (IndexError, ValueError, UnicodeDecodeError):
+            pass
+    n_bad = len(starts) - int(np.count_nonzero(parsed))
+    return values[parsed], n_bad, tail
+
+
+class FrameParser(object):
+    """
+    Incremental parse_frames for a byte stream: keeps the unfinished frame between chunks and counts bad frames
+    instead of warning about each.
+    """
+    def __init__(self, ch3600=None, max_tail=4096):
+        """
+        :param ch3600: frame format, defaults to _mode.CH3600 at each feed.
+        :param max_tail: an unfinished frame longer than this is dropped as bad.
+        """
+        self.ch3600 = ch3600
+        self.max_tail = max_tail
+        self.frames = 0
+        self.bad_frames = 0
+        self._tail = b''
+
+    def feed(self, chunk):
+        """
+        :param chunk: bytes
+        :return: (n, 6) ndarray of frames completed by this chunk.
+        """
+        values, n_bad, self._tail = parse_frames(self._tail + chunk, self.ch3600)
+        if len(self._tail) > self.max_tail:
+            self._tail = b''
+            n_bad += 1
+        self.frames += len(values)
+        self.bad_frames += n_bad
+        return values
+
+
+class Gaussmeter(object):
+    """
+    One CH330 or CH3600 gaussmeter on its own serial port. The module-level functions drive a default instance, make
+    more for scanning with several probes at once, see ProbeArray.
+    """
+    def __init__(self, port=None, ch3600=None, offset=(0.0, 0.0, 0.0), name=None):
+        """
+        :param port: serial port to open, see init. Stays closed if None.
+        :param ch3600: model, defaults to _mode.CH3600.
+        :param offset: [x, y, z] of the probe relative to the stage position in mm.
+        :param name: used in per-probe column names, see ProbeArray.
+        """
+        self.ch3600 = ch3600
+        self.offset = np.asarray(offset, dtype=float)
+        self.name = name
+        self.serial_port = None
+        self.stream = None
+        self._next_sample = 0
+        if port is not None:
+            self.init(port)
+
+    @property
+    def model_ch3600(self):
+        return _mode.CH3600 if self.ch3600 is None else self.ch3600
+
+    def init(self, port):
+        """
+        Opens the serial port. In mock mode a simulated gaussmeter is used instead, see sim.simulate.
+        :param port:(int, str), int X means COMX, or str 'COM8'
+        """
+        if _mode.MOCK:
+            from . import sim
+            if not isinstance(self.serial_port, sim.SimulatedSerial):
+                self.serial_port = sim.simulated_port()
+            log.mock('Simulated gaussmeter opened.')
+            return
+        import serial
+        if isinstance(port, int):
+            port = "COM%d" % port
+        self.serial_port = serial.Serial(port, 115200, timeout=5)
+        self.serial_port.write(b'DATA?>')
+        log.log("Gaussmeter port opened at %s" % port)
+
+    def close(self):
+        try:
+            self.stop_stream()
+        finally:
+            # A dead reader re-raises its error here, the port is released regardless so init can reopen it.
+            if self.serial_port is not None:
+                self.serial_port.close()
+                self.serial_port = None
+
+    def read_once(self, flush=True):
+        """
+        Reads latest reading from CH330 or CH3600 gaussmeter.
+        :flush: if the serial port buffer should be flushed. With a running stream: take the first sample arriving
+        after now rather than the one after the previous read.
+        :return: Length-6 ndarray, fields in x, y, z directions, followed by temp reading of x, y, z probes.
+        """
+        if self.streaming():
+            buffer = self.stream.buffer
+            if flush:
+                self._next_sample = buffer.count
+            self._next_sample = max(self._next_sample, buffer.oldest)
+            _, values = buffer.since(self._next_sample, 1, timeout=5.0)
+            self._next_sample += 1
+            return values[0]
+        ch3600 = self.model_ch3600
+        while True:
             if flush:
-                serial_port.read_all()
-                serial_port.read_until(b'\n')
-            raw_msg = serial_port.read_until(b'\n').decode(encoding='ascii')
-        if _mode.CH3600:
+                self.serial_port.read_all()
+                self.serial_port.read_until(b'\n')
+            raw_msg = self.serial_port.read_until(b'\n').decode(encoding='ascii')
             try:
-                mags_and_temps = parse_ch3600_serial(raw_msg)
+                mags_and_temps = parse_ch3600_serial(raw_msg) if ch3600 else parse_ch330_serial(raw_msg)
                 break
             except (IndexError, ValueError):
                 log.warn('Invalid message received: %s' % raw_msg)
-        else:
+        return _to_array(mags_and_temps, ch3600)
+
+    def read_n_times(self, reps):
+        if self.streaming():
+            _, values = self.stream.buffer.since(self.stream.buffer.count, reps, timeout=5.0)
+            return np.average(values, axis=0)
+        values = [self.read_once()]
+        for i in range(reps - 1):
+            values.append(self.read_once(flush=False))
+        return np.average(values, axis=0)
+
+    def start_stream(self, port=None, capacity=65536):
+        """
+        Starts continuous acquisition in a background thread. While running, read_once and read_n_times take samples
+        from the stream instead of flushing the port.
+        :param port: serial port to read, defaults to the one opened by init.
+        :param capacity: number of samples kept.
+        :return: stream.StreamReader
+        """
+        self.stop_stream()
+        if port is None and self.serial_port is None:
+            raise RuntimeError('Gaussmeter not initialized, run init(port) first.')
+        self.stream = StreamReader(self.serial_port if port is None else port, FrameParser(self.ch3600), capacity)
+        self.stream.start()
+        log.log('Gaussmeter stream started.')
+        return self.stream
+
+    def stop_stream(self):
+        """
+        Stops the stream, raising the exception its reader thread died of, if any.
+        """
+        if self.stream is not None:
+            stream, self.stream = self.stream, None
+            stream.stop()
+            log.log('Gaussmeter stream stopped: %d frames, %d invalid.' % (stream.parser.frames,
+                                                                          stream.parser.bad_frames))
+
+    def streaming(self):
+        return self.stream is not None and self.stream.running
+
+    def samples_after(self, t, n, timeout=5.0):
+        """
+        First n samples received after time t.
+        :param t: time.monotonic() timestamp.
+        :param n: number of samples.
+        :param timeout: raise TimeoutError if they do not arrive within this many seconds.
+        :return: times, (n, 6) values
+        """
+        return self._stream().buffer.after(t, n, timeout)
+
+    def samples_window(self, t0, t1):
+        """
+        All samples received between t0 and t1.
+        :return: times, (n, 6) values
+        """
+        return self._stream().buffer.window(t0, t1)
+
+    def _stream(self):
+        if self.stream is None:
+            raise RuntimeError('Gaussmeter stream not running, call start_stream() first.')
+        return self.stream
+
+
+class ProbeArray(object):
+    """
+    Several gaussmeters mounted on the carriage, read in parallel. Offers the read functions of the mag module, so a
+    BoxScan can use it as its meter: readings are the meters' readings side by side, and the scan data gets one set
+    of columns per probe (mag_x_<name>, ...) plus the offsets in attrs['probes']. probe_data turns that back into an
+    ordinary scan per probe, at the probe's actual positions.
+    """
+    def __init__(self, meters):
+        """
+        :param meters: Gaussmeters (or anything with their read functions, an offset and a name), names default to
+        p0, p1, ...
+        """
+        self.meters = list(meters)
+        self.names = [getattr(m, 'name', None) or 'p%d' % i for i, m in enumerate(self.meters)]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError('Probe names must be unique, got %s' % str(self.names))
+        self.offsets = [np.asarray(getattr(m, 'offset', (0.0, 0.0, 0.0)), dtype=float) for m in self.meters]
+        self._executor = ThreadPoolExecutor(max_workers=len(self.meters))
+
+    @property
+    def columns(self):
+        return ['%s_%s' % (column, name) for name in self.names for column in COLUMNS]
+
+    @property
+    def probes(self):
+        """
+        :return: dict of probe name to offset, as stored in scan attrs.
+        """
+        return {name: offset.tolist() for name, offset in zip(self.names, self.offsets)}
+
+    def _all(self, fn):
+        return list(self._executor.map(fn, self.meters))
+
+    def read_once(self, flush=True):
+        """
+        :return: length 6 * n_probes ndarray.
+        """
+        return np.concatenate(self._all(lambda m: m.read_once(flush=flush)))
+
+    def read_n_times(self, reps):
+        return np.concatenate(self._all(lambda m: m.read_n_times(reps)))
+
+    def streaming(self):
+        return all(m.streaming() for m in self.meters)
+
+    def samples_after(self, t, n, timeout=5.0):
+        """
+        :return: times when the slowest probe delivered each sample, (n, 6 * n_probes) values.
+        """
+        samples = self._all(lambda m: m.samples_after(t, n, timeout))
+        return np.max([times for times, _ in samples], axis=0), np.hstack([values for _, values in samples])
+
+    def close(self):
+        error = None
+        for m in self.meters:
             try:
-                mags_and_temps = parse_ch330_serial(raw_msg)
-                break
-            except (IndexError, ValueError):
-                log.warn('Invalid message received: %s' % raw_msg)
+                m.close()
+            except Exception as e:
+                error = error or e
+        self._executor.shutdown(wait=False)
+        if error is not None:
+            raise error
 
-    #         pattern = '#([-+]?\d*\.{0,1}\d+)/.*?;([-+]?\d*\.{0,1}\d+)/.*?;([-+]?\d*\.{0,1}\d+)/.*?>'
-    #     msg = re.findall(pattern, raw_msg)
-    #     if len(msg) != 0:
-    #         break
-    #     else:
-    #         log.warn("invalid message received: %s" % str(raw_msg))
-    # msg = msg[0]
 
-    mags_and_temps_array = np.array([float(x) for x in mags_and_temps])
-    mags_and_temps_array[3:] = mags_and_temps_array[3:] / 10
-    if not _mode.CH3600:
-        mags_and_temps_array[0:3] = mags_and_temps_array[0:3] / 1e6
-    if _mode.MOCK:
-        mags_and_temps_array = mags_and_temps_array + np.random.random(6) * 5 - 2.5
-    return mags_and_temps_array
+def probe_data(data, name):
+    """
+    Data of one probe out of a ProbeArray scan, in box_scan layout, positions shifted by the probe's offset.
+    :param data: DataFrame from a scan with a ProbeArray.
+    :param name: probe name.
+    :return: DataFrame that draw functions take.
+    """
+    offset = data.attrs['probes'][name]
+    columns = ['%s_%s' % (column, name) for column in COLUMNS]
+    df = data[['x', 'y', 'z'] + columns].rename(columns=dict(zip(columns, COLUMNS)))
+    df.loc[:, ['x', 'y', 'z']] += offset
+    df.attrs = {key: value for key, value in data.attrs.items() if key in ('lengths', 'step_sizes')}
+    return df
+
+
+# Default instance driven by the module-level functions.
+default = Gaussmeter()
+
+
+def read_once(flush=True):
+    return default.read_once(flush)
 
 
 def read_n_times(reps):
-    values = [read_once()]
-    for i in range(reps-1):
-        values.append(read_once(flush=False))
-    return np.average(values, axis=0)
+    return default.read_n_times(reps)
 
 
 def init(port):
-    if isinstance(port, int):
-        port = "COM%d" % port
-    global serial_port
-    serial_port = serial.Serial(port, 115200, timeout=5)
-    serial_port.write(b'DATA?>')
-    log.log("Gaussmeter port opened at %s" % port)
+    default.init(port)
 
 
 def close():
-    global serial_port
-    serial_port.close()
+    default.close()
+
+
+def start_stream(port=None, capacity=65536):
+    """
+    Starts the default gaussmeter's stream, see Gaussmeter.start_stream.
+    """
+    return default.start_stream(port, capacity)
+
+
+def stop_stream():
+    default.stop_stream()
+
+
+def streaming():
+    return default.streaming()
+
+
+def samples_after(t, n, timeout=5.0):
+    return default.samples_after(t, n, timeout)
+
+
+def samples_window(t0, t1):
+    return default.samples_window(t0, t1)
+
+
+def __getattr__(name):
+    # serial_port and stream used to be module globals.
+    if name in ('serial_port', 'stream'):
+        return getattr(default, name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
@@ -0,0 +1,226 @@
+"""
+Motion completion for the xyz stage: move duration prediction, adaptive polling and per-move timing statistics.
+Knows nothing about the controller itself, so it works the same against the WNMC400 and the simulator.
+"""
+import asyncio
+import math
+import time
+from collections import namedtuple
+import numpy as np
+
+
+# mm/s^2 per unit of the controller "A" (acceleration) parameter. Arbitrary units on the controller side, calibrate
+# against the real stage with motion.stats if predictions are consistently off.
+ACCELERATION_SCALE = 100.0
+MIN_POLL = 0.005
+MAX_POLL = 0.2
+
+
+MoveRecord = namedtuple('MoveRecord', ['predicted', 'travel', 'settle', 'polls'])
+
+
+class MotionStats(object):
+    """
+    Accumulates MoveRecords so a scan can be split into travel and settle time.
+    """
+    def __init__(self):
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+
+    def reset(self):
+        self.records = []
+
+    def summary(self):
+        """
+        :return: dict with number of moves, total travel, settle and predicted time in seconds, total overrun of
+        travel versus prediction and total number of run state polls.
+        """
+        predicted = [r.predicted for r in self.records if r.predicted is not None]
+        overrun = [r.travel - r.predicted for r in self.records if r.predicted is not None]
+        return {'moves': len(self.records),
+                'travel': sum(r.travel for r in self.records),
+                'settle': sum(r.settle for r in self.records),
+                'predicted': sum(predicted),
+                'overrun': sum(overrun),
+                'polls': sum(r.polls for r in self.records)}
+
+
+stats = MotionStats()
+callbacks = []
+
+
+def _as_triplet(value):
+    try:
+        _, _, _ = value
+    except TypeError:
+        value = [value, value, value]
+    return value
+
+
+def trapezoid_time(distance, speed, acceleration):
+    """
+    Duration of a move with a trapezoidal (or triangular, for short moves) velocity profile.
+    :param distance: distance in mm, sign ignored.
+    :param speed: cruise speed in mm/s.
+    :param acceleration: acceleration in controller units, see ACCELERATION_SCALE.
+    :return: duration in seconds.
+    """
+    distance = abs(distance)
+    if distance == 0:
+        return 0.0
+    a = acceleration * ACCELERATION_SCALE
+    if a <= 0:
+        return distance / speed
+    if distance >= speed ** 2 / a:
+        return distance / speed + speed / a
+    return 2 * math.sqrt(distance / a)
+
+
+def trapezoid_distance(t, distance, speed, acceleration):
+    """
+    Distance covered t seconds into a trapezoidal move, inverse of trapezoid_time.
+    :param t: time since start of move in s.
+    :param distance: total distance in mm, sign ignored.
+    :param speed: cruise speed in mm/s.
+    :param acceleration: acceleration in controller units.
+    :return: distance covered in mm, always positive.
+    """
+    distance = abs(distance)
+    total = trapezoid_time(distance, speed, acceleration)
+    if t <= 0:
+        return 0.0
+    if t >= total:
+        return distance
+    a = acceleration * ACCELERATION_SCALE
+    if a <= 0:
+        return speed * t
+    peak = min(speed, math.sqrt(distance * a))
+    t_ramp = peak / a
+    if t < t_ramp:
+        return a * t ** 2 / 2
+    if t < total - t_ramp:
+        return a * t_ramp ** 2 / 2 + peak * (t - t_ramp)
+    return distance - a * (total - t) ** 2 / 2
+
+
+def predict_move_time(start, target, speed=25, acceleration=0.3, coordinated=True):
+    """
+    Predicts duration of a move issued with multi_absolute_move or multi_relative_move.
+    :param start: [x, y, z] in mm.
+    :param target: [x, y, z] in mm.
+    :param speed: same as in motor.multi_absolute_move.
+    :param acceleration: same as in motor.multi_absolute_move.
+    :param coordinated: same as in motor.multi_absolute_move.
+    :return: duration in seconds.
+    """
+    speed = _as_triplet(speed)
+    deltas = [t - s for s, t in zip(start, target)]
+    if coordinated:
+        return trapezoid_time(math.sqrt(sum(d ** 2 for d in deltas)), speed[0], acceleration)
+    return max(trapezoid_time(d, s, acceleration) for d, s in zip(deltas, speed))
+
+
+def move_times(starts, targets, speed=25, acceleration=0.3, coordinated=True):
+    """
+    Vectorized predict_move_time for many moves.
+    :param starts: (n, 3) array of start positions in mm.
+    :param targets: (n, 3) array of targets in mm.
+    :return: length-n array of durations in seconds.
+    """
+    speed = np.asarray(_as_triplet(speed), dtype=float)
+    deltas = np.abs(np.asarray(targets, dtype=float) - np.asarray(starts, dtype=float))
+    if coordinated:
+        deltas = np.sqrt(np.sum(deltas ** 2, axis=1))
+        speed = speed[0]
+    a = acceleration * ACCELERATION_SCALE
+    if a <= 0:
+        times = deltas / speed
+    else:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            times = np.where(deltas >= speed ** 2 / a, deltas / speed + speed / a, 2 * np.sqrt(deltas / a))
+    if not coordinated:
+        times = np.max(times, axis=1)
+    return times
+
+
+def poll_interval(elapsed, predicted=None, min_interval=MIN_POLL, max_interval=MAX_POLL):
+    """
+    Time to sleep before polling run state again. Halves the remaining predicted time so polling gets tight right
+    before the move should end, then backs off in proportion to how late the move is.
+    :param elapsed: time since move was issued.
+    :param predicted: predicted duration of move, None if unknown.
+    :param min_interval: shortest sleep.
+    :param max_interval: longest sleep.
+    :return: time in seconds.
+    """
+    if predicted is None:
+        interval = elapsed / 4
+    elif elapsed < predicted:
+        interval = (predicted - elapsed) / 2
+    else:
+        interval = (elapsed - predicted) / 2
+    return min(max_interval, max(min_interval, interval))
+
+
+def wait_for_stop(is_running, predicted=None, started=None, delay=0.0, callback=None, record_stats=stats,
+                  min_interval=MIN_POLL, max_interval=MAX_POLL, clock=time.monotonic, sleep=time.sleep):
+    """
+    Blocks until is_running() returns False.
+    :param is_running: callable returning True while any axis moves.
+    :param predicted: predicted move duration in seconds, None if unknown.
+    :param started: clock() value when the move was issued, defaults to now.
+    :param delay: further wait after stopping, counted as settle time.
+    :param callback: called with the MoveRecord after the move completes, after module-level callbacks.
+    :param record_stats: MotionStats to add the record to, None to skip.
+    :param min_interval: see poll_interval.
+    :param max_interval: see poll_interval.
+    :param clock: time source.
+    :param sleep: sleep function.
+    :return: MoveRecord
+    """
+    if started is None:
+        started = clock()
+    polls = 0
+    while True:
+        polls += 1
+        if not is_running():
+            break
+        sleep(poll_interval(clock() - started, predicted, min_interval, max_interval))
+    stopped = clock()
+    if delay > 0:
+        sleep(delay)
+    return _finish(MoveRecord(predicted, stopped - started, clock() - stopped, polls), record_stats, callback)
+
+
+async def wait_for_stop_async(is_running, predicted=None, started=None, delay=0.0, callback=None, record_stats=stats,
+                              min_interval=MIN_POLL, max_interval=MAX_POLL, clock=time.monotonic):
+    """
+    wait_for_stop for asyncio, sleeping with asyncio.sleep so other tasks run while the stage moves.
+    :param is_running: coroutine function returning True while any axis moves.
+    See wait_for_stop for the rest.
+    :return: MoveRecord
+    """
+    if started is None:
+        started = clock()
+    polls = 0
+    while True:
+        polls += 1
+        if not await is_running():
+            break
+        await asyncio.sleep(poll_interval(clock() - started, predicted, min_interval, max_interval))
+    stopped = clock()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    return _finish(MoveRecord(predicted, stopped - started, clock() - stopped, polls), record_stats, callback)
+
+
+def _finish(record, record_stats, callback):
+    if record_stats is not None:
+        record_stats.add(record)
+    for fn in callbacks:
+        fn(record)
+    if callback is not None:
+        callback(record)
+    return record
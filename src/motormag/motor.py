@@ -7,46 +7,229 @@ A wrapper module for WNMC400 stepper controller
 """
 
 
-import clr
-import pkg_resources
-clr.AddReference(pkg_resources.resource_filename(__name__, "res/MCC4DLL"))
-# noinspection PyUnresolvedReferences
-from clr import SerialPortLibrary
-import System
+import os
 import time
+import numpy as np
 from . import log
+from . import motion
+from . import trajectory
 from . import _mode
 
 
+# When the last move was issued and how long it should take, consumed by wait().
+_move_started = None
+_move_predicted = None
+# [dx, dy, dz] of the last move, see new_trips.
+_move_direction = None
+# Where the last move sent ends, None if unknown. Saves a position query to predict the next move.
+_last_target = None
+# Read the limit switches while waiting for moves, stopping the stage as soon as one trips.
+watch_limits = True
+# Seconds between limit switch reads in wait(), each one a serial round trip on top of the run state poll. The
+# switches are also read on the first and the last poll of every move. At 25 mm/s the stage covers about 6 mm before
+# a trip is seen, lower for tighter stops or 0 to read on every poll.
+limit_period = 0.25
+
+
+# Limit switch bits of the controller input state.
+INPUT_BITS = {'x_low': 9, 'x_high': 10, 'y_low': 6, 'y_high': 7, 'z_low': 3, 'z_high': 4}
+
+
 def _nth_bit(number, bit):
     return ((number >> bit) & 1) == 1
 
 
 class InputState(object):
     def __init__(self, state):
-        self.x_low = _nth_bit(state, 9)
-        self.x_high = _nth_bit(state, 10)
-        self.y_low = _nth_bit(state, 6)
-        self.y_high = _nth_bit(state, 7)
-        self.z_low = _nth_bit(state, 3)
-        self.z_high = _nth_bit(state, 4)
+        self.x_low = _nth_bit(state, INPUT_BITS['x_low'])
+        self.x_high = _nth_bit(state, INPUT_BITS['x_high'])
+        self.y_low = _nth_bit(state, INPUT_BITS['y_low'])
+        self.y_high = _nth_bit(state, INPUT_BITS['y_high'])
+        self.z_low = _nth_bit(state, INPUT_BITS['z_low'])
+        self.z_high = _nth_bit(state, INPUT_BITS['z_high'])
 
     def any(self):
         return any((self.x_low, self.x_high, self.y_low, self.y_high, self.z_low, self.z_high))
 
+    def tripped(self):
+        return [name for name in INPUT_BITS if getattr(self, name)]
+
+
+class LimitSwitchError(RuntimeError):
+    """
+    Raised when a limit switch trips, after the stage has been stopped. state is the InputState read.
+    """
+    def __init__(self, state):
+        super().__init__('Limit switch tripped: %s' % ', '.join(state.tripped()))
+        self.state = state
+
+
+def new_trips(initial=None, direction=None):
+    """
+    Tracks which limit switches count as newly tripped. A switch already active when tracking starts is ignored until
+    it releases only if the move heads away from it, e.g. backing off the switch it stopped on. Moving towards or
+    along an active switch trips it at once.
+    :param initial: InputState when the move was issued, the first state checked if None.
+    :param direction: [dx, dy, dz] of the move, only the signs count. None ignores every switch active initially, for
+    callers that cannot tell where the stage heads.
+    :return: function taking an InputState and returning the names of switches that newly tripped.
+    """
+    ignored = None if initial is None else _heading_away(initial, direction)
+
+    def check(state):
+        nonlocal ignored
+        active = set(state.tripped())
+        if ignored is None:
+            ignored = _heading_away(state, direction)
+        # Released switches are armed again.
+        ignored &= active
+        return sorted(active - ignored)
+    return check
+
+
+def _heading_away(state, direction):
+    """
+    :return: set of active switches a move in direction leaves, all active ones if direction is None.
+    """
+    active = set(state.tripped())
+    if direction is None:
+        return active
+    away = set()
+    for name in active:
+        d = direction['xyz'.index(name[0])]
+        if (name.endswith('_high') and d < 0) or (name.endswith('_low') and d > 0):
+            away.add(name)
+    return away
+
+
+def guard_limits(is_running, get_input_state, stop, initial=None, direction=None, period=0.0, clock=time.monotonic):
+    """
+    Wraps is_running for motion.wait_for_stop so polls also read the limit switches, see new_trips. With period set,
+    the switches are read on the first poll, then at most every period seconds, and once more when the stage stops.
+    :param is_running: run state function.
+    :param get_input_state: function returning an InputState.
+    :param stop: called when a switch trips, before LimitSwitchError is raised.
+    :param initial: InputState when the move was issued.
+    :param direction: [dx, dy, dz] of the move.
+    :param period: seconds between limit switch reads, 0 for every poll.
+    :param clock: time source.
+    :return: function
+    """
+    check = new_trips(initial, direction)
+    last = [None]
+
+    def guard():
+        last[0] = clock()
+        state = get_input_state()
+        if check(state):
+            stop()
+            error = LimitSwitchError(state)
+            log.fail(str(error))
+            raise error
+
+    def running():
+        if last[0] is None or clock() - last[0] >= period:
+            guard()
+            return is_running()
+        if is_running():
+            return True
+        guard()
+        return False
+    return running
+
+
+class DllController(object):
+    """
+    The WNMC400 through its MCC4DLL, loaded with pythonnet. Controller backends translate the calls of this module
+    into hardware (or simulated) actions, sim.SimulatedController is the other one.
+    """
+    def __init__(self):
+        import clr
+        clr.AddReference(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'res', 'MCC4DLL'))
+        # noinspection PyUnresolvedReferences
+        from clr import SerialPortLibrary
+        import System
+        self.System = System
+        self.port = SerialPortLibrary.SPLibClass()
+
+    def initial(self, port):
+        return self.port.MoCtrCard_Initial(self.System.String(port))
+
+    def unload(self):
+        return self.port.MoCtrCard_Unload()
+
+    def relative_move(self, axis_id, distance):
+        return self.port.MoCtrCard_MCrlAxisRelMove(self.System.Byte(axis_id), self.System.Single(distance))
+
+    def reset_coordinate(self, axis_id, value):
+        return self.port.MoCtrCard_ResetCoordinate(self.System.Byte(axis_id), self.System.Single(value))
+
+    def pause(self):
+        return self.port.MoCtrCard_PauseAxisMov(self.System.Byte(255))
+
+    def quit_motion_control(self):
+        return self.port.MoCtrCard_QuiteMotionControl()
+
+    def stop_axis(self, axis_id):
+        return self.port.MoCtrCard_StopAxisMov(self.System.Byte(axis_id))
+
+    def send_mdi(self, command):
+        return self.port.MoCtrCard_SendMDICommand(self.System.String(command))
+
+    def get_axis_position(self):
+        arr = self.System.Array.CreateInstance(self.System.Single, 4)
+        self.port.MoCtrCard_GetAxisPos(self.System.Byte(255), arr)
+        return [arr[0], arr[1], arr[2]]
+
+    def get_run_state(self):
+        arr = self.System.Array.CreateInstance(self.System.Int32, 1)
+        self.port.MoCtrCard_GetRunState(arr)
+        return arr[0]
+
+    def get_input_state(self):
+        arr = self.System.Array.CreateInstance(self.System.UInt32, 1)
+        self.port.MoCtrCard_GetInputState(self.System.Byte(0), arr)
+        return arr[0]
+
+
+class _Unbound(object):
+    """
+    Stands in for the controller until init or use has run.
+    """
+    def __getattr__(self, name):
+        raise RuntimeError('No motor controller, call motor.init first.')
+
+
+# Backend all functions below go through, set by init or use.
+controller = _Unbound()
+
+
+def use(backend):
+    """
+    Sets the controller backend, e.g. a sim.SimulatedController.
+    :return: None
+    """
+    global controller, _last_target
+    controller = backend
+    _last_target = None
+
 
 def init(port):
     """
-    Opens serial port.
+    Opens serial port. Loads the controller DLL unless a backend was set with use, or a simulated controller in mock
+    mode, see sim.simulate.
     :param port:(int, str), int X means COMX, or str 'COM8'
     :return: status code from dll library
     """
-    if _mode.MOCK:
-        log.log('motor controller serial port opened')
-        return 1
+    if isinstance(controller, _Unbound):
+        if _mode.MOCK:
+            from . import sim
+            sim.simulate()
+        else:
+            use(DllController())
     if isinstance(port, int):
         port = "COM%d" % port
-    result = motor_port.MoCtrCard_Initial(System.String(port))
+    result = controller.initial(port)
     if result == 1:
         log.log("Motor serial port %s opened." % port)
     else:
@@ -59,7 +242,7 @@ def close():
     Closes serial port.
     :return: status code
     """
-    result = motor_port.MoCtrCard_Unload()
+    result = controller.unload()
     if result == 1:
         log.log("Motor serial port closed.")
     else:
@@ -75,7 +258,12 @@ def relative_move_raw(axis_id, distance, block=True):
     :param block: if block until finished.
     :return: status code
     """
-    result = motor_port.MoCtrCard_MCrlAxisRelMove(System.Byte(axis_id), System.Single(distance))
+    global _move_started, _move_predicted, _move_direction, _last_target
+    _move_direction = _along(axis_id, distance)
+    _move_started = time.monotonic()
+    _move_predicted = None
+    result = controller.relative_move(axis_id, distance)
+    _last_target = _shifted(axis_id, distance)
     if block:
         wait()
     return result
@@ -88,10 +276,9 @@ def set_position(axis_id, value):
     :param value: value in mm.
     :return: status code
     """
-    if _mode.MOCK:
-        log.mock('motor controller position cleared.')
-        return 1
-    return motor_port.MoCtrCard_ResetCoordinate(System.Byte(axis_id), System.Single(value))
+    global _last_target
+    _last_target = None
+    return controller.reset_coordinate(axis_id, value)
 
 
 def zero():
@@ -105,11 +292,24 @@ def zero():
 
 
 def pause():
-    return motor_port.MoCtrCard_PauseAxisMov(System.Byte(255))
+    global _last_target
+    _last_target = None
+    return controller.pause()
 
 
 def quit_gcode():
-    return motor_port.MoCtrCard_QuiteMotionControl()
+    global _last_target
+    _last_target = None
+    return controller.quit_motion_control()
+
+
+def halt():
+    """
+    Pauses all axes and quits the running G-code, keeping coordinates valid.
+    :return: None
+    """
+    pause()
+    quit_gcode()
 
 
 def stop():
@@ -118,19 +318,30 @@ def stop():
     !!!INVALIDATES POSITION IF SENT MID-GCODE MOVEMENT!!!
     :return: None
     """
-    motor_port.MoCtrCard_StopAxisMov(System.Byte(0))
-    motor_port.MoCtrCard_StopAxisMov(System.Byte(1))
-    motor_port.MoCtrCard_StopAxisMov(System.Byte(2))
+    global _last_target
+    _last_target = None
+    controller.stop_axis(0)
+    controller.stop_axis(1)
+    controller.stop_axis(2)
     log.warn("Motor controller coordinate invalidated!")
 
 
-def mdi_command(command):
+def mdi_command(command, predicted=None, target=None, direction=None):
     """
     Sends GCode to controller.
     :param command: str, GCode
+    :param predicted: predicted duration of resulting move in seconds, used by wait() to schedule polling.
+    :param target: [x, y, z] the move ends at, None if unknown. Lets the next absolute move skip a position query.
+    :param direction: [dx, dy, dz] of the move, tells wait() which limit switches the stage starts on it may leave,
+    see new_trips. None if unknown.
     :return: status code
     """
-    result = motor_port.MoCtrCard_SendMDICommand(System.String(command))
+    global _move_started, _move_predicted, _move_direction, _last_target
+    _move_direction = direction
+    _move_started = time.monotonic()
+    _move_predicted = predicted
+    _last_target = None if target is None else list(target)
+    result = controller.send_mdi(command)
     if result != 1:
         log.warn("Gcode returned an error.")
     return result
@@ -157,7 +368,8 @@ def single_relative_move(axis_id, distance, speed=25, acceleration=0.3, block=Tr
         raise ValueError('axis not in [0, 1, 2]')
         
     gcode = "G80{ax}{dist}F{ax}{spd}A{ax}{acc}D0".format(ax=axis, dist=distance, spd=speed, acc= acceleration)
-    result = mdi_command(gcode)
+    result = mdi_command(gcode, motion.trapezoid_time(distance, speed, acceleration), _shifted(axis_id, distance),
+                         _along(axis_id, distance))
     if block:
         wait(delay)
     return result
@@ -191,12 +403,14 @@ def multi_relative_move(distance, speed=25, acceleration=0.3, coordinated=True,
         gcode_template = "G80X{d[0]:.1f}FX{s[0]:.1f}AX{a[0]:.1f}Y{d[1]:.1f}FY{s[1]:.1f}AY{a[1]:.1f}Z{d[2]:.1f}FZ{s[2]:.1f}AZ{a[2]:.1f}D0"
     
     gcode = gcode_template.format(d=distance, s=speed, a=acceleration)
-    mdi_command(gcode)
+    target = None if _last_target is None else [p + d for p, d in zip(_last_target, distance)]
+    mdi_command(gcode, motion.predict_move_time([0, 0, 0], distance, speed, acceleration[0], coordinated), target,
+                distance)
     if block:
         wait(delay)
     
 
-def multi_absolute_move(target, speed=25, acceleration=0.3, coordinated=True, block=True, delay=0.0):
+def multi_absolute_move(target, speed=25, acceleration=0.3, coordinated=True, block=True, delay=0.0, start=None):
     """
     See relative version.
     :param target:
@@ -205,11 +419,10 @@ def multi_absolute_move(target, speed=25, acceleration=0.3, coordinated=True, bl
     :param coordinated:
     :param block:
     :param delay:
+    :param start: [x, y, z] the move starts from, for predicting its duration. Defaults to the target of the last
+    move sent, the controller is only asked for the position if that is unknown, e.g. after a pause or set_position.
     :return:
     """
-    if _mode.MOCK:
-        log.mock('Absolute movement to %s initiated' % str(target))
-        return 1
     try:
         _, _, _ = target
     except (TypeError, ValueError, IndexError):
@@ -218,26 +431,132 @@ def multi_absolute_move(target, speed=25, acceleration=0.3, coordinated=True, bl
         _, _, _ = speed
     except TypeError:
         speed = [speed, speed, speed]
-    acceleration = [acceleration, acceleration, acceleration]
-    if coordinated:
-        gcode_template = "G01X{d[0]:.1f}Y{d[1]:.1f}Z{d[2]:.1f}F{s[0]:.1f}A{a[0]:.1f}D0"
-    else:    
-        gcode_template = "G00X{d[0]:.1f}FX{s[0]:.1f}AX{a[0]:.1f}Y{d[1]:.1f}FY{s[1]:.1f}AY{a[1]:.1f}Z{d[2]:.1f}FZ{s[2]:.1f}AZ{a[2]:.1f}D0"
-        
-    gcode = gcode_template.format(d=target, s=speed, a=acceleration)
-    mdi_command(gcode)
+    if start is None:
+        start = get_position() if _last_target is None else _last_target
+    gcode = trajectory.move_gcode(target, speed, acceleration, coordinated)
+    mdi_command(gcode, motion.predict_move_time(start, target, speed, acceleration, coordinated), target,
+                np.subtract(target, start))
     if block:
         wait(delay)
 
 
+def run_trajectory(program, lookahead=None, callback=None, tolerance=0.01):
+    """
+    Runs a trajectory.Trajectory from wherever the stage is. Backends that can queue G-code (send_program, e.g.
+    sim.SimulatedController) get the whole program at once, or with lookahead set, segments are streamed so that no
+    more than lookahead are queued ahead of the predicted position in the program. The controller then paces moves and
+    dwells. Other backends get one move per mdi_command, with dwells slept here.
+    With a queued program, dwell windows are predicted from the schedule and then checked against the position: a
+    window opens once the stage is seen at the segment's target and closes early if it is seen leaving, so it only
+    covers time the stage stood still even if motion.ACCELERATION_SCALE is off. Late arrivals shift the rest of the
+    schedule, and a warning is logged once per run if the timing drifts from the prediction.
+    :param program: trajectory.Trajectory
+    :param lookahead: number of segments to keep queued, None to send everything at once.
+    :param callback: called with (segment index, dwell start, dwell end) in time.monotonic() once each dwell is over,
+    e.g. to pick the samples of a streaming gaussmeter.
+    :param tolerance: distance in mm from a segment's target at which the stage counts as there.
+    :return: (n, 2) array of dwell start and end of every segment in time.monotonic().
+    """
+    global _move_started, _move_predicted, _move_direction, _last_target
+    segments = program.segments
+    windows = np.zeros((len(segments), 2))
+    if not hasattr(controller, 'send_program'):
+        for i, segment in enumerate(segments):
+            multi_absolute_move(segment.target, segment.speed, segment.acceleration, segment.coordinated,
+                                block=True)
+            windows[i, 0] = time.monotonic()
+            time.sleep(segment.dwell)
+            windows[i, 1] = time.monotonic()
+            if callback is not None:
+                callback(i, *windows[i])
+        return windows
+    start = get_position() if _last_target is None else _last_target
+    schedule = program.schedule(start)
+    _last_target = None
+    _move_direction = np.subtract(segments[0].target, start) if len(segments) else None
+    chunk = len(segments) if lookahead is None else max(1, lookahead)
+    started = time.monotonic()
+    # Nothing polls the run state while the program runs, the guard is only there for the switches.
+    guard = limit_guard(lambda: True)
+    sent = 0
+    # Seconds the stage runs behind the schedule, measured at each arrival.
+    lag = 0.0
+    drifted = False
+    for i, segment in enumerate(segments):
+        upto = min(len(segments), i + chunk)
+        if upto > sent:
+            if controller.send_program(program.gcode(sent, upto)) != 1:
+                log.warn("Gcode program returned an error.")
+            sent = upto
+        begin, end = started + lag + schedule[i]
+        _sleep_until(begin, guard)
+        arrived = _await_arrival(segment.target, tolerance, begin, guard, i)
+        late = arrived > begin
+        if late:
+            lag += arrived - begin
+            begin, end = arrived, arrived + segment.dwell
+        left = _watch_dwell(segment.target, tolerance, begin, end, guard)
+        if (late or left < end) and not drifted:
+            log.warn("Segment %d dwell %.3f s off the predicted schedule, check motion.ACCELERATION_SCALE." % (
+                i, max(lag, end - left)))
+            drifted = True
+        windows[i] = begin, left
+        if callback is not None:
+            callback(i, *windows[i])
+    _move_started, _move_predicted = started + lag, schedule[-1, 1] if len(schedule) else 0.0
+    if len(segments):
+        _last_target = list(segments[-1].target)
+    wait()
+    return windows
+
+
+def _at(target, tolerance):
+    return bool(np.all(np.abs(np.subtract(get_position(), target)) <= tolerance))
+
+
+def _sleep_until(moment, guard):
+    while time.monotonic() < moment:
+        guard()
+        time.sleep(max(0.0, min(motion.MAX_POLL, moment - time.monotonic())))
+
+
+def _await_arrival(target, tolerance, predicted, guard, index):
+    """
+    Polls the position from the predicted arrival on until the stage is at target.
+    :return: time.monotonic() it was first seen there, predicted if it already was.
+    """
+    if _at(target, tolerance):
+        return predicted
+    while True:
+        guard()
+        if not is_running():
+            raise RuntimeError('Stage stopped at %s short of trajectory segment %d.' % (get_position(), index))
+        time.sleep(motion.poll_interval(time.monotonic() - predicted, 0.0))
+        if _at(target, tolerance):
+            return time.monotonic()
+
+
+def _watch_dwell(target, tolerance, begin, end, guard):
+    """
+    Checks the stage stays at target until the predicted end of its dwell.
+    :return: end, or the last time.monotonic() it was seen at target if it left before.
+    """
+    seen = begin
+    while seen < end:
+        time.sleep(max(0.0, min(motion.MAX_POLL, end - time.monotonic())))
+        guard()
+        if not _at(target, tolerance):
+            return seen
+        seen = time.monotonic()
+    return end
+
+
 def get_position():
     """
     Gets current [x, y, z].
     :return: [x, y, z] in mm.
     """
-    arr = System.Array.CreateInstance(System.Single, 4)
-    motor_port.MoCtrCard_GetAxisPos(System.Byte(255), arr)
-    return [arr[0], arr[1], arr[2]]
+    return controller.get_axis_position()
 
 
 def is_running():
@@ -245,24 +564,26 @@ def is_running():
     Query if any axis is in movement.
     :return: bool
     """
-    arr = System.Array.CreateInstance(System.Int32, 1)
-    motor_port.MoCtrCard_GetRunState(arr)
-    return arr[0] % 2 == 1
+    return controller.get_run_state() % 2 == 1
 
 
-def wait(delay=0.0):
+def wait(delay=0.0, callback=None):
     """
-    Blocks until all axes stop moving
+    Blocks until all axes stop moving. Polls tightly around the predicted end of the last move and backs off otherwise,
+    timings end up in motion.stats.
     :param delay: further wait after stopping.
-    :return: None
+    :param callback: called with a motion.MoveRecord once stopped.
+    :return: motion.MoveRecord
     """
+    global _move_started, _move_predicted, _move_direction
+    running = limit_guard(is_running)
     try:
-        while True:
-            if is_running():
-                time.sleep(0.2)
-            else:
-                break
-        time.sleep(delay)
+        record = motion.wait_for_stop(running, predicted=_move_predicted, started=_move_started, delay=delay,
+                                      callback=callback)
+        _move_started = None
+        _move_predicted = None
+        _move_direction = None
+        return record
     except KeyboardInterrupt as ki:
         pause()
         quit_gcode()
@@ -270,12 +591,35 @@ def wait(delay=0.0):
 
 
 def get_input_state():
-    if _mode.MOCK:
-        log.mock('Input state checked')
-        return InputState(0)
-    arr = System.Array.CreateInstance(System.UInt32, 1)
-    motor_port.MoCtrCard_GetInputState(System.Byte(0), arr)
-    return InputState(arr[0])
+    return InputState(controller.get_input_state())
+
+
+def limit_guard(is_running):
+    """
+    Wraps a run state function to watch the limit switches during the last move sent, as wait() does, for loops
+    polling the stage themselves. See guard_limits and limit_period.
+    :return: function, is_running itself if watch_limits is off.
+    """
+    if not watch_limits:
+        return is_running
+    return guard_limits(is_running, get_input_state, halt, direction=_move_direction, period=limit_period)
+
+
+def _along(axis_id, distance):
+    direction = [0.0, 0.0, 0.0]
+    direction[axis_id] = distance
+    return direction
+
+
+def _shifted(axis_id, distance):
+    """
+    :return: last target moved by distance along one axis, None if unknown.
+    """
+    if _last_target is None:
+        return None
+    target = list(_last_target)
+    target[axis_id] += distance
+    return target
 
 
 def up(distance, speed=20):
@@ -289,5 +633,3 @@ def left(distance, speed=20):
 def backward(distance, speed=20):
     single_relative_move(2, distance, speed=speed)
 
-
-motor_port = SerialPortLibrary.SPLibClass()
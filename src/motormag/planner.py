@@ -0,0 +1,132 @@
+"""
+Scan path planning: orders scan points to cut travel, and estimates how long a path takes to drive.
+All ordering functions return an index array into the given (n, 3) points.
+"""
+import numpy as np
+
+from . import motion
+
+
+def _ranks(points, order):
+    # Integer lattice position of every point along each axis, slowest axis first.
+    return [np.unique(points[:, 'xyz'.index(ax)], return_inverse=True)[1].reshape(-1) for ax in order]
+
+
+def raster_order(points, order='zxy'):
+    """
+    Same order as sorting the scan DataFrame by [*order]: 1st axis moves the least, the stage flies back to the start
+    of the last axis after each line.
+    :param points: (n, 3) array of x, y, z.
+    :param order: length-3 string of x, y and z.
+    :return: index array.
+    """
+    slow, middle, fast = _ranks(np.asarray(points), order)
+    return np.lexsort([fast, middle, slow])
+
+
+def serpentine_order(points, order='zxy'):
+    """
+    Boustrophedon order: like raster_order, but each line of the last axis runs opposite to the previous one, and so
+    does each plane of the middle axis, so consecutive points are always neighbours.
+    :param points: (n, 3) array of x, y, z.
+    :param order: length-3 string of x, y and z.
+    :return: index array.
+    """
+    slow, middle, fast = _ranks(np.asarray(points), order)
+    n_middle = middle.max(initial=0) + 1
+    n_fast = fast.max(initial=0) + 1
+    middle = np.where(slow % 2 == 0, middle, n_middle - 1 - middle)
+    line = slow * n_middle + middle
+    fast = np.where(line % 2 == 0, fast, n_fast - 1 - fast)
+    return np.lexsort([fast, middle, slow])
+
+
+def nearest_neighbour_order(points, start=(0, 0, 0), speed=25, acceleration=0.3, coordinated=True):
+    """
+    Greedy ordering for arbitrary point sets: always go to the unvisited point with the shortest predicted move.
+    O(n^2), fine for some 10k points.
+    :param points: (n, 3) array of x, y, z.
+    :param start: where the stage is before the first point.
+    :return: index array.
+    """
+    points = np.asarray(points, dtype=float)
+    remaining = np.ones(len(points), dtype=bool)
+    ordering = np.empty(len(points), dtype=int)
+    current = np.asarray(start, dtype=float)
+    for n in range(len(points)):
+        candidates = np.flatnonzero(remaining)
+        times = motion.move_times(np.broadcast_to(current, (len(candidates), 3)), points[candidates], speed,
+                                  acceleration, coordinated)
+        best = candidates[np.argmin(times)]
+        ordering[n] = best
+        remaining[best] = False
+        current = points[best]
+    return ordering
+
+
+def two_opt(points, ordering, start=(0, 0, 0), max_passes=10):
+    """
+    Improves an ordering by reversing sub-paths wherever that shortens total distance (2-opt). Uses distance rather
+    than move time, so the vectorized gain computation stays simple. O(n^2) per pass.
+    :param points: (n, 3) array of x, y, z.
+    :param ordering: index array to start from, e.g. from nearest_neighbour_order.
+    :param start: where the stage is before the first point.
+    :param max_passes: give up after this many passes over all sub-paths.
+    :return: index array.
+    """
+    points = np.asarray(points, dtype=float)
+    ordering = np.asarray(ordering).copy()
+    for _ in range(max_passes):
+        improved = False
+        for i in range(len(ordering) - 1):
+            path = np.vstack([start, points[ordering]])
+            # Path point k is ordering[k - 1]. Reversing ordering[i:j] replaces edges (i, i + 1) and (j, j + 1) by
+            # (i, j) and (i + 1, j + 1), for every j >= i + 2 at once.
+            a, b = path[i], path[i + 1]
+            c, d = path[i + 2:], np.vstack([path[i + 3:], [np.nan] * 3])
+            old = np.linalg.norm(b - a) + np.nan_to_num(np.linalg.norm(d - c, axis=1))
+            new = np.linalg.norm(c - a, axis=1) + np.nan_to_num(np.linalg.norm(d - b, axis=1))
+            gains = old - new
+            if len(gains) and gains.max() > 1e-9:
+                j = i + 2 + int(np.argmax(gains))
+                ordering[i:j] = ordering[i:j][::-1]
+                improved = True
+        if not improved:
+            break
+    return ordering
+
+
+def plan(points, method='serpentine', order='zxy', start=(0, 0, 0), speed=25, acceleration=0.3, coordinated=True):
+    """
+    Orders scan points.
+    :param points: (n, 3) array of x, y, z.
+    :param method: 'raster', 'serpentine', 'nearest' or 'nearest+2opt'.
+    :param order: axis order for raster and serpentine, see scan.box_scan.
+    :param start: stage position before the scan, for the nearest neighbour methods.
+    :return: index array.
+    """
+    if method == 'raster':
+        return raster_order(points, order)
+    elif method == 'serpentine':
+        return serpentine_order(points, order)
+    elif method == 'nearest':
+        return nearest_neighbour_order(points, start, speed, acceleration, coordinated)
+    elif method == 'nearest+2opt':
+        return two_opt(points, nearest_neighbour_order(points, start, speed, acceleration, coordinated), start)
+    else:
+        raise ValueError('Unknown path planning method: %s' % str(method))
+
+
+def estimate_time(points, ordering=None, start=(0, 0, 0), speed=25, acceleration=0.3, coordinated=True):
+    """
+    Predicted travel time for driving through points, from the same model motor.wait uses.
+    :param points: (n, 3) array of x, y, z.
+    :param ordering: index array, points are taken as given if None.
+    :param start: stage position before the first point.
+    :return: time in seconds, settling and measuring not included.
+    """
+    points = np.asarray(points, dtype=float)
+    if ordering is not None:
+        points = points[ordering]
+    path = np.vstack([start, points])
+    return float(np.sum(motion.move_times(path[:-1], path[1:], speed, acceleration, coordinated)))
@@ -0,0 +1,183 @@
+"""
+Batch rendering of 2-D slice plots for reports. A SliceRenderer keeps one figure with its mesh, colorbar and labels,
+and only swaps data, color scale and title between slices of the same plane, instead of building a new figure per
+plot like draw.plot_strength_2d. render_slices writes files for a list of slice specs, optionally spread over a
+process pool with one renderer per process.
+"""
+import os
+from collections import namedtuple
+import numpy as np
+
+from ._mode import cmap
+from .grid import as_grid
+
+
+SliceSpec = namedtuple('SliceSpec', ['cut_axis', 'cut_index', 'field_axis', 'kind'])
+SliceSpec.__new__.__defaults__ = ('xyz', 'strength')
+KINDS = ('strength', 'gradient')
+
+
+class SliceRenderer(object):
+    """
+    Renders slices of one box scan into a single reused figure.
+    """
+    def __init__(self, data, figsize=None, dpi=100, vmin=None, vmax=None, gradient_range=(1e-5, 1e-1), b_zero=None):
+        """
+        :param data: scan DataFrame, grid.FieldGrid or storage.ScanFile.
+        :param figsize: figure size in inches.
+        :param dpi: resolution of saved raster images.
+        :param vmin: strength color scale, per slice if None like draw.plot_strength_2d.
+        :param vmax: see vmin.
+        :param gradient_range: log color scale of gradient plots, see draw.plot_relative_gradient_2d.
+        :param b_zero: reference field of gradient plots, field at the center if None.
+        """
+        from . import draw
+        self.grid = as_grid(data)
+        self.vmin, self.vmax = vmin, vmax
+        self.gradient_range = gradient_range
+        self.b_zero = b_zero
+        self.figure, self.ax = draw._pyplot().subplots(1, figsize=figsize, dpi=dpi)
+        self._artists = None
+        self._layout = None
+        self._contours = None
+
+    def _values(self, spec):
+        """
+        :return: horizontal, vertical coordinate matrices and values of the slice.
+        """
+        grid = self.grid
+        slicer = tuple(spec.cut_index if ax == spec.cut_axis else slice(None) for ax in 'xyz')
+        if spec.kind == 'strength':
+            values = grid.amplitude(spec.field_axis)
+        elif spec.kind == 'gradient':
+            spatial_axes = ''.join(ax for ax, n in zip('xyz', grid.shape) if n > 1)
+            values = np.sqrt(grid.relative_gradient_squared(spec.field_axis, spatial_axes, self.b_zero))
+        else:
+            raise ValueError('Unknown plot kind %s, expected one of %s' % (spec.kind, ', '.join(KINDS)))
+        plane = [ax for ax in 'xyz' if ax != spec.cut_axis]
+        coordinates = grid.coordinates
+        return coordinates[plane[0]][slicer], coordinates[plane[1]][slicer], values[slicer]
+
+    def _norm(self, spec, values):
+        from matplotlib.colors import LogNorm, Normalize
+        if spec.kind == 'gradient':
+            return LogNorm(*self.gradient_range)
+        return Normalize(np.nanmin(values) if self.vmin is None else self.vmin,
+                         np.nanmax(values) if self.vmax is None else self.vmax)
+
+    def render(self, spec):
+        """
+        Draws one slice into the figure. Artists are only rebuilt when the plane or plot kind changes.
+        :param spec: SliceSpec or (cut_axis, cut_index, field_axis, kind) tuple.
+        :return: figure
+        """
+        spec = SliceSpec(*spec)
+        horizontal, vertical, values = self._values(spec)
+        norm = self._norm(spec, values)
+        layout = (spec.cut_axis, spec.kind, values.shape)
+        if layout != self._layout:
+            self.figure.clear()
+            self._contours = None
+            self.ax = self.figure.add_subplot(1, 1, 1)
+            self.ax.axis('equal')
+            mesh = self.ax.pcolormesh(horizontal, vertical, values, shading='auto', norm=norm, cmap=cmap)
+            colorbar = self.figure.colorbar(mesh, ax=self.ax)
+            plane = [ax for ax in 'xyz' if ax != spec.cut_axis]
+            self.ax.set_xlabel('%s/mm' % plane[0])
+            self.ax.set_ylabel('%s/mm' % plane[1])
+            self._artists = mesh, colorbar
+            self._layout = layout
+        else:
+            mesh, colorbar = self._artists
+            mesh.set_array(values)
+            mesh.set_norm(norm)
+            colorbar.update_normal(mesh)
+        if self._contours is not None:
+            # Takes the clabel texts with it.
+            self._contours.remove()
+            self._contours = None
+        position = self.grid.axes['xyz'.index(spec.cut_axis)][spec.cut_index]
+        if spec.kind == 'gradient':
+            self._contours = self.ax.contour(horizontal, vertical, values, [2e-5, 5e-5, 1e-4, 2e-4, 0.0005],
+                                             colors='w', zorder=10)
+            self.ax.clabel(self._contours, fontsize=10, inline=1, fmt='%.0e')
+            self.ax.set_title('B components: %s, cut position: %s=%.1f(i=%d)' % (
+                spec.field_axis, spec.cut_axis, position, spec.cut_index))
+        else:
+            self.ax.set_title('Field: %s, cut position: %s=%.1f(i=%d) in mT' % (
+                spec.field_axis, spec.cut_axis, position, spec.cut_index))
+        return self.figure
+
+    def save(self, spec, path):
+        """
+        Renders a slice and writes it to path, format from the file extension.
+        """
+        self.render(spec).savefig(path)
+        return path
+
+    def close(self):
+        from . import draw
+        draw._pyplot().close(self.figure)
+
+
+def file_name(spec, fmt='png', prefix=''):
+    spec = SliceSpec(*spec)
+    return '%s%s_%s_%s%03d.%s' % (prefix, spec.kind, spec.field_axis, spec.cut_axis, spec.cut_index, fmt)
+
+
+def all_slices(data, cut_axis, field_axis='xyz', kind='strength'):
+    """
+    :return: SliceSpec for every plane of a scan along cut_axis.
+    """
+    n = as_grid(data).shape['xyz'.index(cut_axis)]
+    return [SliceSpec(cut_axis, i, field_axis, kind) for i in range(n)]
+
+
+_worker = None
+
+
+def _start_worker(grid, options):
+    global _worker
+    import matplotlib
+    matplotlib.use('Agg')
+    _worker = SliceRenderer(grid, **options)
+
+
+def _render_chunk(jobs):
+    return [_worker.save(spec, path) for spec, path in jobs]
+
+
+def render_slices(data, specs, directory, fmt='png', prefix='', processes=1, **options):
+    """
+    Writes one image per slice spec.
+    :param data: scan DataFrame, grid.FieldGrid or storage.ScanFile.
+    :param specs: list of SliceSpec or (cut_axis, cut_index, field_axis, kind) tuples, kind 'strength' or 'gradient'.
+    :param directory: output directory, created if needed.
+    :param fmt: 'png', 'svg' or anything else savefig knows.
+    :param prefix: file name prefix, see file_name.
+    :param processes: number of worker processes, 1 to render here.
+    :param options: passed on to SliceRenderer.
+    :return: list of file paths in spec order.
+    """
+    grid = as_grid(data)
+    os.makedirs(directory, exist_ok=True)
+    specs = [SliceSpec(*spec) for spec in specs]
+    paths = [os.path.join(directory, file_name(spec, fmt, prefix)) for spec in specs]
+    # Slices of the same plane and kind next to each other, so artists get reused.
+    order = sorted(range(len(specs)), key=lambda i: (specs[i].cut_axis, specs[i].kind, specs[i].cut_index))
+    jobs = [(specs[i], paths[i]) for i in order]
+    if processes == 1 or len(jobs) <= 1:
+        renderer = SliceRenderer(grid, **options)
+        try:
+            for spec, path in jobs:
+                renderer.save(spec, path)
+        finally:
+            renderer.close()
+        return paths
+    from concurrent.futures import ProcessPoolExecutor
+    processes = min(processes or os.cpu_count() or 1, len(jobs))
+    # Contiguous chunks keep each worker on few planes.
+    chunks = [list(chunk) for chunk in np.array_split(np.arange(len(jobs)), processes)]
+    with ProcessPoolExecutor(processes, initializer=_start_worker, initargs=(grid, options)) as pool:
+        list(pool.map(_render_chunk, [[jobs[i] for i in chunk] for chunk in chunks]))
+    return paths
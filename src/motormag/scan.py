@@ -1,13 +1,53 @@
+import os
+import pickle
+import queue
+import threading
+import time
+from . import envelope
 from . import log
 from . import motor
 from . import mag
+from . import motion
+from . import planner
+from . import storage
+from . import interp
 import numpy as np
 import pandas as pd
 
 
 class BoxScan(object):
+    """
+    Box scan with moves pipelined against bookkeeping: the next move is issued as soon as readings for the current
+    point are in, and DataFrame writes and logging happen on a worker thread while the stage travels.
+    stage and meter default to the motor and mag modules, anything with the same functions (e.g. sim.SimulatedStage,
+    sim.SimulatedMeter) can be used instead. If the meter is streaming (mag.start_stream), readings are the first
+    n_discards + n_reps samples received time_wait after the stage stopped, of which the first n_discards are dropped.
+    With settle_tolerance or target_error given, the number of readings per point adapts instead, see settle.
+    With a mag.ProbeArray as meter, every probe gets its own set of columns, see mag.probe_data.
+    With storage given, every point and its raw readings are appended to a scan file as soon as measured.
+    After a run, timings holds the seconds spent in travel, settle, read, bookkeeping and logging, the last two on the
+    worker thread and so overlapping with the others.
+    """
     def __init__(self, x_range, y_range, z_range, x_steps=None, y_steps=None, z_steps=None, step_size=5, order='zxy',
-             time_wait=0.5, n_discards=0, n_reps=3):
+                 time_wait=0.5, n_discards=0, n_reps=3, speed=25, acceleration=0.3, path='serpentine',
+                 test_corners=True, storage=None, checkpoint=None, checkpoint_interval=30.0, settle_tolerance=None,
+                 target_error=None, min_reads=2, max_reads=20, stage=None, meter=None, observer=None):
+        """
+        :param settle_tolerance: probe counts as settled once two successive readings agree within this many mT.
+        Replaces n_discards.
+        :param target_error: read until the standard error of the average is below this many mT. Replaces n_reps.
+        :param min_reads: fewest readings averaged per point with settle_tolerance or target_error.
+        :param max_reads: most readings taken per point, discarded ones included.
+        :param storage: file name or storage.ScanWriter to write points to during the scan, None to keep in memory
+        only. Needs h5py.
+        :param checkpoint: file name to save progress to, see resume.
+        :param checkpoint_interval: seconds between checkpoints, one is also written when the scan ends or fails.
+        :param test_corners: trace the edges of the scan volume at scan speed before scanning, see
+        envelope.trace_perimeter. The planned path is always checked against the machine envelope, see envelope.
+        :param observer: called on the bookkeeping thread with (row in box_scan order, averaged readings) of every
+        point, e.g. live.LiveView.push. Must be quick.
+        See box_scan for the rest.
+        """
         self.x_range = x_range
         self.y_range = y_range
         self.z_range = z_range
@@ -19,11 +59,706 @@ class BoxScan(object):
         self.time_wait = time_wait
         self.n_discards=n_discards
         self.n_reps = n_reps
+        self.speed = speed
+        self.acceleration = acceleration
+        self.path = path
+        self.test_corners = test_corners
+        self.storage = storage
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.settle_tolerance = settle_tolerance
+        self.target_error = target_error
+        if not max_reads >= min_reads >= 1:
+            raise ValueError('Need max_reads >= min_reads >= 1, got min_reads=%s, max_reads=%s' % (min_reads,
+                                                                                                   max_reads))
+        self.min_reads = min_reads
+        self.max_reads = max_reads
+        self.stage = motor if stage is None else stage
+        self.meter = mag if meter is None else meter
+        self.observer = observer
+
+        self.data = None
+        self.points_done = 0
+        self.elapsed = 0.0
+        self._first_point = 0
+        self._resume_state = None
+        self.timings = _timings()
+
+    @property
+    def throughput(self):
+        """
+        :return: measured points per minute of the last run.
+        """
+        if self.elapsed == 0:
+            return 0.0
+        return (self.points_done - self._first_point) / self.elapsed * 60
+
+    @property
+    def settings(self):
+        """
+        :return: dict of scan parameters, stored with the data.
+        """
+        return {'x_range': self.x_range, 'y_range': self.y_range, 'z_range': self.z_range, 'x_steps': self.x_steps,
+                'y_steps': self.y_steps, 'z_steps': self.z_steps, 'step_size': self.step_size, 'order': self.order,
+                'time_wait': self.time_wait, 'n_discards': self.n_discards, 'n_reps': self.n_reps,
+                'speed': self.speed, 'acceleration': self.acceleration, 'path': self.path,
+                'settle_tolerance': self.settle_tolerance, 'target_error': self.target_error,
+                'min_reads': self.min_reads, 'max_reads': self.max_reads}
+
+    def _readings(self, settled):
+        """
+        Yields timestamp, reading one at a time for as long as asked.
+        """
+        if self.meter.streaming():
+            n = 0
+            while True:
+                n += 1
+                times, values = self.meter.samples_after(settled, n)
+                yield times[-1], values[-1]
+        flush = True
+        while True:
+            value = self.meter.read_once(flush=flush)
+            flush = False
+            yield time.monotonic(), value
+
+    def _measure(self, settled):
+        """
+        :param settled: time.monotonic() from which on the probe is considered settled.
+        :return: timestamps and (n, 6 * probes) individual readings to average, total number of readings taken.
+        """
+        if self.settle_tolerance is not None or self.target_error is not None:
+            return settle(self._readings(settled), self.settle_tolerance, self.target_error, self.min_reads,
+                          self.max_reads)
+        if self.meter.streaming():
+            times, values = self.meter.samples_after(settled, self.n_discards + self.n_reps)
+            return times[self.n_discards:], values[self.n_discards:], self.n_discards + self.n_reps
+        for _ in range(self.n_discards):
+            self.meter.read_once()
+        times, values = [], []
+        for i in range(self.n_reps):
+            values.append(self.meter.read_once(flush=(i == 0)))
+            times.append(time.monotonic())
+        return np.asarray(times), np.asarray(values), self.n_discards + self.n_reps
+
+    def _count_move(self, record):
+        self.timings['travel'] += record.travel
+        self.timings['settle'] += record.settle
+
+    def _wait_and_measure(self):
+        """
+        Waits for the stage to stop and takes the readings of the current point, see _measure. Adds to timings.
+        """
+        if self.meter.streaming():
+            # No sleeping, settling is done by only taking samples stamped after the settle time.
+            self.stage.wait(callback=self._count_move)
+            settled = time.monotonic() + self.time_wait
+        else:
+            self.stage.wait(self.time_wait, callback=self._count_move)
+            settled = time.monotonic()
+        started = time.monotonic()
+        result = self._measure(settled)
+        self.timings['settle'] += max(0.0, settled - started)
+        self.timings['read'] += time.monotonic() - max(started, settled)
+        return result
+
+    @property
+    def columns(self):
+        """
+        :return: reading columns of the meter, per probe for a mag.ProbeArray.
+        """
+        return list(getattr(self.meter, 'columns', mag.COLUMNS))
+
+    def _open_storage(self, metadata):
+        if self.storage is None or hasattr(self.storage, 'append'):
+            return self.storage
+        return storage.ScanWriter(self.storage, metadata, ['x', 'y', 'z'] + self.columns + ['reads', 'std_error'],
+                                  raw_width=len(self.columns))
+
+    def run(self):
+        """
+        Does the scan, see box_scan for parameters.
+        :return: pd.DataFrame containing data, also kept as self.data.
+        """
+        state = self._resume_state
+        if state is None and not all(np.abs(np.array(self.stage.get_position())) < 0.1):
+            raise RuntimeError('Motor stage not at zero - manually drive to zero before scanning.')
+        if not _order_sanity(self.order):
+            raise ValueError('Got invalid scan order: %s' % str(self.order))
+        x_points = range_to_points(self.x_range, self.x_steps, self.step_size)
+        y_points = range_to_points(self.y_range, self.y_steps, self.step_size)
+        z_points = range_to_points(self.z_range, self.z_steps, self.step_size)
+        columns = self.columns
+        names = ['x', 'y', 'z'] + columns + ['reads', 'std_error']
+        if state is None:
+            # Un-flattening xm, ym and zm by shape (x_steps, y_steps, z_steps) returns them to the matrix form.
+            xm, ym, zm = np.meshgrid(x_points, y_points, z_points, indexing='ij')
+            positions = np.vstack([xm.ravel(), ym.ravel(), zm.ravel()]).T
+            # Motor movement order: y-axis should move the most and z the least.
+            start = self.stage.get_position()
+            ordering = planner.plan(positions, self.path, self.order, start, self.speed, self.acceleration)
+            log.log('Planned %s path over %d points, estimated travel time %.1f s.' % (
+                self.path, len(ordering), planner.estimate_time(positions, ordering, start, self.speed,
+                                                                self.acceleration)))
+            # One row per point in path order, rows[nth] is written once point nth is measured.
+            indices = np.asarray(ordering)
+            rows = np.zeros((len(indices), len(names)))
+            rows[:, :3] = positions[indices]
+            rows[:, -1] = np.nan
+            first = 0
+        else:
+            indices = state['data'].index.to_numpy()
+            rows = state['data'].loc[:, names].to_numpy(dtype=float)
+            first = state['done']
+            log.log('Resuming box scan at point %d/%d.' % (first + 1, len(indices)))
+        targets = rows[:, :3].copy()
+        total_points = len(indices)
+        if first >= total_points:
+            # Checkpoint of a scan that ran to the end, nothing to drive to.
+            log.log('Box scan already complete, %d/%d points in checkpoint.' % (first, total_points))
+            self.points_done = self._first_point = first
+            return self._result(rows, indices, names, [x_points, y_points, z_points])
+        position = self.stage.get_position()
+        if state is not None:
+            # Stage stopped either at the last measured point or at the point it was measuring.
+            _check_resume_position(position, targets[max(0, first - 1):first + 1])
+        envelope.check_path(np.vstack([targets[first:], [0, 0, 0]]), position)
+        if state is None and self.test_corners:
+            envelope.trace_perimeter(x_points, y_points, z_points, self.speed, self.acceleration, self.stage)
+        lengths = [len(x_points), len(y_points), len(z_points)]
+        step_sizes = [_get_step_size(x_points), _get_step_size(y_points), _get_step_size(z_points)]
+        metadata = {'lengths': lengths, 'step_sizes': step_sizes, 'settings': self.settings}
+        if hasattr(self.meter, 'probes'):
+            metadata['probes'] = self.meter.probes
+        writer = self._open_storage(metadata)
+        stored = None if writer is None else [names.index(c) for c in writer.columns]
+        results = queue.Queue()
+        worker_errors = []
+        completed = [first]
+        last_checkpoint = [time.monotonic()]
+        width = len(columns)
+
+        def bookkeeping():
+            # rows belongs to this thread during the scan, the main thread only reads targets.
+            while True:
+                item = results.get()
+                if item is None:
+                    return
+                if worker_errors:
+                    continue
+                nth, i, times, values, reads = item
+                try:
+                    started = time.monotonic()
+                    row = rows[nth]
+                    row[3:3 + width] = np.average(values, axis=0)
+                    row[3 + width:] = reads, standard_error(values)
+                    if writer is not None:
+                        writer.append(i, row[stored], values, times)
+                    if self.observer is not None:
+                        self.observer(i, row[3:3 + width])
+                    logged = time.monotonic()
+                    log.progress(nth + 1, total_points, 'field at %.2f, %.2f, %.2f: %.2fmT, %.2fmT, %.2fmT',
+                                 *row[:6].tolist())
+                    self.timings['logging'] += time.monotonic() - logged
+                    completed[0] = nth + 1
+                    if self.checkpoint is not None and \
+                            time.monotonic() - last_checkpoint[0] > self.checkpoint_interval:
+                        self._write_checkpoint(_frame(rows, indices, names), completed[0])
+                        last_checkpoint[0] = time.monotonic()
+                    self.timings['bookkeeping'] += logged - started
+                except Exception as e:
+                    worker_errors.append(e)
+
+        worker = threading.Thread(target=bookkeeping, daemon=True)
+        worker.start()
+        log.log('Starting box scan.')
+        self.points_done = self._first_point = first
+        self.timings = _timings()
+        start = time.monotonic()
+        try:
+            self.stage.multi_absolute_move(targets[first], speed=self.speed, acceleration=self.acceleration,
+                                           block=False)
+            for nth in range(first, total_points):
+                if worker_errors:
+                    break
+                times, values, reads = self._wait_and_measure()
+                if nth + 1 < total_points:
+                    self.stage.multi_absolute_move(targets[nth + 1], speed=self.speed, acceleration=self.acceleration,
+                                                   block=False)
+                results.put((nth, indices[nth], times, values, reads))
+                self.points_done = nth + 1
+                self.elapsed = time.monotonic() - start
+        finally:
+            results.put(None)
+            worker.join()
+            if writer is not None and writer is not self.storage:
+                writer.close()
+            if self.checkpoint is not None:
+                self._write_checkpoint(_frame(rows, indices, names), completed[0])
+                if completed[0] < total_points:
+                    log.warn('Scan interrupted after %d/%d points, resume with BoxScan.resume(%r).' % (
+                        completed[0], total_points, self.checkpoint))
+        if worker_errors:
+            raise worker_errors[0]
+        log.log('Box scan finished: %d points in %.1f s, %.1f points/min.' % (self.points_done - first, self.elapsed,
+                                                                             self.throughput))
+        self.stage.multi_absolute_move([0, 0, 0])
+        return self._result(rows, indices, names, [x_points, y_points, z_points])
+
+    def _result(self, rows, indices, names, axes):
+        """
+        :return: scan DataFrame in box_scan order with its attrs, also kept as self.data.
+        """
+        df = _frame(rows, indices, names)
+        df.sort_index(inplace=True)
+        df.attrs['lengths'] = [len(a) for a in axes]
+        df.attrs['step_sizes'] = [_get_step_size(a) for a in axes]
+        if hasattr(self.meter, 'probes'):
+            df.attrs['probes'] = self.meter.probes
+        self.data = df
+        self._resume_state = None
+        return df
+
+    def _write_checkpoint(self, df, done):
+        """
+        Atomically replaces the checkpoint file with the scan state after done points (in path order).
+        :param df: scan DataFrame in path order.
+        """
+        state = {'version': 1, 'settings': self.settings, 'data': df, 'done': done}
+        temporary = self.checkpoint + '.tmp'
+        with open(temporary, 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(temporary, self.checkpoint)
+
+    @classmethod
+    def resume(cls, checkpoint, storage=None, stage=None, meter=None):
+        """
+        Continues an interrupted scan from its checkpoint file, in the same path order, skipping points already
+        measured. The stage has to be either where the scan stopped or re-homed at zero. Call run() on the result, which
+        for the checkpoint of a finished scan returns its data without moving.
+        :param checkpoint: checkpoint file written by a scan with checkpoint set.
+        :param storage: see __init__, pass the same file as before to keep appending to it.
+        :param stage: see __init__.
+        :param meter: see __init__.
+        :return: BoxScan
+        """
+        with open(checkpoint, 'rb') as f:
+            state = pickle.load(f)
+        box = cls(**state['settings'], test_corners=False, checkpoint=checkpoint, storage=storage, stage=stage,
+                  meter=meter)
+        box._resume_state = state
+        return box
+
+
+class FlyScan(object):
+    """
+    On-the-fly scan: the stage sweeps each line of the fast axis (last in order) at constant speed with G01 while the
+    gaussmeter streams, and every sample gets the position interpolated from a timestamped track of get_position()
+    calls made while waiting for the sweep to finish. Lines alternate direction.
+    The meter has to be streaming, see mag.start_stream.
+    """
+    def __init__(self, x_range, y_range, z_range, x_steps=None, y_steps=None, z_steps=None, step_size=5, order='zxy',
+                 fly_speed=5, speed=25, acceleration=0.3, track_period=0.02, regrid=True, stage=None, meter=None):
+        """
+        :param fly_speed: sweep speed along the fast axis in mm/s.
+        :param speed: speed of moves between lines.
+        :param acceleration: used for all moves. Sweeps start and end a run-up distance outside the scanned range so
+        the stage is at fly_speed all the way through it.
+        :param track_period: seconds between get_position() calls during a sweep.
+        :param regrid: interpolate samples onto the same grid box_scan would measure, otherwise return all samples.
+        See BoxScan for the rest.
+        """
+        self.x_range = x_range
+        self.y_range = y_range
+        self.z_range = z_range
+        self.x_steps = x_steps
+        self.y_steps = y_steps
+        self.z_steps = z_steps
+        self.step_size = step_size
+        self.order = order
+        self.fly_speed = fly_speed
+        self.speed = speed
+        self.acceleration = acceleration
+        self.track_period = track_period
+        self.regrid = regrid
+        self.stage = motor if stage is None else stage
+        self.meter = mag if meter is None else meter
 
         self.data = None
+        self.samples = 0
+        self.elapsed = 0.0
+
+    def _sweep(self, begin, end):
+        """
+        Drives from begin to end at fly_speed, tracking position.
+        :return: (n, 4) array of timestamp, x, y, z; sweep start and end time.
+        """
+        self.stage.multi_absolute_move(begin, speed=self.speed, acceleration=self.acceleration)
+        track = []
+        t0 = time.monotonic()
+        self.stage.multi_absolute_move(end, speed=self.fly_speed, acceleration=self.acceleration, block=False)
+        # Watches the limit switches like stage.wait would.
+        running = self.stage.limit_guard(self.stage.is_running)
+
+        def tracking_is_running():
+            before = time.monotonic()
+            position = self.stage.get_position()
+            track.append([(before + time.monotonic()) / 2, *position])
+            return running()
+
+        try:
+            motion.wait_for_stop(tracking_is_running, started=t0, min_interval=self.track_period,
+                                 max_interval=self.track_period)
+        except KeyboardInterrupt as ki:
+            self.stage.pause()
+            self.stage.quit_gcode()
+            raise ki
+        return np.asarray(track), t0, time.monotonic()
 
     def run(self):
-        pass
+        """
+        Does the scan.
+        :return: pd.DataFrame with the same columns as box_scan, also kept as self.data.
+        """
+        if not all(np.abs(np.array(self.stage.get_position())) < 0.1):
+            raise RuntimeError('Motor stage not at zero - manually drive to zero before scanning.')
+        if not _order_sanity(self.order):
+            raise ValueError('Got invalid scan order: %s' % str(self.order))
+        if not self.meter.streaming():
+            raise RuntimeError('Fly scan needs a streaming gaussmeter, call mag.start_stream first.')
+        if hasattr(self.meter, 'columns'):
+            raise ValueError('Fly scan works with a single probe only.')
+        axis_points = {'x': range_to_points(self.x_range, self.x_steps, self.step_size),
+                       'y': range_to_points(self.y_range, self.y_steps, self.step_size),
+                       'z': range_to_points(self.z_range, self.z_steps, self.step_size)}
+        slow, middle, fast = self.order
+        fast_id = 'xyz'.index(fast)
+        fast_points = axis_points[fast]
+        lo, hi = fast_points.min(), fast_points.max()
+        run_up = 1.1 * self.fly_speed ** 2 / (2 * self.acceleration * motion.ACCELERATION_SCALE)
+        low = [axis_points[ax].min() - (run_up if ax == fast else 0) for ax in 'xyz']
+        high = [axis_points[ax].max() + (run_up if ax == fast else 0) for ax in 'xyz']
+        envelope.check_box(low, high)
+        grid = np.zeros([len(axis_points['x']), len(axis_points['y']), len(axis_points['z']), 6])
+        raw = []
+        log.log('Starting fly scan.')
+        start = time.monotonic()
+        self.samples = 0
+        line = 0
+        for i, slow_value in enumerate(axis_points[slow]):
+            middle_indices = range(len(axis_points[middle]))
+            for j in (middle_indices if i % 2 == 0 else reversed(middle_indices)):
+                position = {slow: slow_value, middle: axis_points[middle][j]}
+                begin, end = (lo - run_up, hi + run_up) if line % 2 == 0 else (hi + run_up, lo - run_up)
+                track, t0, t1 = self._sweep([position.get(ax, begin) for ax in 'xyz'],
+                                            [position.get(ax, end) for ax in 'xyz'])
+                times, values = self.meter.samples_window(t0, t1)
+                positions = np.vstack([np.interp(times, track[:, 0], track[:, k + 1]) for k in range(3)]).T
+                inside = (positions[:, fast_id] >= lo) & (positions[:, fast_id] <= hi)
+                positions, values = positions[inside], values[inside]
+                raw.append(np.hstack([positions, values]))
+                self.samples += len(values)
+                log.log('Line %d: %d samples at %s=%.2f, %s=%.2f.' % (line + 1, len(values), slow, slow_value,
+                                                                       middle, axis_points[middle][j]))
+                if self.regrid:
+                    if len(values) < 2:
+                        raise RuntimeError('Too few samples in line %d to regrid, lower fly_speed.' % (line + 1))
+                    sorting = np.argsort(positions[:, fast_id])
+                    regridded = np.vstack([np.interp(fast_points, positions[sorting, fast_id], values[sorting, k])
+                                           for k in range(6)]).T
+                    slicer = {slow: i, middle: j, fast: slice(None)}
+                    grid[tuple(slicer[ax] for ax in 'xyz')] = regridded
+                line += 1
+        self.elapsed = time.monotonic() - start
+        log.log('Fly scan finished: %d samples in %.1f s.' % (self.samples, self.elapsed))
+        self.stage.multi_absolute_move([0, 0, 0], speed=self.speed, acceleration=self.acceleration)
+        columns = ['x', 'y', 'z', 'mag_x', 'mag_y', 'mag_z', 'temp_x', 'temp_y', 'temp_z']
+        if not self.regrid:
+            self.data = pd.DataFrame(np.vstack(raw), columns=columns)
+            return self.data
+        xm, ym, zm = np.meshgrid(axis_points['x'], axis_points['y'], axis_points['z'], indexing='ij')
+        data = np.vstack([xm.flatten(), ym.flatten(), zm.flatten(), grid.reshape(-1, 6).T]).T
+        df = pd.DataFrame(data, columns=columns)
+        df.attrs['lengths'] = [len(axis_points[ax]) for ax in 'xyz']
+        df.attrs['step_sizes'] = [_get_step_size(axis_points[ax]) for ax in 'xyz']
+        self.data = df
+        return df
+
+
+class AdaptiveScan(BoxScan):
+    """
+    Box scan that only measures the full step_size grid where the field needs it. A coarse pass measures every
+    2 ** levels-th point of the box_scan grid, then cells of the measured grid whose estimated linear interpolation
+    error exceeds tolerance are subdivided and their midpoints measured, halving the spacing each pass until
+    step_size, the point budget or the error target is reached.
+    The error of a cell is estimated from how much the field gradient changes at its corners, |d(dB/dd)| * h_d / 8
+    with the gradient taken over one cell, which is the linear interpolation error at the cell centre for a field
+    with constant curvature. Cells next to a steep edge are refined too, so edges falling inside a coarse cell are
+    not missed.
+    """
+    def __init__(self, x_range, y_range, z_range, x_steps=None, y_steps=None, z_steps=None, step_size=5, order='zxy',
+                 levels=3, tolerance=0.05, max_points=None, time_wait=0.5, n_discards=0, n_reps=3, speed=25,
+                 acceleration=0.3, path='serpentine', test_corners=True, settle_tolerance=None, target_error=None,
+                 min_reads=2, max_reads=20, stage=None, meter=None):
+        """
+        :param levels: number of halvings between coarse and finest spacing, coarse step is step_size * 2 ** levels.
+        :param tolerance: largest accepted interpolation error estimate of a cell in mT.
+        :param max_points: point budget, no limit if None. Coarse pass is always measured in full.
+        See BoxScan for the rest, path is used for the coarse pass only, refinement points are visited nearest first.
+        """
+        super().__init__(x_range, y_range, z_range, x_steps, y_steps, z_steps, step_size, order, time_wait,
+                         n_discards, n_reps, speed, acceleration, path, test_corners, settle_tolerance=settle_tolerance,
+                         target_error=target_error, min_reads=min_reads, max_reads=max_reads, stage=stage, meter=meter)
+        self.levels = levels
+        self.tolerance = tolerance
+        self.max_points = max_points
+        self.measured = None
+
+    @property
+    def settings(self):
+        return dict(super().settings, levels=self.levels, tolerance=self.tolerance, max_points=self.max_points)
+
+    @classmethod
+    def resume(cls, checkpoint, storage=None, stage=None, meter=None):
+        """
+        Not supported, adaptive scans write no checkpoints.
+        """
+        raise NotImplementedError('Adaptive scans cannot be resumed from a checkpoint.')
+
+    def _measure_points(self, axes, nodes):
+        """
+        Drives to and measures the given grid nodes, moves pipelined like BoxScan.run.
+        :param axes: [x_points, y_points, z_points] of the finest grid.
+        :param nodes: (n, 3) index array into axes.
+        :return: (n, 8) averaged readings, number of readings and standard error.
+        """
+        targets = np.vstack([axes[k][nodes[:, k]] for k in range(3)]).T
+        ordering = planner.plan(targets, self.path if self.points_done == 0 else 'nearest', self.order,
+                                self.stage.get_position(), self.speed, self.acceleration)
+        values = np.zeros((len(nodes), 8))
+        self.stage.multi_absolute_move(targets[ordering[0]], speed=self.speed, acceleration=self.acceleration,
+                                       block=False)
+        for nth, i in enumerate(ordering):
+            _, readings, reads = self._wait_and_measure()
+            if nth + 1 < len(ordering):
+                self.stage.multi_absolute_move(targets[ordering[nth + 1]], speed=self.speed,
+                                               acceleration=self.acceleration, block=False)
+            values[i] = np.concatenate([np.average(readings, axis=0), [reads, standard_error(readings)]])
+            self.points_done += 1
+        return values
+
+    def run(self):
+        """
+        Does the scan.
+        :return: pd.DataFrame of the full step_size grid in box_scan layout, with an extra 'level' column holding the
+        pass each point was measured in (0 for the coarse pass) or -1 for points filled in by interpolation. Only the
+        measured points are kept as self.measured.
+        """
+        if not all(np.abs(np.array(self.stage.get_position())) < 0.1):
+            raise RuntimeError('Motor stage not at zero - manually drive to zero before scanning.')
+        if not _order_sanity(self.order):
+            raise ValueError('Got invalid scan order: %s' % str(self.order))
+        if len(self.columns) != 6:
+            raise ValueError('Adaptive scan works with a single probe only.')
+        axes = [range_to_points(self.x_range, self.x_steps, self.step_size),
+                range_to_points(self.y_range, self.y_steps, self.step_size),
+                range_to_points(self.z_range, self.z_steps, self.step_size)]
+        envelope.check_box([min(a) for a in axes], [max(a) for a in axes])
+        if self.test_corners:
+            envelope.trace_perimeter(*axes, self.speed, self.acceleration, self.stage)
+        shape = tuple(len(a) for a in axes)
+        values = np.full(shape + (8,), np.nan)
+        level = np.full(shape, -1)
+        stride = 2 ** self.levels
+        nodes = _lattice_nodes([_stride_indices(n, stride) for n in shape])
+        log.log('Starting adaptive scan: %d coarse points, %d in full grid.' % (len(nodes), level.size))
+        self.points_done = 0
+        self.timings = _timings()
+        start = time.monotonic()
+        values[tuple(nodes.T)] = self._measure_points(axes, nodes)
+        level[tuple(nodes.T)] = 0
+        filled = _fill_stride(axes, values, level, stride)
+        n = 0
+        while stride > 1:
+            errors = _cell_errors(filled[0], filled[1], level[np.ix_(*filled[0])] >= 0)
+            flagged = np.argwhere(errors > self.tolerance)
+            log.log('Pass %d: largest error estimate %.3g mT, %d cells above tolerance.' % (
+                n, np.max(errors, initial=0), len(flagged)))
+            if len(flagged) == 0:
+                break
+            flagged = flagged[np.argsort(errors[tuple(flagged.T)])[::-1]]
+            nodes = _refinement_nodes(filled[0], flagged, shape, stride // 2, level,
+                                      None if self.max_points is None else self.max_points - self.points_done)
+            if len(nodes) == 0:
+                log.warn('Point budget of %d reached.' % self.max_points)
+                break
+            n += 1
+            stride //= 2
+            values[tuple(nodes.T)] = self._measure_points(axes, nodes)
+            level[tuple(nodes.T)] = n
+            filled = _fill_stride(axes, values, level, stride, filled)
+        while stride > 1:
+            stride //= 2
+            filled = _fill_stride(axes, values, level, stride, filled)
+        self.elapsed = time.monotonic() - start
+        log.log('Adaptive scan finished: %d of %d points measured in %.1f s.' % (self.points_done, level.size,
+                                                                                self.elapsed))
+        self.stage.multi_absolute_move([0, 0, 0])
+        xm, ym, zm = np.meshgrid(*axes, indexing='ij')
+        data = np.vstack([xm.flatten(), ym.flatten(), zm.flatten(), filled[1][..., :6].reshape(-1, 6).T]).T
+        df = pd.DataFrame(data, columns=['x', 'y', 'z', 'mag_x', 'mag_y', 'mag_z', 'temp_x', 'temp_y', 'temp_z'])
+        df['reads'] = np.where(level >= 0, values[..., 6], 0).flatten().astype(int)
+        df['std_error'] = values[..., 7].flatten()
+        df['level'] = level.flatten()
+        df.attrs['lengths'] = list(shape)
+        df.attrs['step_sizes'] = [_get_step_size(a) for a in axes]
+        self.measured = df[df.level >= 0]
+        self.data = df
+        return df
+
+
+def _stride_indices(n, stride):
+    """
+    :return: every stride-th index of a length-n axis, last index always included.
+    """
+    return np.union1d(np.arange(0, n, stride), [n - 1])
+
+
+def _lattice_nodes(indices):
+    return np.vstack([m.ravel() for m in np.meshgrid(*indices, indexing='ij')]).T
+
+
+def _fill_stride(axes, values, level, stride, coarser=None):
+    """
+    Readings on the every-stride-th-point grid, unmeasured nodes interpolated from the next coarser grid.
+    :return: (per-axis node indices, (nx, ny, nz, 6) filled values).
+    """
+    indices = [_stride_indices(len(a), stride) for a in axes]
+    filled = values[np.ix_(*indices)].copy()
+    missing = level[np.ix_(*indices)] < 0
+    if coarser is not None and np.any(missing):
+        coarse_indices, coarse_values = coarser
+        coords = _lattice_nodes([a[i] for a, i in zip(axes, coarse_indices)])
+        positions = np.vstack([a[i][np.argwhere(missing)[:, k]] for k, (a, i) in enumerate(zip(axes, indices))]).T
+        filled[missing] = interp.interpolate(coords, coarse_values.reshape(-1, coarse_values.shape[-1]), positions)
+    return indices, filled
+
+
+def _cell_errors(indices, filled, measured):
+    """
+    Interpolation error estimate of every cell of a filled grid, see AdaptiveScan. Cells with unmeasured corners get 0.
+    :return: array of cells, indexed by lower corner node, size 1 along fixed axes.
+    """
+    free = [k for k, i in enumerate(indices) if len(i) > 1]
+    field = filled[..., :3]
+    # Change of the per-cell gradient at each node, largest over field components and directions.
+    nodes = np.zeros(field.shape[:3])
+    for d in free:
+        jump = np.max(np.abs(np.diff(field, n=2, axis=d)), axis=-1) / 8
+        padding = [(0, 0)] * 3
+        padding[d] = (1, 1)
+        nodes = np.maximum(nodes, np.pad(jump, padding))
+    errors, complete = nodes, measured
+    for k in free:
+        errors = np.maximum(np.take(errors, range(len(indices[k]) - 1), axis=k),
+                            np.take(errors, range(1, len(indices[k])), axis=k))
+        complete = np.minimum(np.take(complete, range(len(indices[k]) - 1), axis=k),
+                              np.take(complete, range(1, len(indices[k])), axis=k))
+    errors[~complete.astype(bool)] = 0
+    return errors
+
+
+def _refinement_nodes(indices, cells, shape, stride, level, budget=None):
+    """
+    Unmeasured nodes of the every-stride-th-point grid inside the given cells.
+    :param indices: per-axis node indices of the cells' grid.
+    :param cells: (n, 3) lower corners of cells to refine, most important first.
+    :param budget: most nodes to return, whole cells only.
+    :return: (m, 3) node index array.
+    """
+    finer = [_stride_indices(n, stride) for n in shape]
+    scheduled = level >= 0
+    nodes = []
+    for cell in cells:
+        ranges = []
+        for k in range(3):
+            if len(indices[k]) == 1:
+                ranges.append(finer[k])
+            else:
+                lo, hi = indices[k][cell[k]], indices[k][cell[k] + 1]
+                ranges.append(finer[k][(finer[k] >= lo) & (finer[k] <= hi)])
+        new = _lattice_nodes(ranges)
+        new = new[~scheduled[tuple(new.T)]]
+        if budget is not None and sum(len(n) for n in nodes) + len(new) > budget:
+            break
+        scheduled[tuple(new.T)] = True
+        nodes.append(new)
+    return np.vstack(nodes) if nodes else np.zeros((0, 3), dtype=int)
+
+
+def _frame(rows, indices, names):
+    """
+    :return: DataFrame of a copy of rows with index indices, the reads column as integers.
+    """
+    df = pd.DataFrame(rows, index=indices, columns=names, copy=True)
+    df['reads'] = df['reads'].astype(int)
+    return df
+
+
+def _timings():
+    return {'travel': 0.0, 'settle': 0.0, 'read': 0.0, 'bookkeeping': 0.0, 'logging': 0.0}
+
+
+def _fields(values):
+    """
+    Field columns of (..., 6 * probes) readings, temperatures dropped.
+    """
+    values = np.asarray(values, dtype=float)
+    return values[..., np.arange(values.shape[-1]) % 6 < 3]
+
+
+def standard_error(values):
+    """
+    :param values: (n, 6) individual readings, or (n, 6 * probes) of a mag.ProbeArray.
+    :return: largest standard error of the averaged field components in mT, NaN for a single reading.
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) < 2:
+        return np.nan
+    return float(np.max(np.std(_fields(values), axis=0, ddof=1)) / np.sqrt(len(values)))
+
+
+def settle(readings, tolerance=None, target_error=None, min_reads=2, max_reads=20):
+    """
+    Takes readings until the probe has settled and the average is good enough, instead of a fixed number of discards
+    and repetitions. Readings are discarded until two successive ones agree within tolerance, then taken until there
+    are min_reads and the standard error is below target_error. Gives up after max_reads in total, averaging what
+    it has.
+    :param readings: iterator of (timestamp, (6,) reading).
+    :param tolerance: largest field difference in mT between successive settled readings, None to skip settling.
+    :param target_error: standard error of the average to reach in mT, None to stop at min_reads.
+    :param min_reads: fewest readings to average.
+    :param max_reads: most readings to take, discarded ones included.
+    :return: timestamps and (n, 6) readings to average, total number of readings taken.
+    """
+    taken = 0
+    used = []
+    if tolerance is not None:
+        previous = None
+        while taken < max_reads:
+            current = next(readings)
+            taken += 1
+            if previous is not None and np.max(np.abs(_fields(current[1]) - _fields(previous[1]))) <= tolerance:
+                used = [previous, current]
+                break
+            previous = current
+        else:
+            used = [previous]
+    while taken < max_reads:
+        if len(used) >= min_reads and (target_error is None or standard_error([v for _, v in used]) <= target_error):
+            break
+        used.append(next(readings))
+        taken += 1
+    return np.asarray([t for t, _ in used]), np.asarray([v for _, v in used]), taken
 
 
 def range_to_points(range_def, steps=None, step_size=5):
@@ -65,34 +800,25 @@ def _get_step_size(points):
     try:
         return points[1] - points[0]
     except IndexError:
-        return np.NaN
+        return np.nan
 
 
-def _test_corners(x_points, y_points, z_points, speed=10):
+def _check_resume_position(position, last_targets, tolerance=0.1):
     """
-    Drives the motor stage to all 8 corners of the scan before actually scanning to avoid crashing with no one around.
-    :param x_points: a list of all x axis points to be scanned.
-    :param y_points: see x
-    :param z_points: see x
-    :param speed: speed to do the test
-    :return: None. Ctrl + C to abort.
+    Resuming is only safe if the controller's coordinates are still valid: the stage is either where the interrupted
+    scan left it, or has been re-homed to zero.
     """
-    x_min, x_max = min(x_points), max(x_points)
-    y_min, y_max = min(y_points), max(y_points)
-    z_min, z_max = min(z_points), max(z_points)
-    log.log('Driving to 8 corners of test volume.')
-    motor.multi_absolute_move([x_min, y_min, z_min], speed=speed)
-    motor.multi_absolute_move([x_max, y_min, z_min], speed=speed)
-    motor.multi_absolute_move([x_max, y_max, z_min], speed=speed)
-    motor.multi_absolute_move([x_max, y_min, z_min], speed=speed)
-    motor.multi_absolute_move([x_min, y_min, z_max], speed=speed)
-    motor.multi_absolute_move([x_max, y_min, z_max], speed=speed)
-    motor.multi_absolute_move([x_max, y_max, z_max], speed=speed)
-    motor.multi_absolute_move([x_max, y_min, z_max], speed=speed)
+    position = np.asarray(position, dtype=float)
+    candidates = np.vstack([np.zeros((1, 3)), np.asarray(last_targets, dtype=float).reshape(-1, 3)])
+    if np.any(np.all(np.abs(candidates - position) < tolerance, axis=1)):
+        return
+    raise RuntimeError('Motor stage at %s, neither where the scan stopped nor at zero - re-home before resuming.'
+                       % str(position))
 
 
 def box_scan(x_range, y_range, z_range, x_steps=None, y_steps=None, z_steps=None, step_size=5, order='zxy',
-             n_discards=1, n_reps=3):
+             n_discards=1, n_reps=3, path='serpentine', storage=None, checkpoint=None, settle_tolerance=None,
+             target_error=None, min_reads=2, max_reads=20):
     """
     Does a scan in a cubic volume.
     :param x_range: [start, end] or single value. Give a single value if the axis is not to be scanned.
@@ -106,34 +832,57 @@ def box_scan(x_range, y_range, z_range, x_steps=None, y_steps=None, z_steps=None
     the heaviest.
     :param n_discards: Drop first n mag field readings to give the probe time to settle.
     :param n_reps: Number of readings to take and average over.
+    :param path: point ordering, 'serpentine', 'raster', 'nearest' or 'nearest+2opt', see planner.plan.
+    :param storage: file name to append each point to while scanning, see storage.ScanWriter. Needs h5py.
+    :param checkpoint: file name to save progress to, an interrupted scan continues with resume_scan(checkpoint).
+    :param settle_tolerance: discard readings until two successive ones agree within this many mT instead of a fixed
+    n_discards, see settle.
+    :param target_error: average readings until the standard error is below this many mT instead of a fixed n_reps.
+    :param min_reads: fewest readings averaged when settle_tolerance or target_error is given.
+    :param max_reads: most readings per point when settle_tolerance or target_error is given.
+    :return: pd.DataFrame containing data, with the number of readings taken and the standard error of every point
+    in columns reads and std_error.
+    """
+    return BoxScan(x_range, y_range, z_range, x_steps, y_steps, z_steps, step_size, order, time_wait=0.0,
+                   n_discards=n_discards, n_reps=n_reps, path=path, storage=storage, checkpoint=checkpoint,
+                   settle_tolerance=settle_tolerance, target_error=target_error, min_reads=min_reads,
+                   max_reads=max_reads).run()
+
+
+def resume_scan(checkpoint, storage=None):
+    """
+    Continues an interrupted box_scan. Stage has to be where the scan stopped, or re-homed to zero.
+    :param checkpoint: checkpoint file given to box_scan.
+    :param storage: scan file given to box_scan, points are appended to it.
     :return: pd.DataFrame containing data.
     """
-    if not all(np.abs(np.array(motor.get_position())) < 0.1):
-        raise RuntimeError('Motor stage not at zero - manually drive to zero before scanning.')
-    if not _order_sanity(order):
-        raise ValueError('Got invalid scan order: %s' % str(order))
-    x_points = range_to_points(x_range, x_steps, step_size)
-    y_points = range_to_points(y_range, y_steps, step_size)
-    z_points = range_to_points(z_range, z_steps, step_size)
-    _test_corners(x_points, y_points, z_points)
-    # Un-flattening xm, ym and zm by shape (x_steps, y_steps, z_steps) returns them to the matrix form.
-    xm, ym, zm = np.meshgrid(x_points, y_points, z_points, indexing='ij')
-    data = np.vstack([xm.flatten(), ym.flatten(), zm.flatten(), np.zeros([6, len(xm.flatten())])]).T
-    df = pd.DataFrame(data, columns=['x', 'y', 'z', 'mag_x', 'mag_y', 'mag_z', 'temp_x', 'temp_y', 'temp_z'])
-    # Motor movement order sorting: y-axis should move the most and z the least.
-    df.sort_values([*order], inplace=True)
-    log.log('Starting box scan.')
-    total_points = len(df.index)
-    for nth, i in enumerate(df.index):
-        x, y, z = df.loc[i, ['x', 'y', 'z']]
-        motor.multi_absolute_move([x, y, z])
-        for _ in range(n_discards):
-            mag.read_once()
-        df.loc[i, ['mag_x', 'mag_y', 'mag_z', 'temp_x', 'temp_y', 'temp_z']] = mag.read_n_times(n_reps)
-        log.log('%d/%d, field at %.2f, %.2f, %.2f: %.2fmT, %.2fmT, %.2fmT' % (nth + 1, total_points, x, y, z,
-                                                                              *df.loc[i, ['mag_x', 'mag_y', 'mag_z']]))
-    motor.multi_absolute_move([0, 0, 0])
-    df.sort_index(inplace=True)
-    df.attrs['lengths'] = [len(x_points), len(y_points), len(z_points)]
-    df.attrs['step_sizes'] = [_get_step_size(x_points), _get_step_size(y_points), _get_step_size(z_points)]
-    return df
+    return BoxScan.resume(checkpoint, storage=storage).run()
+
+
+def adaptive_scan(x_range, y_range, z_range, x_steps=None, y_steps=None, z_steps=None, step_size=5, order='zxy',
+                  levels=3, tolerance=0.05, max_points=None, n_discards=1, n_reps=3):
+    """
+    Scans a cubic volume coarsely, then refines where the field is not resolved, see AdaptiveScan.
+    :param levels: coarse step is step_size * 2 ** levels.
+    :param tolerance: interpolation error target in mT.
+    :param max_points: point budget, no limit if None.
+    See box_scan for the rest.
+    :return: pd.DataFrame of the full grid with a 'level' column, -1 where values were interpolated.
+    """
+    return AdaptiveScan(x_range, y_range, z_range, x_steps, y_steps, z_steps, step_size, order, levels=levels,
+                        tolerance=tolerance, max_points=max_points, time_wait=0.0, n_discards=n_discards,
+                        n_reps=n_reps).run()
+
+
+def fly_scan(x_range, y_range, z_range, x_steps=None, y_steps=None, z_steps=None, step_size=5, order='zxy',
+             fly_speed=5, regrid=True):
+    """
+    Scans a cubic volume with continuous sweeps along the last axis in order, see FlyScan. Gaussmeter has to be
+    streaming, see mag.start_stream.
+    :param fly_speed: sweep speed in mm/s, at most step size times the meter's output rate to get a sample per step.
+    :param regrid: return values on the same grid box_scan would, otherwise every sample with its position.
+    See box_scan for the rest.
+    :return: pd.DataFrame containing data.
+    """
+    return FlyScan(x_range, y_range, z_range, x_steps, y_steps, z_steps, step_size, order, fly_speed=fly_speed,
+                   regrid=regrid).run()
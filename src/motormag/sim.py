@@ -0,0 +1,604 @@
+"""
+Simulated hardware for testing scans without the WNMC400 and the gaussmeter: a stage moving along trapezoidal
+velocity profiles with a ringing carriage after each stop, a controller backend understanding the G-code the motor
+module sends, gaussmeters with noise and analytic fields of dipoles and coils.
+simulate() runs the motor and mag modules themselves against the simulation, which is what mock mode does.
+"""
+import re
+import threading
+import time
+from collections import deque
+import numpy as np
+
+from . import log
+from . import motion
+from . import motor
+from . import _mode
+
+MU_0 = 4e-7 * np.pi
+# Finished moves SimulatedStage keeps for position_at lookups of past timestamps.
+HISTORY = 1000
+
+
+class SimulatedStage(object):
+    """
+    xyz stage whose position evolves in real time along trapezoidal velocity profiles.
+    Offers the same move/wait functions as the motor module, so it can stand in for it.
+    """
+    def __init__(self, position=(0.0, 0.0, 0.0), clock=time.monotonic, limits=None, ringing=None):
+        """
+        :param position: starting [x, y, z] in mm.
+        :param clock: time source.
+        :param limits: ([x, y, z] low, [x, y, z] high) limit switch positions in mm, no switches if None.
+        :param ringing: (amplitude in mm, decay time in s, frequency in Hz) of the probe swinging along the direction
+        of the last move after the stage stops. Not seen by get_position, only by meters. None for a rigid carriage.
+        """
+        self.clock = clock
+        self.limits = limits
+        self.ringing = ringing
+        self._start = np.asarray(position, dtype=float)
+        self._target = self._start.copy()
+        self._t0 = clock()
+        self._speed = [25, 25, 25]
+        self._acceleration = 0.3
+        self._coordinated = True
+        self._duration = 0.0
+        # Queued program: dwell after the current move, then (target, speed, acceleration, coordinated, dwell) moves.
+        self._dwell = 0.0
+        self._queue = []
+        self._lock = threading.RLock()
+        # Limit switch state and [dx, dy, dz] of the last move when it started, see motor.new_trips.
+        self._move_inputs = None
+        self._move_direction = None
+        # Earlier moves as (start, target, speed, acceleration, coordinated, t0, duration), oldest first.
+        self._history = deque(maxlen=HISTORY)
+
+    def move_to(self, target, speed=25, acceleration=0.3, coordinated=True):
+        """
+        Starts moving towards target from wherever the stage currently is, dropping any queued moves.
+        :return: predicted duration in seconds.
+        """
+        now = self.clock()
+        with self._lock:
+            start = self.position_at(now)
+            self._move_inputs = self.get_input_state() if self.limits is not None else None
+            self._move_direction = np.subtract(target, start)
+            self._queue = []
+            self._dwell = 0.0
+            return self._begin(start, target, speed, acceleration, coordinated, now)
+
+    def _begin(self, start, target, speed, acceleration, coordinated, t0):
+        self._history.append(self._segment())
+        # Copies, history entries must not change with the current move.
+        self._start = np.array(start, dtype=float)
+        self._target = np.array(target, dtype=float)
+        self._speed = motion._as_triplet(speed)
+        self._acceleration = acceleration
+        self._coordinated = coordinated
+        self._duration = motion.predict_move_time(self._start, self._target, speed, acceleration, coordinated)
+        self._t0 = t0
+        return self._duration
+
+    def _segment(self):
+        return (self._start, self._target, self._speed, self._acceleration, self._coordinated, self._t0,
+                self._duration)
+
+    def _segment_at(self, timestamp):
+        """
+        :return: the move under way (or last finished) at timestamp, see _segment.
+        """
+        self._advance(timestamp)
+        with self._lock:
+            segment = self._segment()
+            if timestamp >= segment[5]:
+                return segment
+            for segment in reversed(self._history):
+                if timestamp >= segment[5]:
+                    return segment
+        # Older than the history, the stage was standing where the oldest known move started.
+        return segment[0], segment[0], segment[2], segment[3], segment[4], timestamp, 0.0
+
+    def _advance(self, now):
+        """
+        Starts queued moves whose turn has come by now, each right after the previous one and its dwell.
+        """
+        with self._lock:
+            while self._queue and now >= self._t0 + self._duration + self._dwell:
+                target, speed, acceleration, coordinated, dwell = self._queue.pop(0)
+                end = self._t0 + self._duration + self._dwell
+                self._begin(self._target, target, speed, acceleration, coordinated, end)
+                self._dwell = dwell
+
+    def queue_moves(self, moves):
+        """
+        Appends moves to run back to back after the current one, like a G-code program on the controller.
+        :param moves: list of (target, speed, acceleration, coordinated, dwell after the move in s).
+        """
+        now = self.clock()
+        if not self.is_running():
+            # Idle, the program starts now rather than when the last move ended.
+            with self._lock:
+                self._move_inputs = self.get_input_state() if self.limits is not None else None
+                self._move_direction = np.subtract(moves[0][0], self._target) if moves else None
+                self._begin(self._target, self._target, self._speed, self._acceleration, self._coordinated, now)
+                self._dwell = 0.0
+        with self._lock:
+            self._queue.extend(moves)
+        self._advance(now)
+
+    def end_position(self):
+        """
+        :return: [x, y, z] the stage ends up at once all queued moves are done.
+        """
+        with self._lock:
+            return list(self._queue[-1][0] if self._queue else self._target)
+
+    def get_position(self):
+        """
+        :return: [x, y, z] in mm.
+        """
+        return self.position_at(self.clock())
+
+    def position_at(self, timestamp):
+        """
+        Position at a clock() value. Timestamps before the current move, queued program moves included, are looked
+        up in the last HISTORY moves, so samples stamped before a move switch get where the stage was then.
+        :return: [x, y, z] in mm.
+        """
+        start, target, speed, acceleration, coordinated, t0, _ = self._segment_at(timestamp)
+        t = timestamp - t0
+        delta = target - start
+        if coordinated:
+            length = np.sqrt(np.sum(delta ** 2))
+            if length == 0:
+                return list(target)
+            covered = motion.trapezoid_distance(t, length, speed[0], acceleration)
+            return list(start + delta * covered / length)
+        covered = [motion.trapezoid_distance(t, d, v, acceleration) for d, v in zip(delta, speed)]
+        return list(start + np.sign(delta) * covered)
+
+    def probe_position_at(self, timestamp):
+        """
+        Where a probe on the carriage actually is: position_at plus ringing after a stop.
+        :return: [x, y, z] in mm.
+        """
+        position = np.asarray(self.position_at(timestamp))
+        start, target, _, _, _, t0, duration = self._segment_at(timestamp)
+        t = timestamp - t0 - duration
+        if self.ringing is None or t < 0:
+            return list(position)
+        amplitude, decay, frequency = self.ringing
+        delta = target - start
+        length = np.sqrt(np.sum(delta ** 2))
+        if length == 0:
+            return list(position)
+        swing = amplitude * np.exp(-t / decay) * np.sin(2 * np.pi * frequency * t)
+        return list(position + delta / length * swing)
+
+    def is_running(self):
+        now = self.clock()
+        self._advance(now)
+        return now - self._t0 < self._duration + self._dwell
+
+    def set_position(self, axis_id, value):
+        """
+        Overrides the coordinate of one axis without moving, like motor.set_position.
+        """
+        shift = value - self.get_position()[axis_id]
+        self._start[axis_id] += shift
+        self._target[axis_id] += shift
+        return 1
+
+    def input_bits(self):
+        """
+        :return: raw controller input state, switches are hit when at or beyond limits.
+        """
+        if self.limits is None:
+            return 0
+        position = np.asarray(self.get_position())
+        bits = 0
+        for i, ax in enumerate('xyz'):
+            if position[i] <= self.limits[0][i]:
+                bits |= 1 << motor.INPUT_BITS[ax + '_low']
+            if position[i] >= self.limits[1][i]:
+                bits |= 1 << motor.INPUT_BITS[ax + '_high']
+        return bits
+
+    def get_input_state(self):
+        """
+        :return: motor.InputState
+        """
+        return motor.InputState(self.input_bits())
+
+    def pause(self):
+        """
+        Stops dead wherever the stage is, dropping any queued moves.
+        """
+        now = self.clock()
+        with self._lock:
+            position = np.asarray(self.position_at(now), dtype=float)
+            self._queue = []
+            self._dwell = 0.0
+            self._begin(position, position, self._speed, self._acceleration, self._coordinated, now)
+        return 1
+
+    def quit_gcode(self):
+        return 1
+
+    def multi_absolute_move(self, target, speed=25, acceleration=0.3, coordinated=True, block=True, delay=0.0):
+        self.move_to(target, speed, acceleration, coordinated)
+        if block:
+            self.wait(delay)
+        return 1
+
+    def limit_guard(self, is_running):
+        """
+        See motor.limit_guard, switches are read on every poll.
+        """
+        if self.limits is None:
+            return is_running
+        return motor.guard_limits(is_running, self.get_input_state, self.pause, self._move_inputs,
+                                  self._move_direction)
+
+    def wait(self, delay=0.0, callback=None):
+        """
+        See motor.wait, limit switches are watched if the stage has any.
+        """
+        return motion.wait_for_stop(self.limit_guard(self.is_running), predicted=self._duration, started=self._t0, delay=delay,
+                                    callback=callback, clock=self.clock)
+
+
+class SimulatedMeter(object):
+    """
+    Gaussmeter reading a field function at the current position of a simulated stage.
+    Offers the same read functions as the mag module, so it can stand in for it.
+    """
+    def __init__(self, stage, field=None, noise=0.0, period=0.0, temperature=25.0, offset=(0.0, 0.0, 0.0), name=None):
+        """
+        :param stage: something with get_position(), usually a SimulatedStage.
+        :param field: callable taking [x, y, z] in mm, returning [bx, by, bz] in mT. Zero field if None.
+        :param noise: standard deviation of gaussian noise added to each component, mT.
+        :param period: seconds per reading, the meter's output rate.
+        :param temperature: reported probe temperature.
+        :param offset: [x, y, z] of the probe relative to the stage position, see mag.Gaussmeter.
+        :param name: probe name, see mag.ProbeArray.
+        """
+        self.stage = stage
+        self.offset = np.asarray(offset, dtype=float)
+        self.name = name
+        self.field = field
+        self.noise = noise
+        self.period = period
+        self.temperature = temperature
+
+    def read_once(self, flush=True):
+        if self.period > 0:
+            time.sleep(self.period)
+        if hasattr(self.stage, 'probe_position_at'):
+            position = np.asarray(self.stage.probe_position_at(self.stage.clock())) + self.offset
+        else:
+            position = np.asarray(self.stage.get_position()) + self.offset
+        field = np.zeros(3) if self.field is None else np.asarray(self.field(position), dtype=float)
+        if self.noise > 0:
+            field = field + np.random.normal(0, self.noise, 3)
+        return np.concatenate([field, [self.temperature] * 3])
+
+    def read_n_times(self, reps):
+        values = [self.read_once()]
+        for i in range(reps - 1):
+            values.append(self.read_once(flush=False))
+        return np.average(values, axis=0)
+
+    def streaming(self):
+        return False
+
+    def close(self):
+        pass
+
+
+def format_ch3600(mags, temps):
+    return '#%+011.4f/000/%+05d;%+011.4f/000/%+05d;%+011.4f/000/%+05d>\r\n' % (
+        mags[0], temps[0] * 10, mags[1], temps[1] * 10, mags[2], temps[2] * 10)
+
+
+def format_ch330(mags):
+    return '#%.1f/%.1f/%.1f>\r\n' % (mags[0] * 1e6, mags[1] * 1e6, mags[2] * 1e6)
+
+
+class SimulatedSerial(object):
+    """
+    Serial port of a gaussmeter in continuous output mode, measuring the field at a simulated stage's position.
+    Frames are generated on demand for every sample period that has passed, so nothing runs in the background.
+    """
+    def __init__(self, stage, field=None, noise=0.0, period=0.01, temperature=25.0, ch3600=None, timeout=5.0):
+        """
+        :param stage: something with get_position(), position_at(t) is used if available.
+        :param field: see SimulatedMeter.
+        :param noise: see SimulatedMeter.
+        :param period: seconds between frames.
+        :param temperature: reported probe temperature.
+        :param ch3600: frame format, defaults to _mode.CH3600 at construction.
+        :param timeout: read timeout in seconds, as in serial.Serial.
+        """
+        self.stage = stage
+        self.field = field
+        self.noise = noise
+        self.period = period
+        self.temperature = temperature
+        self.ch3600 = _mode.CH3600 if ch3600 is None else ch3600
+        self.timeout = timeout
+        self.is_open = True
+        self._next = time.monotonic()
+        self._pending = b''
+
+    def _position(self, timestamp):
+        if hasattr(self.stage, 'probe_position_at'):
+            return self.stage.probe_position_at(timestamp)
+        if hasattr(self.stage, 'position_at'):
+            return self.stage.position_at(timestamp)
+        return self.stage.get_position()
+
+    def _generate(self):
+        now = time.monotonic()
+        frames = []
+        while self._next <= now:
+            position = self._position(self._next)
+            field = np.zeros(3) if self.field is None else np.asarray(self.field(position), dtype=float)
+            if self.noise > 0:
+                field = field + np.random.normal(0, self.noise, 3)
+            if self.ch3600:
+                frames.append(format_ch3600(field, [self.temperature] * 3))
+            else:
+                frames.append(format_ch330(field))
+            self._next += self.period
+        if frames:
+            self._pending += ''.join(frames).encode(encoding='ascii')
+
+    @property
+    def in_waiting(self):
+        self._generate()
+        return len(self._pending)
+
+    def read(self, size=1):
+        deadline = time.monotonic() + self.timeout
+        self._generate()
+        while len(self._pending) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(max(0.0, min(self._next - time.monotonic(), remaining)))
+            self._generate()
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def read_until(self, expected=b'\n'):
+        data = b''
+        while not data.endswith(expected):
+            chunk = self.read(1)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def read_all(self):
+        return self.read(self.in_waiting)
+
+    def write(self, data):
+        return len(data)
+
+    def close(self):
+        self.is_open = False
+
+
+_GCODE = re.compile(r'^G(\d\d)((?:[A-Z]{1,2}[-+]?\d*\.?\d+)*)$')
+_DWELL = re.compile(r'^G04P(\d*\.?\d+)$')
+_GCODE_WORD = re.compile(r'([A-Z]{1,2})([-+]?\d*\.?\d+)')
+
+
+def parse_gcode(command, position):
+    """
+    Turns a move the motor module sends (G00, G01 absolute, G80, G81 relative; G01 and G81 coordinated) into a target.
+    :param command: G-code string.
+    :param position: current [x, y, z].
+    :return: target [x, y, z], speed [x, y, z], acceleration, coordinated.
+    """
+    match = _GCODE.match(command.replace(' ', '').upper())
+    if match is None or match.group(1) not in ('00', '01', '80', '81'):
+        raise ValueError('Unsupported G-code: %s' % command)
+    code = match.group(1)
+    words = dict(_GCODE_WORD.findall(match.group(2)))
+    relative = code in ('80', '81')
+    coordinated = code in ('01', '81')
+    target = list(position)
+    speed = [25.0, 25.0, 25.0]
+    accelerations = []
+    for i, ax in enumerate('XYZ'):
+        if ax in words:
+            target[i] = float(words[ax]) + (position[i] if relative else 0.0)
+        if not coordinated:
+            speed[i] = float(words.get('F' + ax, speed[i]))
+            if 'A' + ax in words:
+                accelerations.append(float(words['A' + ax]))
+    if coordinated:
+        speed = [float(words.get('F', 25.0))] * 3
+        accelerations.append(float(words.get('A', 0.3)))
+    return target, speed, min(accelerations) if accelerations else 0.3, coordinated
+
+
+class SimulatedController(object):
+    """
+    Controller backend for the motor module (see motor.use) driving a SimulatedStage, at the level of the DLL calls:
+    G-code moves are parsed and executed with the stage's motion model.
+    """
+    def __init__(self, stage=None):
+        self.stage = SimulatedStage() if stage is None else stage
+
+    def initial(self, port):
+        log.mock('Simulated controller opened on %s.' % port)
+        return 1
+
+    def unload(self):
+        return 1
+
+    def relative_move(self, axis_id, distance):
+        target = self.stage.get_position()
+        target[axis_id] += distance
+        self.stage.move_to(target, coordinated=False)
+        return 1
+
+    def reset_coordinate(self, axis_id, value):
+        return self.stage.set_position(axis_id, value)
+
+    def pause(self):
+        return self.stage.pause()
+
+    def quit_motion_control(self):
+        return 1
+
+    def stop_axis(self, axis_id):
+        return self.stage.pause()
+
+    def send_mdi(self, command):
+        log.mock('G-code: %s' % command)
+        try:
+            target, speed, acceleration, coordinated = parse_gcode(command, self.stage.get_position())
+        except ValueError as e:
+            log.warn(str(e))
+            return 0
+        self.stage.move_to(target, speed, acceleration, coordinated)
+        return 1
+
+    def send_program(self, lines):
+        """
+        Queues G-code lines, moves and G04 dwells, to run back to back after whatever is queued already.
+        :return: 1 on success, 0 if a line is not understood, in which case nothing is queued.
+        """
+        moves = []
+        position = self.stage.end_position()
+        for line in lines:
+            log.mock('G-code: %s' % line)
+            dwell = _DWELL.match(line.replace(' ', '').upper())
+            try:
+                if dwell is not None:
+                    if not moves:
+                        moves.append([position, [25.0] * 3, 0.3, True, 0.0])
+                    moves[-1][4] += float(dwell.group(1))
+                    continue
+                target, speed, acceleration, coordinated = parse_gcode(line, position)
+            except ValueError as e:
+                log.warn(str(e))
+                return 0
+            moves.append([target, speed, acceleration, coordinated, 0.0])
+            position = target
+        self.stage.queue_moves([tuple(move) for move in moves])
+        return 1
+
+    def get_axis_position(self):
+        return [float(p) for p in self.stage.get_position()]
+
+    def get_run_state(self):
+        return 1 if self.stage.is_running() else 0
+
+    def get_input_state(self):
+        return self.stage.input_bits()
+
+
+def simulate(field=None, noise=0.0, period=0.01, ringing=None, limits=None, temperature=25.0, ch3600=None):
+    """
+    Points the motor module and the default gaussmeter of the mag module at simulated hardware, so box_scan and
+    everything else runs unchanged. Done by motor.init in mock mode.
+    :param field: see SimulatedMeter, e.g. dipole_field or helmholtz_field.
+    :param noise: see SimulatedMeter.
+    :param period: gaussmeter output period in seconds.
+    :param ringing: see SimulatedStage.
+    :param limits: see SimulatedStage.
+    :param temperature: see SimulatedMeter.
+    :param ch3600: see SimulatedSerial.
+    :return: SimulatedController, its stage is the simulated stage.
+    """
+    from . import mag
+    controller = SimulatedController(SimulatedStage(limits=limits, ringing=ringing))
+    motor.use(controller)
+    mag.default.serial_port = SimulatedSerial(controller.stage, field, noise, period, temperature, ch3600)
+    return controller
+
+
+def simulated_port():
+    """
+    Gaussmeter port on the stage of the simulated controller, or on a stage of its own if the motor module is not
+    simulated. Used by mag.init in mock mode.
+    """
+    stage = motor.controller.stage if isinstance(motor.controller, SimulatedController) else SimulatedStage()
+    return SimulatedSerial(stage)
+
+
+def _field_function(compute):
+    # Field functions take one [x, y, z] or an (..., 3) array of positions in mm.
+    def field(position):
+        return compute(np.asarray(position, dtype=float))
+    return field
+
+
+def dipole_field(moment=(0.0, 0.0, 1.0), position=(0.0, 0.0, 0.0)):
+    """
+    :param moment: [mx, my, mz] in A m^2.
+    :param position: dipole position in mm.
+    :return: field function of [x, y, z] in mm, returning [bx, by, bz] in mT.
+    """
+    moment = np.asarray(moment, dtype=float)
+    center = np.asarray(position, dtype=float)
+
+    def compute(p):
+        r = (p - center) / 1000
+        distance = np.linalg.norm(r, axis=-1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            b = MU_0 / (4 * np.pi) * (3 * r * np.sum(r * moment, axis=-1, keepdims=True) / distance ** 5
+                                      - moment / distance ** 3)
+        return b * 1e3
+    return _field_function(compute)
+
+
+def loop_field(radius, current, turns=1, center=(0.0, 0.0, 0.0), axis='z'):
+    """
+    Exact field of a circular current loop, from complete elliptic integrals.
+    :param radius: loop radius in mm.
+    :param current: current in A.
+    :param turns: number of turns.
+    :param center: loop center in mm.
+    :param axis: loop axis, 'x', 'y' or 'z'.
+    :return: field function of [x, y, z] in mm, returning [bx, by, bz] in mT.
+    """
+    from scipy.special import ellipe, ellipk
+    center = np.asarray(center, dtype=float)
+    k_axis = 'xyz'.index(axis)
+    a = radius / 1000
+
+    def compute(p):
+        r = (p - center) / 1000
+        z = r[..., k_axis]
+        radial = r.copy()
+        radial[..., k_axis] = 0
+        rho = np.linalg.norm(radial, axis=-1)
+        m = 4 * a * rho / ((a + rho) ** 2 + z ** 2)
+        k, e = ellipk(m), ellipe(m)
+        scale = MU_0 * current * turns / (2 * np.pi * np.sqrt((a + rho) ** 2 + z ** 2))
+        b_axis = scale * (k + (a ** 2 - rho ** 2 - z ** 2) / ((a - rho) ** 2 + z ** 2) * e)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            b_rho = np.where(rho > 0, scale * z / rho * (-k + (a ** 2 + rho ** 2 + z ** 2) / ((a - rho) ** 2 + z ** 2)
+                                                         * e), 0.0)
+            unit = np.where(rho[..., None] > 0, radial / rho[..., None], 0.0)
+        b = unit * b_rho[..., None]
+        b[..., k_axis] = b_axis
+        return b * 1e3
+    return _field_function(compute)
+
+
+def helmholtz_field(radius, current, turns=1, center=(0.0, 0.0, 0.0), axis='z'):
+    """
+    Pair of coaxial loops a radius apart, uniform field around center.
+    See loop_field for parameters.
+    """
+    offset = np.zeros(3)
+    offset['xyz'.index(axis)] = radius / 2
+    loops = [loop_field(radius, current, turns, np.asarray(center) + sign * offset, axis) for sign in (-1, 1)]
+    return _field_function(lambda p: loops[0](p) + loops[1](p))
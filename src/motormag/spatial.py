@@ -0,0 +1,298 @@
+"""
+Spatial index of scan points, for point queries and for cuts that do not line up with the scan grid. Box grids, in any
+row order and with fixed axes, are indexed through their axis vectors with searchsorted, so nothing is built and a
+lookup costs O(log n) per axis. Other point sets get a scipy cKDTree, built once. Cuts interpolate only at the
+requested positions from their local neighbourhood, instead of triangulating the whole volume like griddata.
+Indexes are memoized on FieldGrid and kept in a small cache keyed on the coordinates otherwise, see get_index.
+"""
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+from . import interp
+from .grid import FieldGrid
+
+
+CACHE_SIZE = 8
+_cache = OrderedDict()
+
+
+class SpatialIndex(object):
+    """
+    Nearest point, radius and local interpolation queries over fixed coordinates. Results refer to rows of the
+    coordinates the index was built from, values passed to interpolate are in that row order.
+    """
+    def __init__(self, coords):
+        """
+        :param coords: (n, 3) array of x, y, z.
+        """
+        self._coords = np.ascontiguousarray(coords, dtype=float).reshape(-1, 3)
+        grid = interp._as_grid(self._coords)
+        if grid is not None:
+            axes, order = grid
+            self._set_grid(axes, order)
+        else:
+            # scipy is imported on first use, like in interp.
+            from scipy.spatial import cKDTree
+            self.kind = 'tree'
+            self._tree = cKDTree(self._coords)
+
+    @classmethod
+    def for_grid(cls, axes):
+        """
+        Index of a box grid whose rows are in C order of axes, as in FieldGrid and box_scan DataFrames.
+        :param axes: [x_points, y_points, z_points], each ascending or descending.
+        :return: SpatialIndex
+        """
+        index = cls.__new__(cls)
+        index._coords = None
+        axes = [np.asarray(a, dtype=float) for a in axes]
+        rows = np.arange(int(np.prod([len(a) for a in axes]))).reshape([len(a) for a in axes])
+        for i, a in enumerate(axes):
+            if len(a) > 1 and a[0] > a[-1]:
+                axes[i] = a[::-1]
+                rows = np.flip(rows, axis=i)
+        index._set_grid(axes, rows.ravel())
+        return index
+
+    def _set_grid(self, axes, rows):
+        """
+        :param axes: ascending axis vectors.
+        :param rows: row of each grid node, in C order of axes.
+        """
+        self.kind = 'grid'
+        self.axes = axes
+        self.shape = tuple(len(a) for a in axes)
+        self._rows = rows
+        self._free = [i for i, a in enumerate(axes) if len(a) > 1]
+        self._fixed = [i for i, a in enumerate(axes) if len(a) == 1]
+
+    def __len__(self):
+        return len(self._rows) if self.kind == 'grid' else len(self._coords)
+
+    @property
+    def coords(self):
+        """
+        :return: (n, 3) coordinates in row order.
+        """
+        if self._coords is None:
+            nodes = np.array(np.unravel_index(np.arange(len(self._rows)), self.shape))
+            coords = np.empty((len(self._rows), 3))
+            coords[self._rows] = np.vstack([self.axes[i][nodes[i]] for i in range(3)]).T
+            self._coords = coords
+        return self._coords
+
+    def nearest(self, positions):
+        """
+        :param positions: (m, 3) or (3,) query positions.
+        :return: (distances, rows) of the closest scan point to each position.
+        """
+        positions = np.asarray(positions, dtype=float)
+        single = positions.ndim == 1
+        positions = positions.reshape(-1, 3)
+        if self.kind == 'tree':
+            distances, rows = self._tree.query(positions)
+        else:
+            # Closest node on a rectilinear grid is the closest point along each axis separately.
+            nodes = []
+            for i, a in enumerate(self.axes):
+                j = np.clip(np.searchsorted(a, positions[:, i]), 1, max(len(a) - 1, 1))
+                if len(a) > 1:
+                    j = np.where(np.abs(a[j - 1] - positions[:, i]) <= np.abs(a[j] - positions[:, i]), j - 1, j)
+                else:
+                    j = np.zeros(len(positions), dtype=np.int64)
+                nodes.append(j)
+            rows = self._rows[np.ravel_multi_index(nodes, self.shape)]
+            closest = np.vstack([self.axes[i][nodes[i]] for i in range(3)]).T
+            distances = np.linalg.norm(closest - positions, axis=1)
+        return (distances[0], rows[0]) if single else (distances, rows)
+
+    def within(self, position, radius):
+        """
+        :param position: [x, y, z]
+        :param radius: in mm.
+        :return: sorted array of rows of scan points at most radius from position.
+        """
+        position = np.asarray(position, dtype=float)
+        if self.kind == 'tree':
+            return np.array(sorted(self._tree.query_ball_point(position, radius)), dtype=np.int64)
+        # Only the block of nodes inside the bounding cube of the sphere is looked at.
+        ranges = [np.arange(np.searchsorted(a, p - radius, 'left'), np.searchsorted(a, p + radius, 'right'))
+                  for a, p in zip(self.axes, position)]
+        nodes = [n.ravel() for n in np.meshgrid(*ranges, indexing='ij')]
+        offsets = np.vstack([self.axes[i][nodes[i]] for i in range(3)]).T - position
+        inside = np.einsum('ij,ij->i', offsets, offsets) <= radius ** 2
+        return np.sort(self._rows[np.ravel_multi_index([n[inside] for n in nodes], self.shape)])
+
+    def interpolate(self, values, positions, neighbours=8, max_distance=None):
+        """
+        Linear interpolation at positions from the surrounding points only. Grids interpolate multilinearly between
+        the enclosing nodes, NaN outside the scanned box and off the plane of fixed axes, like interp. Other point sets
+        fit a linear field to the nearest neighbours, weighted by inverse distance.
+        :param values: (n,) or (n, k) array in row order.
+        :param positions: (m, 3) array.
+        :param neighbours: number of points in the local fit, point sets only.
+        :param max_distance: NaN where the closest point is further than this, point sets only. None for no limit.
+        :return: (m,) or (m, k) array.
+        """
+        values = np.asarray(values, dtype=float)
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        if self.kind == 'grid':
+            return self._interpolate_grid(values, positions)
+        return self._interpolate_tree(values, positions, neighbours, max_distance)
+
+    def _interpolate_grid(self, values, positions):
+        result = np.zeros((len(positions),) + values.shape[1:])
+        outside = np.zeros(len(positions), dtype=bool)
+        for i in self._fixed:
+            outside |= ~np.isclose(positions[:, i], self.axes[i][0])
+        lower, fraction = [np.zeros(len(positions), dtype=np.int64)] * 3, [None] * 3
+        for i in self._free:
+            a = self.axes[i]
+            # Rounding slack at the faces, like the isclose on fixed axes.
+            slack = 1e-9 * (a[-1] - a[0])
+            outside |= (positions[:, i] < a[0] - slack) | (positions[:, i] > a[-1] + slack) | np.isnan(positions[:, i])
+            j = np.clip(np.searchsorted(a, positions[:, i], 'right') - 1, 0, len(a) - 2)
+            lower[i] = j
+            fraction[i] = np.clip((positions[:, i] - a[j]) / (a[j + 1] - a[j]), 0.0, 1.0)
+        # Sum over the 2 ** free corners of the enclosing cell.
+        for corner in range(2 ** len(self._free)):
+            nodes, weight = list(lower), np.ones(len(positions))
+            for bit, i in enumerate(self._free):
+                upper = (corner >> bit) & 1
+                nodes[i] = lower[i] + upper
+                weight = weight * (fraction[i] if upper else 1.0 - fraction[i])
+            weight = np.where(outside, 0.0, weight)
+            corner_values = values[self._rows[np.ravel_multi_index(nodes, self.shape)]]
+            result += weight.reshape((-1,) + (1,) * (values.ndim - 1)) * corner_values
+        result[outside] = np.nan
+        return result
+
+    def _interpolate_tree(self, values, positions, neighbours, max_distance):
+        k = min(neighbours, len(self._coords))
+        distances, rows = self._tree.query(positions, k=k)
+        distances, rows = distances.reshape(len(positions), k), rows.reshape(len(positions), k)
+        flat = values.reshape(len(values), -1)
+        # Weighted least squares of value = c + g . (p - position) per query, c is the result.
+        design = np.concatenate([np.ones((len(positions), k, 1)), self._coords[rows] - positions[:, None, :]], axis=2)
+        weights = 1.0 / (distances + 1e-9 * max(1.0, float(np.max(distances))))[:, :, None]
+        coefficients = np.linalg.pinv(design * weights) @ (flat[rows] * weights)
+        result = coefficients[:, 0, :]
+        exact = distances[:, 0] == 0
+        result[exact] = flat[rows[exact, 0]]
+        if max_distance is not None:
+            result[distances[:, 0] > max_distance] = np.nan
+        return result.reshape((len(positions),) + values.shape[1:])
+
+    def plane_cut(self, values, origin, u, v, u_points, v_points, **options):
+        """
+        Values on an arbitrarily oriented plane.
+        :param values: (n,) or (n, k) array in row order.
+        :param origin: [x, y, z] point on the plane.
+        :param u: in-plane direction of the first cut axis.
+        :param v: second in-plane direction, made orthogonal to u.
+        :param u_points: offsets from origin along u in mm.
+        :param v_points: offsets from origin along v in mm.
+        :param options: see interpolate.
+        :return: (positions (nu, nv, 3), values (nu, nv) or (nu, nv, k))
+        """
+        positions = plane_positions(origin, u, v, u_points, v_points)
+        result = self.interpolate(values, positions.reshape(-1, 3), **options)
+        return positions, result.reshape(positions.shape[:2] + result.shape[1:])
+
+    def polyline_cut(self, values, points, step, **options):
+        """
+        Values along a path through the scan.
+        :param values: (n,) or (n, k) array in row order.
+        :param points: (p, 3) vertices of the path.
+        :param step: sample spacing along the path in mm.
+        :param options: see interpolate.
+        :return: (distance along the path (m,), positions (m, 3), values (m,) or (m, k))
+        """
+        distance, positions = polyline_positions(points, step)
+        return distance, positions, self.interpolate(values, positions, **options)
+
+
+def plane_positions(origin, u, v, u_points, v_points):
+    """
+    :return: (nu, nv, 3) positions origin + a * u + b * v for a in u_points, b in v_points, u and v orthonormalized.
+    """
+    u = np.asarray(u, dtype=float)
+    u = u / np.linalg.norm(u)
+    v = np.asarray(v, dtype=float)
+    v = v - np.dot(v, u) * u
+    if np.linalg.norm(v) < 1e-12:
+        raise ValueError('Plane directions u and v are parallel')
+    v = v / np.linalg.norm(v)
+    a, b = np.meshgrid(np.asarray(u_points, dtype=float), np.asarray(v_points, dtype=float), indexing='ij')
+    return np.asarray(origin, dtype=float) + a[..., None] * u + b[..., None] * v
+
+
+def polyline_positions(points, step):
+    """
+    :return: (distance along the path (m,), positions (m, 3)) every step mm along the path, vertices included.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    if len(lengths) == 0:
+        return np.zeros(1), points[:1].copy()
+    starts = np.concatenate([[0.0], np.cumsum(lengths)])
+    distance = np.union1d(np.arange(0.0, starts[-1], step), starts)
+    segment = np.clip(np.searchsorted(starts, distance, 'right') - 1, 0, len(lengths) - 1)
+    fraction = np.where(lengths[segment] > 0, (distance - starts[segment]) / np.where(lengths[segment] > 0,
+                                                                                      lengths[segment], 1.0), 0.0)
+    positions = points[segment] + fraction[:, None] * (points[segment + 1] - points[segment])
+    return distance, positions
+
+
+def get_index(data):
+    """
+    :param data: FieldGrid, box scan DataFrame, or (n, 3) coordinates.
+    :return: SpatialIndex, memoized on a FieldGrid, from cache if the same coordinates were indexed recently otherwise.
+    """
+    if isinstance(data, FieldGrid):
+        return data._memo('spatial_index', lambda: SpatialIndex.for_grid(data.axes))
+    if isinstance(data, pd.DataFrame):
+        data = data[['x', 'y', 'z']].to_numpy()
+    coords = np.ascontiguousarray(data, dtype=float)
+    key = (coords.shape, hashlib.sha1(coords.tobytes()).hexdigest())
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    index = SpatialIndex(coords)
+    _cache[key] = index
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return index
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def _field_values(data):
+    """
+    :return: (n, 3) mag_x, mag_y, mag_z in the row order of get_index(data).
+    """
+    if isinstance(data, FieldGrid):
+        return data.field.reshape(3, -1).T
+    return data[['mag_x', 'mag_y', 'mag_z']].to_numpy(dtype=float)
+
+
+def cut_plane(data, origin, u, v, u_points, v_points, **options):
+    """
+    Field on an oblique plane through a scan, see SpatialIndex.plane_cut.
+    :param data: FieldGrid or scan DataFrame.
+    :return: (positions (nu, nv, 3), field (nu, nv, 3))
+    """
+    return get_index(data).plane_cut(_field_values(data), origin, u, v, u_points, v_points, **options)
+
+
+def cut_polyline(data, points, step, **options):
+    """
+    Field along a path through a scan, see SpatialIndex.polyline_cut.
+    :param data: FieldGrid or scan DataFrame.
+    :return: (distance along the path (m,), positions (m, 3), field (m, 3))
+    """
+    return get_index(data).polyline_cut(_field_values(data), points, step, **options)
@@ -0,0 +1,263 @@
+"""
+On-disk scan storage in HDF5: points are appended to chunked, compressed datasets while the scan runs, so a crash
+only loses the point in flight. Needs h5py.
+
+File layout:
+    attrs['metadata']   JSON: lengths, step_sizes, order and scan settings.
+    attrs['columns']    column names of 'data'.
+    data    (n, k)  one row per point, x, y, z, mag_x, ... in 'columns' order.
+    index   (n,)    row of the point in box_scan order (the DataFrame index).
+    time    (n,)    time.time() when the point was stored.
+    raw     (m, 6)  individual readings that were averaged into the points, 6 columns per probe.
+    raw_time    (m,)    time.monotonic() stamps of raw readings.
+    raw_point   (m,)    index of the point each raw reading belongs to.
+"""
+import json
+import time
+import numpy as np
+import pandas as pd
+
+try:
+    import h5py
+except ImportError:  # pragma: no cover
+    h5py = None
+
+from .grid import FieldGrid
+
+
+COLUMNS = ['x', 'y', 'z', 'mag_x', 'mag_y', 'mag_z', 'temp_x', 'temp_y', 'temp_z', 'reads', 'std_error']
+
+
+def _require_h5py():
+    if h5py is None:
+        raise ImportError('Scan storage needs h5py: pip install h5py')
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('Cannot store %s in scan metadata' % type(value))
+
+
+class ScanWriter(object):
+    """
+    Appends measured points to a scan file. Use as a context manager or call close().
+    Opening an existing file appends to it, metadata and columns are then taken from the file.
+    """
+    def __init__(self, path, metadata=None, columns=None, chunk_size=1024, compression='gzip', flush_every=1,
+                 raw_width=6):
+        """
+        :param path: file name.
+        :param metadata: JSON-serializable dict, numpy values allowed. Should contain lengths and step_sizes for box
+        scans.
+        :param columns: column names of point rows, defaults to COLUMNS.
+        :param chunk_size: rows per HDF5 chunk.
+        :param compression: h5py compression filter, None for none.
+        :param flush_every: flush to disk every this many points.
+        :param raw_width: values per raw reading, 6 per probe.
+        """
+        _require_h5py()
+        self.path = path
+        self.flush_every = flush_every
+        self.file = h5py.File(path, 'a')
+        self._unflushed = 0
+        if 'data' in self.file:
+            self.columns = list(json.loads(self.file.attrs['columns']))
+            self.metadata = json.loads(self.file.attrs['metadata'])
+            return
+        self.columns = list(COLUMNS if columns is None else columns)
+        self.metadata = {} if metadata is None else metadata
+        self.file.attrs['columns'] = json.dumps(self.columns)
+        self.file.attrs['metadata'] = json.dumps(self.metadata, default=_to_json)
+        options = dict(chunks=True, compression=compression)
+        width = len(self.columns)
+        self.file.create_dataset('data', (0, width), maxshape=(None, width), dtype='f8',
+                                 **dict(options, chunks=(chunk_size, width)))
+        self.file.create_dataset('raw', (0, raw_width), maxshape=(None, raw_width), dtype='f8',
+                                 **dict(options, chunks=(chunk_size, raw_width)))
+        for name, dtype in [('index', 'i8'), ('time', 'f8'), ('raw_time', 'f8'), ('raw_point', 'i8')]:
+            self.file.create_dataset(name, (0,), maxshape=(None,), dtype=dtype, **dict(options, chunks=(chunk_size,)))
+
+    def __len__(self):
+        return len(self.file['index'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _append(self, name, values):
+        dataset = self.file[name]
+        n = len(dataset)
+        dataset.resize(n + len(values), axis=0)
+        dataset[n:] = values
+
+    def append(self, index, row, raw=None, raw_times=None):
+        """
+        Stores one measured point.
+        :param index: row of the point in box_scan order.
+        :param row: values in column order.
+        :param raw: (m, raw_width) individual readings, optional.
+        :param raw_times: length-m timestamps of raw readings.
+        :return: None
+        """
+        self._append('data', np.asarray(row, dtype=float).reshape(1, -1))
+        self._append('index', [index])
+        self._append('time', [time.time()])
+        if raw is not None:
+            raw = np.asarray(raw, dtype=float).reshape(-1, self.file['raw'].shape[1])
+            self._append('raw', raw)
+            self._append('raw_time', np.full(len(raw), np.nan) if raw_times is None else raw_times)
+            self._append('raw_point', np.full(len(raw), index))
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self._unflushed = 0
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class ScanFile(object):
+    """
+    Read access to a scan file. Nothing is loaded until asked for: single columns, single planes of a box scan, or
+    the whole scan. draw functions accept a ScanFile directly, loading only the field columns, and the 2-D plots only
+    the planes they cut.
+    """
+    def __init__(self, path):
+        _require_h5py()
+        self.path = path
+        self.file = h5py.File(path, 'r')
+        self.columns = list(json.loads(self.file.attrs['columns']))
+        self.metadata = json.loads(self.file.attrs['metadata'])
+
+    def __len__(self):
+        return len(self.file['index'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+    @property
+    def index(self):
+        return self.file['index'][:]
+
+    def _frame(self, rows, index, row_columns, columns):
+        positions = [row_columns.index(c) for c in columns]
+        df = pd.DataFrame(rows[:, positions], columns=columns, index=index)
+        df.sort_index(inplace=True)
+        for key in ['lengths', 'step_sizes', 'probes']:
+            if key in self.metadata:
+                df.attrs[key] = self.metadata[key]
+        return df
+
+    def to_dataframe(self, columns=None):
+        """
+        :param columns: subset of columns to load, all if None.
+        :return: DataFrame like box_scan returns, rows sorted by index.
+        """
+        columns = self.columns if columns is None else columns
+        positions = sorted(self.columns.index(c) for c in columns)
+        rows = self.file['data'][:, positions] if len(self) else np.zeros((0, len(positions)))
+        return self._frame(rows, self.index, [self.columns[i] for i in positions], columns)
+
+    def plane(self, cut_axis, cut_index, columns=None):
+        """
+        Loads only the points in one plane of a box scan.
+        :param cut_axis: plane normal, 'x', 'y' or 'z'.
+        :param cut_index: nth plane.
+        :param columns: subset of columns to load.
+        :return: DataFrame
+        """
+        return self.planes(cut_axis, cut_index, cut_index + 1, columns)
+
+    def planes(self, cut_axis, start, stop, columns=None):
+        """
+        Loads only the points in planes start to stop - 1 of a box scan.
+        See plane.
+        :return: DataFrame
+        """
+        columns = self.columns if columns is None else columns
+        lengths = self.metadata['lengths']
+        axis = 'xyz'.index(cut_axis)
+        index = self.index
+        grid_position = np.unravel_index(index, lengths)[axis]
+        positions = np.flatnonzero((grid_position >= start) & (grid_position < stop))
+        rows = self.file['data'][positions, :] if len(positions) else np.zeros((0, len(self.columns)))
+        return self._frame(rows, index[positions], self.columns, columns)
+
+    def axis(self, axis):
+        """
+        Positions along one axis of a box scan, loading only the line of points through the first corner.
+        :param axis: 'x', 'y' or 'z'.
+        :return: array
+        """
+        lengths = self.metadata['lengths']
+        k = 'xyz'.index(axis)
+        index = self.index
+        grid_position = np.array(np.unravel_index(index, lengths))
+        on_line = np.all(np.delete(grid_position, k, axis=0) == 0, axis=0)
+        positions = np.flatnonzero(on_line)
+        if len(positions) != lengths[k]:
+            raise ValueError('Scan file does not hold a complete line along %s' % axis)
+        # h5py reads rows in increasing order only, sorted along the axis afterwards.
+        return self.file['data'][positions, self.columns.index(axis)][np.argsort(grid_position[k, positions])]
+
+    def raw(self, index=None):
+        """
+        :param index: point to get raw readings of, all if None.
+        :return: raw_times, (m, raw_width) raw readings.
+        """
+        if index is None:
+            return self.file['raw_time'][:], self.file['raw'][:]
+        positions = np.flatnonzero(self.file['raw_point'][:] == index)
+        if len(positions) == 0:
+            return np.zeros(0), np.zeros((0, self.file['raw'].shape[1]))
+        return self.file['raw_time'][positions], self.file['raw'][positions, :]
+
+    def to_grid(self, cut_axis=None, start=None, stop=None):
+        """
+        :param cut_axis: with start and stop, only planes start to stop - 1 normal to cut_axis are loaded.
+        :return: grid.FieldGrid of a complete box scan, loading coordinates and field only.
+        """
+        columns = ['x', 'y', 'z', 'mag_x', 'mag_y', 'mag_z']
+        if cut_axis is None:
+            return FieldGrid.from_dataframe(self.to_dataframe(columns))
+        lengths = list(self.metadata['lengths'])
+        k = 'xyz'.index(cut_axis)
+        start, stop = max(0, start), min(lengths[k], stop)
+        lengths[k] = stop - start
+        return FieldGrid.from_dataframe(self.planes(cut_axis, start, stop, columns), lengths)
+
+
+def save(data, path, metadata=None):
+    """
+    Writes a whole scan DataFrame to a scan file, index and attrs included.
+    """
+    metadata = dict(data.attrs, **({} if metadata is None else metadata))
+    with ScanWriter(path, metadata, list(data.columns), flush_every=len(data) + 1) as writer:
+        rows = data.to_numpy(dtype=float)
+        writer._append('data', rows)
+        writer._append('index', data.index.to_numpy())
+        writer._append('time', np.full(len(data), time.time()))
+
+
+def load(path):
+    """
+    :return: DataFrame stored in a scan file.
+    """
+    with ScanFile(path) as scan_file:
+        return scan_file.to_dataframe()
@@ -0,0 +1,202 @@
+"""
+Continuous acquisition of the gaussmeter output: a background thread parses the serial stream into a timestamped ring
+buffer, so readings can be picked by time instead of flushing the port before every reading.
+"""
+import threading
+import time
+import numpy as np
+
+
+class RingBuffer(object):
+    """
+    Preallocated ring buffer of timestamped samples. Timestamps must be non-decreasing.
+    Samples are addressed by a running count, so sample n stays sample n after the buffer wraps, until overwritten.
+    """
+    def __init__(self, capacity=65536, width=6):
+        self.capacity = capacity
+        self.width = width
+        self.times = np.zeros(capacity)
+        self.values = np.zeros((capacity, width))
+        self.count = 0
+        # Set by the producer when it dies, raised to waiting readers instead of letting them time out.
+        self.error = None
+        self._condition = threading.Condition()
+
+    def extend(self, times, values):
+        """
+        Appends samples and wakes up waiting readers.
+        :param times: length-n array of timestamps.
+        :param values: (n, width) array.
+        :return: None
+        """
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float).reshape(-1, self.width)
+        n = len(times)
+        with self._condition:
+            if n > self.capacity:
+                times, values = times[-self.capacity:], values[-self.capacity:]
+                self.count += n - self.capacity
+                n = self.capacity
+            positions = np.arange(self.count, self.count + n) % self.capacity
+            self.times[positions] = times
+            self.values[positions] = values
+            self.count += n
+            self._condition.notify_all()
+
+    def fail(self, error):
+        """
+        Marks the producer as dead, wakes up readers and makes any further waits raise error.
+        """
+        with self._condition:
+            self.error = error
+            self._condition.notify_all()
+
+    def append(self, timestamp, value):
+        self.extend([timestamp], [value])
+
+    @property
+    def oldest(self):
+        """
+        :return: count of the oldest sample still in buffer.
+        """
+        return max(0, self.count - self.capacity)
+
+    def _search(self, t, side):
+        # Buffer content is at most two sorted runs: [head:] holds the older samples once wrapped, [:head] the newer.
+        if self.count <= self.capacity:
+            return int(np.searchsorted(self.times[:self.count], t, side))
+        head = self.count % self.capacity
+        older = self.times[head:]
+        i = int(np.searchsorted(older, t, side))
+        if i < len(older):
+            return self.oldest + i
+        return self.oldest + len(older) + int(np.searchsorted(self.times[:head], t, side))
+
+    def take(self, start, stop):
+        """
+        Copies samples by count.
+        :return: times, values
+        """
+        if start < self.oldest:
+            raise IndexError('Samples %d-%d already overwritten' % (start, self.oldest))
+        positions = np.arange(start, stop) % self.capacity
+        return self.times[positions], self.values[positions]
+
+    def latest(self, n):
+        """
+        :return: times, values of the last n samples, fewer if not available.
+        """
+        with self._condition:
+            return self.take(max(self.oldest, self.count - n), self.count)
+
+    def window(self, t0, t1):
+        """
+        :return: times, values of all samples with t0 <= timestamp <= t1.
+        """
+        with self._condition:
+            return self.take(self._search(t0, 'left'), self._search(t1, 'right'))
+
+    def after(self, t, n, timeout=None):
+        """
+        Blocks until n samples taken after time t are available.
+        :param t: timestamp, samples at exactly t are not included.
+        :param n: number of samples.
+        :param timeout: seconds to wait at most, None for forever.
+        :return: times, values of the first n samples after t.
+        """
+        return self._wait(lambda: self._search(t, 'right'), n, timeout)
+
+    def available(self, start):
+        """
+        Non-blocking read of everything received from count start on.
+        :return: times, values
+        """
+        with self._condition:
+            return self.take(start, self.count)
+
+    def since(self, start, n, timeout=None):
+        """
+        Blocks until samples start to start + n (by count) are available.
+        :return: times, values
+        """
+        return self._wait(lambda: start, n, timeout)
+
+    def _wait(self, find_start, n, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                start = find_start()
+                if self.count - start >= n:
+                    return self.take(start, start + n)
+                if self.error is not None:
+                    raise self.error
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError('Only %d of %d samples arrived' % (self.count - start, n))
+                self._condition.wait(remaining)
+
+
+class StreamReader(object):
+    """
+    Background thread reading raw bytes from a serial port and parsing them into a RingBuffer.
+    All samples completed by one read are stamped with time.monotonic() at the moment it returned.
+    """
+    def __init__(self, port, parser, capacity=65536, width=6):
+        """
+        :param port: serial.Serial or anything with read(size) and in_waiting.
+        :param parser: object with feed(bytes) returning an (n, width) array of completed samples, e.g.
+        mag.FrameParser. Keeps its own count of bad frames.
+        :param capacity: ring buffer size in samples.
+        :param width: values per sample.
+        """
+        self.port = port
+        self.parser = parser
+        self.buffer = RingBuffer(capacity, width)
+        self._running = False
+        self._thread = None
+        self.error = None
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the thread. Raises the exception it died of, if any.
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.error is not None:
+            raise self.error
+
+    def _loop(self):
+        try:
+            while self._running:
+                chunk = self.port.read(max(1, self.port.in_waiting))
+                if chunk:
+                    self.feed(chunk, time.monotonic())
+        except Exception as e:
+            self.error = e
+            self._running = False
+            self.buffer.fail(e)
+
+    def feed(self, chunk, timestamp):
+        """
+        Parses a chunk of raw bytes.
+        :param chunk: bytes
+        :param timestamp: receive time assigned to all samples completed by this chunk.
+        :return: number of samples added.
+        """
+        values = self.parser.feed(chunk)
+        if len(values):
+            self.buffer.extend(np.full(len(values), timestamp), values)
+        return len(values)
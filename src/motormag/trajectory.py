@@ -0,0 +1,119 @@
+"""
+Multi-point moves as one G-code program: absolute moves in the same G00/G01 format as motor.multi_absolute_move, with
+dwells at measurement points, so the controller paces the whole sequence instead of one MDI round-trip and polling
+loop per point. Programs are built and timed offline, motor.run_trajectory sends them.
+"""
+from collections import namedtuple
+import numpy as np
+
+from . import motion
+
+
+COORDINATED_TEMPLATE = "G01X{d[0]:.1f}Y{d[1]:.1f}Z{d[2]:.1f}F{s[0]:.1f}A{a:.1f}D0"
+UNCOORDINATED_TEMPLATE = "G00X{d[0]:.1f}FX{s[0]:.1f}AX{a:.1f}Y{d[1]:.1f}FY{s[1]:.1f}AY{a:.1f}Z{d[2]:.1f}FZ{s[2]:.1f}AZ{a:.1f}D0"
+# Standard G04 dwell in seconds. Check against the controller manual before running programs on the WNMC400.
+DWELL_TEMPLATE = "G04P{:.3f}"
+
+
+Segment = namedtuple('Segment', ['target', 'speed', 'acceleration', 'coordinated', 'dwell'])
+
+
+def move_gcode(target, speed=25, acceleration=0.3, coordinated=True):
+    """
+    G-code of an absolute move, as sent by motor.multi_absolute_move.
+    :param target: [x, y, z] in mm.
+    :param speed: scalar or [x, y, z] speed in mm/s, see motor.multi_absolute_move.
+    :param acceleration: acceleration in controller units.
+    :param coordinated: G01 if True, G00 otherwise.
+    :return: str
+    """
+    template = COORDINATED_TEMPLATE if coordinated else UNCOORDINATED_TEMPLATE
+    return template.format(d=target, s=motion._as_triplet(speed), a=acceleration)
+
+
+def dwell_gcode(seconds):
+    return DWELL_TEMPLATE.format(seconds)
+
+
+class Trajectory(object):
+    """
+    Sequence of absolute moves, each optionally followed by a dwell during which the probe can be read.
+    """
+    def __init__(self, start=(0.0, 0.0, 0.0), speed=25, acceleration=0.3, coordinated=True):
+        """
+        :param start: where the stage is when the program starts, used for timing only.
+        :param speed: default speed of moves.
+        :param acceleration: default acceleration of moves.
+        :param coordinated: default move type.
+        """
+        self.start = [float(p) for p in start]
+        self.speed = speed
+        self.acceleration = acceleration
+        self.coordinated = coordinated
+        self.segments = []
+
+    def __len__(self):
+        return len(self.segments)
+
+    def move_to(self, target, dwell=0.0, speed=None, acceleration=None, coordinated=None):
+        """
+        Appends a move, settings default to those given to __init__.
+        :param target: [x, y, z] in mm.
+        :param dwell: seconds to stay at target before the next move.
+        :return: self
+        """
+        try:
+            _, _, _ = target
+        except (TypeError, ValueError):
+            raise ValueError("target should be a length-3 list")
+        self.segments.append(Segment([float(t) for t in target], self.speed if speed is None else speed,
+                                     self.acceleration if acceleration is None else acceleration,
+                                     self.coordinated if coordinated is None else coordinated, float(dwell)))
+        return self
+
+    @classmethod
+    def through(cls, points, dwell=0.0, start=(0.0, 0.0, 0.0), speed=25, acceleration=0.3, coordinated=True):
+        """
+        :param points: (n, 3) targets in the order to visit them, e.g. planned with planner.plan.
+        :param dwell: seconds to stay at every point.
+        :return: Trajectory
+        """
+        trajectory = cls(start, speed, acceleration, coordinated)
+        for point in np.asarray(points, dtype=float):
+            trajectory.move_to(point, dwell)
+        return trajectory
+
+    def gcode(self, first=0, last=None):
+        """
+        :param first: first segment to emit.
+        :param last: segment to stop before, None for all.
+        :return: list of G-code lines, a move per segment followed by a dwell where one is set.
+        """
+        lines = []
+        for segment in self.segments[first:last]:
+            lines.append(move_gcode(segment.target, segment.speed, segment.acceleration, segment.coordinated))
+            if segment.dwell > 0:
+                lines.append(dwell_gcode(segment.dwell))
+        return lines
+
+    def schedule(self, start=None):
+        """
+        Predicted timing of the program with the motion model, in seconds from its start.
+        :param start: stage position at the start, defaults to the one given to __init__.
+        :return: (n, 2) array of arrival at each target and end of its dwell.
+        """
+        times = np.zeros((len(self.segments), 2))
+        position, t = self.start if start is None else start, 0.0
+        for i, segment in enumerate(self.segments):
+            t += motion.predict_move_time(position, segment.target, segment.speed, segment.acceleration,
+                                          segment.coordinated)
+            times[i] = t, t + segment.dwell
+            position, t = segment.target, t + segment.dwell
+        return times
+
+    @property
+    def duration(self):
+        """
+        :return: predicted run time of the whole program in seconds.
+        """
+        return float(self.schedule()[-1, 1]) if self.segments else 0.0
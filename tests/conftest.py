@@ -0,0 +1,11 @@
+import pytest
+from motormag import envelope
+
+
+@pytest.fixture(autouse=True)
+def no_envelope():
+    # Scans would otherwise check against whatever envelope file the machine running the tests has.
+    saved = envelope._current, envelope._loaded
+    envelope.use(None)
+    yield
+    envelope._current, envelope._loaded = saved
@@ -0,0 +1,57 @@
+import asyncio
+import numpy as np
+import pytest
+from motormag import aio, mag, sim, _mode
+
+
+def test_scan_points_with_progress():
+    async def run():
+        stage, meter = aio.simulated(field=lambda p: p, period=0.001)
+        progress = asyncio.Queue()
+        targets = [[1, 0, 0], [1, 2, 0], [0, 2, 3]]
+        df = await aio.scan_points(stage, meter, targets, n_reps=2, speed=500, acceleration=50, progress=progress)
+        updates = [progress.get_nowait() for _ in range(progress.qsize())]
+        return df, updates, await stage.get_position()
+
+    df, updates, position = asyncio.run(run())
+    assert np.allclose(df.loc[:, ['mag_x', 'mag_y', 'mag_z']].to_numpy(), [[1, 0, 0], [1, 2, 0], [0, 2, 3]])
+    assert [u[0] for u in updates] == [0, 1, 2] and updates[-1][1] == 3
+    assert np.allclose(position, [0, 2, 3])
+
+
+def test_limit_switch_stops_scan():
+    async def run():
+        stage, meter = aio.simulated(limits=([-100, -100, -100], [10, 100, 100]))
+        with pytest.raises(aio.LimitSwitchError) as e:
+            await aio.scan_points(stage, meter, [[5, 0, 0], [50, 0, 0]], speed=100, acceleration=50,
+                                  limit_period=0.005)
+        assert 'x_high' in str(e.value)
+        assert not await stage.is_running()
+        return await stage.get_position()
+
+    position = asyncio.run(run())
+    assert 10 <= position[0] < 50
+
+
+def test_read_stream(monkeypatch):
+    monkeypatch.setattr(_mode, 'CH3600', True)
+    stage = sim.SimulatedStage()
+    mag.start_stream(sim.SimulatedSerial(stage, field=lambda p: [1.0, 2.0, 3.0], period=0.002))
+
+    async def run():
+        meter = aio.AsyncMeter(mag)
+        stage_task = asyncio.ensure_future(aio.AsyncStage(stage).move_to([0, 0, 1], speed=100, acceleration=50))
+        n = 0
+        async for times, values in meter.read_stream(period=0.01):
+            assert np.allclose(values[:, :3], [1, 2, 3])
+            assert np.all(np.diff(times) >= 0)
+            n += len(times)
+            if n >= 20:
+                break
+        await stage_task
+        return n
+
+    try:
+        assert asyncio.run(run()) >= 20
+    finally:
+        mag.stop_stream()
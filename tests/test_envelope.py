@@ -0,0 +1,126 @@
+import time
+import numpy as np
+import pytest
+from motormag import envelope, motor, scan, sim
+
+
+MAGNET = ([-10, -10, 20], [10, 10, 40], 'magnet')
+
+
+def test_path_violations():
+    box = envelope.Envelope(travel=([-50, -50, 0], [50, 50, 60]), obstacles=[MAGNET])
+    box.check_path([[20, 0, 30], [20, 20, 30], [-20, 20, 30]])
+    # Both ends clear of the magnet, the straight move between them is not.
+    with pytest.raises(envelope.EnvelopeError) as e:
+        box.check_path([[20, 0, 30], [-20, 0, 30]])
+    assert e.value.index == 1 and 'magnet' in str(e.value)
+    assert [v[0] for v in box.violations([[0, 0, 10], [0, 0, 70]])] == [1, 1]
+    # Axes of an uncoordinated move may take any route inside the box spanned by its ends.
+    assert box.violations([[20, 20, 30], [-20, -20, 30]], start=[20, 20, 30])
+    assert not box.violations([[20, 20, 30], [20, -20, 30]], start=[20, 20, 30], coordinated=False)
+    assert box.violations([[20, 20, 30], [-20, -20, 30]], start=[20, -20, 30], coordinated=False)
+
+
+def test_holder_and_margin():
+    probe = envelope.Envelope(obstacles=[MAGNET])
+    holder = envelope.Envelope(obstacles=[MAGNET], holder=([-1, -1, 0], [1, 1, 100]))
+    margin = envelope.Envelope(obstacles=[MAGNET], margin=2)
+    # Probe below the magnet, with a holder rising above it.
+    assert not probe.violations([[0, 0, 10]])
+    assert holder.violations([[0, 0, 10]])
+    assert not probe.violations([[11, 0, 30]], start=[11, 0, 0]) and margin.violations([[11, 0, 30]], start=[11, 0, 0])
+
+
+def test_check_box_and_persistence(tmp_path):
+    box = envelope.Envelope(travel=([-50, -50, 0], [50, 50, 60]), obstacles=[MAGNET], holder=([0, 0, 0], [0, 0, 5]),
+                            margin=1)
+    box.check_box([20, 20, 0], [40, 40, 50])
+    with pytest.raises(envelope.EnvelopeError):
+        box.check_box([0, 0, 0], [40, 40, 16])
+    with pytest.raises(envelope.EnvelopeError):
+        box.check_box([20, 20, 0], [60, 40, 50])
+    path = str(tmp_path / 'envelope.json')
+    box.save(path)
+    loaded = envelope.load(path)
+    assert loaded.to_dict() == box.to_dict()
+
+
+def test_large_path_is_fast():
+    box = envelope.Envelope(travel=([-50, -50, 0], [50, 50, 60]), obstacles=[MAGNET] * 5)
+    points = np.random.default_rng(0).uniform([15, -40, 0], [40, 40, 60], (100000, 3))
+    start = time.perf_counter()
+    box.check_path(points, start=points[0])
+    assert time.perf_counter() - start < 1.0
+
+
+def test_perimeter():
+    corners = envelope.perimeter([0, 5, 10], [2, 4], [1, 3])
+    assert len(np.unique(corners, axis=0)) == 8
+    # Consecutive corners share an edge.
+    assert np.all(np.sum(np.diff(corners, axis=0) != 0, axis=1) == 1)
+
+
+def test_trace_perimeter_limit_abort():
+    stage = sim.SimulatedStage(limits=([-100, -100, -100], [100, 5, 100]))
+    with pytest.raises(motor.LimitSwitchError) as e:
+        envelope.trace_perimeter([0, 10], [0, 10], [0, 10], speed=200, acceleration=20, stage=stage)
+    assert e.value.state.y_high
+    assert not stage.is_running()
+    position = stage.get_position()
+    assert 5 <= position[1] < 6
+
+
+def test_back_off_limit_switch():
+    stage = sim.SimulatedStage(limits=([-100, -100, -100], [100, 5, 100]))
+    with pytest.raises(motor.LimitSwitchError):
+        stage.multi_absolute_move([0, 10, 0], speed=200, acceleration=20)
+    # Resting on y_high, moving further onto it or along it stops at once.
+    for x, y in ((0, 60), (20, None)):
+        with pytest.raises(motor.LimitSwitchError):
+            stage.multi_absolute_move([x, stage.get_position()[1] if y is None else y, 0], speed=200,
+                                      acceleration=20)
+        assert stage.get_position()[1] < 5.5
+        assert stage.get_position()[0] < 1
+    # Moving off it is fine, and the switch trips again when driven back onto.
+    stage.multi_absolute_move([0, 0, 0], speed=200, acceleration=20)
+    assert stage.get_position() == [0, 0, 0]
+    with pytest.raises(motor.LimitSwitchError):
+        stage.multi_absolute_move([0, 10, 0], speed=200, acceleration=20)
+    # Same through the motor module.
+    controller = sim.simulate(limits=([-100, -100, -100], [100, 5, 100]))
+    with pytest.raises(motor.LimitSwitchError):
+        motor.multi_absolute_move([0, 10, 0], speed=200, acceleration=20)
+    y = controller.stage.get_position()[1]
+    assert y >= 5
+    # Read on the first poll, before the stage gets far.
+    with pytest.raises(motor.LimitSwitchError):
+        motor.multi_absolute_move([0, 60, 0], speed=200, acceleration=20)
+    assert controller.stage.get_position()[1] < y + 0.5
+    motor.multi_absolute_move([0, 0, 0], speed=200, acceleration=20)
+    assert np.allclose(motor.get_position(), [0, 0, 0])
+
+
+def test_new_trips():
+    on_high = motor.InputState(1 << motor.INPUT_BITS['y_high'])
+    clear = motor.InputState(0)
+    assert motor.new_trips(on_high, [0, -1, 0])(on_high) == []
+    assert motor.new_trips(on_high, [0, 1, 0])(on_high) == ['y_high']
+    assert motor.new_trips(on_high, [1, 0, 0])(on_high) == ['y_high']
+    # Unknown direction, ignored until released.
+    check = motor.new_trips(on_high)
+    assert check(on_high) == []
+    assert check(clear) == []
+    assert check(on_high) == ['y_high']
+
+
+def test_box_scan_checks_envelope():
+    stage = sim.SimulatedStage()
+    meter = sim.SimulatedMeter(stage)
+    envelope.use(envelope.Envelope(obstacles=[([1.5, -1, -1], [2.5, 5, 5])]))
+    try:
+        with pytest.raises(envelope.EnvelopeError):
+            scan.BoxScan([0, 4], [0, 2], 0, step_size=1, time_wait=0.0, speed=500, acceleration=50, stage=stage,
+                         meter=meter).run()
+    finally:
+        envelope.use(None)
+    assert stage.get_position() == [0, 0, 0]
@@ -0,0 +1,89 @@
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+import pytest
+from motormag import draw
+from motormag.grid import FieldGrid
+
+
+def scan_frame():
+    xs, ys, zs = np.arange(0.0, 10.0, 2.0), np.arange(0.0, 6.0, 1.0), np.array([0.0, 4.0, 8.0])
+    xm, ym, zm = np.meshgrid(xs, ys, zs, indexing='ij')
+    df = pd.DataFrame({'x': xm.ravel(), 'y': ym.ravel(), 'z': zm.ravel()})
+    df['mag_x'] = 3 * df.x + 1
+    df['mag_y'] = df.y * df.z
+    df['mag_z'] = 2.0
+    df.attrs['lengths'] = [len(xs), len(ys), len(zs)]
+    df.attrs['step_sizes'] = [2.0, 1.0, 4.0]
+    return df
+
+
+def test_from_dataframe():
+    df = scan_frame()
+    grid = FieldGrid.from_dataframe(df)
+    coordinates, mags = draw.dataframe_to_matrices(df)
+    assert grid.field.shape == (3, 5, 6, 3)
+    assert np.all(grid.axes[2] == [0, 4, 8])
+    for ax in 'xyz':
+        assert np.all(grid.coordinates[ax] == coordinates[ax])
+        assert np.all(grid.mags[ax] == mags[ax])
+    assert np.allclose(grid.to_dataframe()[df.columns], df)
+
+
+def test_derived_quantities_memoized():
+    grid = FieldGrid.from_dataframe(scan_frame())
+    amplitude = grid.amplitude('xyz')
+    assert grid.amplitude('xyz') is amplitude
+    assert np.allclose(grid.gradient('x', 'x'), 3)
+    assert np.allclose(grid.gradient('y', 'z'), grid.coordinates['y'])
+    assert grid.gradient('x', 'x') is grid.gradients()['bx']['x']
+    expected = (grid.gradient_squared('xy', 'xyz') / np.sum(grid.b_zero() ** 2))
+    assert np.allclose(draw.relative_field_gradient_squared(grid), expected)
+    assert np.allclose(grid.b_zero(), [13, 10, 2])
+
+
+def test_fixed_axis_gradient_error():
+    df = scan_frame()
+    df = df[df.z == 4].reset_index(drop=True)
+    df.attrs['lengths'] = [5, 6, 1]
+    grid = FieldGrid.from_dataframe(df)
+    assert draw.determine_fixed_axes(grid) == ['z']
+    with pytest.raises(ValueError):
+        grid.gradient('x', 'z')
+    f, ax, pcm = draw.plot_strength_2d(grid, field_axis='x')
+    assert pcm.get_array().size == 30
+
+
+def test_join_dataframes():
+    df = scan_frame()
+    df['std_error'] = 0.1
+    # Two halves along x sharing the plane x=4, the second taken with a small positioning offset and more noise.
+    first, second = df[df.x <= 4].copy(), df[df.x >= 4].copy()
+    second['x'] += 0.05
+    second['std_error'] = 0.2
+    second.loc[second.x < 5, 'mag_z'] = 7.0
+    second.attrs = dict(df.attrs)
+    joined = draw.join_dataframes([second, first])
+    assert joined.attrs['lengths'] == [5, 6, 3]
+    assert joined.attrs['step_sizes'] == [2.0, 1.0, 4.0]
+    assert np.allclose(joined[['x', 'y', 'z', 'mag_x', 'mag_y']], df[['x', 'y', 'z', 'mag_x', 'mag_y']])
+    overlap = joined.x == 4
+    # Weighted 4:1 towards the less noisy scan.
+    assert np.allclose(joined.mag_z[overlap], (4 * 2.0 + 7.0) / 5)
+    assert np.allclose(joined.mag_z[~overlap], 2.0)
+    assert np.allclose(joined.std_error[overlap], np.sqrt(1 / (1 / 0.01 + 1 / 0.04)))
+    assert np.allclose(FieldGrid.from_dataframe(joined).gradient('x', 'x'), 3)
+
+
+def test_join_dataframes_holes():
+    df = scan_frame()
+    parts = [df[(df.x <= 2) & (df.z == 0)], df[df.x >= 6]]
+    joined = draw.join_dataframes(parts)
+    assert 'lengths' not in joined.attrs
+    assert len(joined) == len(parts[0]) + len(parts[1])
+    holes = joined.attrs['holes']
+    assert len(holes) + len(joined) == 5 * 6 * 3
+    assert not np.any((holes[:, 0] <= 2) & (holes[:, 2] == 0))
+    with pytest.raises(ValueError):
+        draw.join_dataframes([])
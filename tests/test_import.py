@@ -0,0 +1,18 @@
+import subprocess
+import sys
+
+
+def _loaded_after(statement):
+    code = '%s\nimport sys\nprint(" ".join(sorted(sys.modules)))' % statement
+    return set(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.split())
+
+
+def test_package_import_is_lazy():
+    loaded = _loaded_after('import motormag')
+    assert not {'clr', 'pandas', 'matplotlib', 'scipy', 'motormag.motor', 'motormag.draw'} & loaded
+
+
+def test_analysis_imports_skip_hardware_and_plotting():
+    loaded = _loaded_after('import motormag\nmotormag.draw\nimport motormag.storage, motormag.scan')
+    assert 'motormag.draw' in loaded and 'motormag.scan' in loaded
+    assert not {'clr', 'System', 'serial', 'matplotlib.pyplot', 'scipy.interpolate'} & loaded
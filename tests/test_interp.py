@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+from scipy.interpolate import griddata
+from motormag import interp, draw
+
+
+def box_frame(xs, ys, zs, field):
+    xm, ym, zm = np.meshgrid(xs, ys, zs, indexing='ij')
+    df = pd.DataFrame({'x': xm.ravel(), 'y': ym.ravel(), 'z': zm.ravel()})
+    df['mag_x'], df['mag_y'], df['mag_z'] = field(df.x, df.y, df.z)
+    for col in ['temp_x', 'temp_y', 'temp_z']:
+        df[col] = 25.0
+    df.attrs['lengths'] = [len(xs), len(ys), len(zs)]
+    return df
+
+
+def linear(x, y, z):
+    return 2 * x + y, y - z, 0.5 * z + 1
+
+
+def test_grid_matches_griddata():
+    interp.clear_cache()
+    coords = box_frame(np.arange(4.0), np.arange(3.0), np.arange(3.0), linear)
+    coords = coords.sample(frac=1, random_state=1)
+    positions = np.random.default_rng(0).uniform(0, 2, (20, 3))
+    interpolator = interp.get_interpolator(coords[['x', 'y', 'z']])
+    assert interpolator.kind == 'grid'
+    values = coords[['mag_x', 'mag_y', 'mag_z']].to_numpy()
+    expected = griddata(coords[['x', 'y', 'z']], values, positions)
+    assert np.allclose(interpolator(values, positions), expected)
+    assert interp.get_interpolator(coords[['x', 'y', 'z']].to_numpy().copy()) is interpolator
+    assert np.all(np.isnan(interpolator(values, [[10, 0, 0]])))
+
+
+def test_scattered_and_planar():
+    interp.clear_cache()
+    rng = np.random.default_rng(2)
+    coords = rng.uniform(0, 1, (50, 3))
+    values = coords @ [1.0, 2.0, 3.0]
+    positions = rng.uniform(0.3, 0.6, (10, 3))
+    assert interp.get_interpolator(coords).kind == 'delaunay'
+    assert np.allclose(interp.interpolate(coords, values, positions), griddata(coords, values, positions))
+    # A 2-D scan cannot be triangulated by griddata, grid path handles it.
+    planar = box_frame(np.arange(3.0), np.arange(3.0), [5.0], linear)
+    result = interp.interpolate(planar[['x', 'y', 'z']], planar.mag_x, [[0.5, 0.5, 5.0], [0.5, 0.5, 4.0]])
+    assert np.isclose(result[0], 1.5)
+    assert np.isnan(result[1])
+
+
+def test_sub_uses_direct_alignment():
+    field = box_frame(np.arange(3.0), np.arange(3.0), np.arange(2.0), linear)
+    background = field.copy()
+    background[['mag_x', 'mag_y', 'mag_z']] = 1.0
+    result = draw.sub(field, background)
+    assert np.allclose(result.mag_x, field.mag_x - 1)
+    assert np.allclose(draw.div(field, background).mag_z, field.mag_z)
@@ -0,0 +1,38 @@
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+from motormag import live, scan, sim
+
+
+def test_live_view_during_scan():
+    stage = sim.SimulatedStage()
+    meter = sim.SimulatedMeter(stage, field=lambda p: np.asarray(p) + [1, 0, 0], period=0.001)
+    x, y, z = scan.range_to_points([0, 4], step_size=1), scan.range_to_points([0, 3], step_size=1), [0.0]
+    view = live.LiveView(x, y, z, fps=20).start()
+    box = scan.BoxScan([0, 4], [0, 3], 0, step_size=1, time_wait=0.0, speed=500, acceleration=50, test_corners=False,
+                       stage=stage, meter=meter, observer=view.push)
+    df = box.run()
+    view.stop()
+    assert view.cut_axis == 'z' and view.points == 20
+    # Frames are rate limited, not one per point.
+    assert view.frames <= box.elapsed * 20 + 4
+    grid = view.to_grid()
+    assert np.allclose(grid.field.reshape(3, -1).T, df[['mag_x', 'mag_y', 'mag_z']].to_numpy())
+    shown = view.mesh.get_array()
+    assert not np.any(np.ma.getmaskarray(shown))
+    assert np.allclose(shown, grid.amplitude('xyz')[:, :, 0].T)
+    low, high = view.mesh.get_clim()
+    assert low <= 1.0 and np.sqrt(5 ** 2 + 3 ** 2) <= high
+
+
+def test_live_view_slices():
+    view = live.LiveView([0, 1, 2], [0, 1], [0, 1, 2, 3], cut_axis='y', cut_index=1, vmin=0, vmax=10)
+    view.push(np.ravel_multi_index((2, 1, 3), view.shape), [3.0, 4.0, 0.0])
+    view.push(np.ravel_multi_index((2, 0, 3), view.shape), [6.0, 8.0, 0.0])
+    assert view.refresh(force=True)
+    shown = view.mesh.get_array()
+    assert shown.shape == (4, 3)
+    assert shown[3, 2] == 5.0 and np.ma.getmaskarray(shown).sum() == 11
+    assert not view.refresh(force=True)
+    view.show('y', 0)
+    assert view.mesh.get_array()[3, 2] == 10.0
@@ -0,0 +1,37 @@
+import json
+from motormag import log
+
+
+def test_progress_rate_limited(tmp_path, capsys):
+    path = tmp_path / 'log.jsonl'
+    log.configure(background=True, json_path=str(path), progress_interval=60.0)
+    try:
+        log.log('starting')
+        for i in range(100):
+            log.progress(i + 1, 100, 'point at %.1f', i / 10)
+        log.warn('done')
+        log.flush()
+    finally:
+        log.configure(background=True, json_path='', progress_interval=1.0)
+    lines = capsys.readouterr().out.splitlines()
+    # First and last progress step only, in order with the other messages.
+    assert len(lines) == 4
+    assert lines[0].endswith('starting')
+    assert '1/100' in lines[1] and lines[1].endswith('point at 0.0')
+    assert '100/100' in lines[2] and 'ETA 0:00:00' in lines[2] and lines[2].endswith('point at 9.9')
+    assert 'done' in lines[3]
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(records) == 102
+    assert [r['level'] for r in records[:2]] == ['info', 'progress']
+    assert records[-1]['level'] == 'warning'
+    assert records[50]['message'] == 'point at 4.9' and records[50]['args'] == [4.9]
+    assert records[50]['done'] == 50 and records[50]['total'] == 100
+
+
+def test_synchronous(capsys):
+    log.configure(background=False)
+    try:
+        log.fail('broken')
+        assert 'broken' in capsys.readouterr().out
+    finally:
+        log.configure(background=True)
@@ -0,0 +1,47 @@
+import numpy as np
+from motormag import mag, sim
+
+
+def test_parse_frames_ch3600():
+    frames = [sim.format_ch3600([0.0097, -0.0003, -12.5], [25.6, 25.6, 25.5]),
+              r'#00000.0097/000/+0256;-00000.0003/000/+0256;-00000.0027/000/+256>' + '\r\n']
+    buffer = ''.join(frames).encode('ascii')
+    values, n_bad, tail = mag.parse_frames(buffer + b'#00001.0/000', ch3600=True)
+    assert n_bad == 0
+    assert tail == b'#00001.0/000'
+    expected = [mag.parse_message(f, ch3600=True) for f in frames]
+    assert np.allclose(values, expected)
+
+
+def test_parse_frames_ch330_bad_frames():
+    good = sim.format_ch330([0.5, -0.25, 1.0])
+    buffer = (good + '#1/2>\r\n' + '#1/2/3x>\r\n' + '#1/2/#1/2/3>\r\n' + good).encode('ascii')
+    values, n_bad, tail = mag.parse_frames(buffer, ch3600=False)
+    assert n_bad == 3
+    assert tail == b''
+    assert np.allclose(values, [[0.5, -0.25, 1.0, 0, 0, 0], [1e-6, 2e-6, 3e-6, 0, 0, 0],
+                                [0.5, -0.25, 1.0, 0, 0, 0]])
+
+
+def test_frame_parser_fallback():
+    parser = mag.FrameParser(ch3600=False)
+    assert len(parser.feed(b'#1/2/3>\r\n#1-2/2/3>\r\n#4/5/')) == 1
+    assert len(parser.feed(b'6>\r\n')) == 1
+    assert parser.frames == 2
+    assert parser.bad_frames == 1
+
+
+def test_close_without_init():
+    meter = mag.Gaussmeter()
+    meter.close()
+    assert meter.serial_port is None
+
+
+def test_parse_frames_text_between_fields():
+    # The CH3600 regex allows anything between a field and its temperature, e.g. units.
+    plain = sim.format_ch3600([1.5, -2.0, 3.25], [25.0, 25.5, 26.0])
+    with_units = plain.replace('/000/', '/mT 000/')
+    frames = [plain, with_units, '#garbage>\r\n', plain]
+    values, n_bad, tail = mag.parse_frames(''.join(frames).encode('ascii'), ch3600=True)
+    assert n_bad == 1
+    assert np.allclose(values, [mag.parse_message(plain, ch3600=True)] * 2 + [mag.parse_message(with_units, True)])
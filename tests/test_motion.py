@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from motormag import motion, sim
+
+
+def test_trapezoid_time():
+    # 10 mm at 50 mm/s, 500 mm/s^2: 0.1 s ramps on either side of 0.1 s cruise.
+    assert motion.trapezoid_time(10, 50, 5) == pytest.approx(0.3)
+    assert motion.trapezoid_time(-10, 50, 5) == pytest.approx(0.3)
+    # Too short to reach cruise speed, triangular profile.
+    assert motion.trapezoid_time(1, 50, 5) == pytest.approx(2 * np.sqrt(1 / 500))
+    assert motion.trapezoid_time(0, 50, 5) == 0
+    assert motion.trapezoid_distance(0.3, 10, 50, 5) == pytest.approx(10)
+    assert motion.trapezoid_distance(0.15, 10, 50, 5) == pytest.approx(5)
+
+
+def test_predict_move_time():
+    assert motion.predict_move_time([0, 0, 0], [6, 8, 0], 50, 5) == pytest.approx(motion.trapezoid_time(10, 50, 5))
+    assert motion.predict_move_time([0, 0, 0], [6, 8, 0], 50, 5, coordinated=False) == \
+        pytest.approx(motion.trapezoid_time(8, 50, 5))
+
+
+def test_poll_interval():
+    assert motion.poll_interval(0, 1.0) == motion.MAX_POLL
+    assert motion.poll_interval(0.999, 1.0) == motion.MIN_POLL
+    assert motion.poll_interval(1.001, 1.0) == motion.MIN_POLL
+    assert motion.poll_interval(10, 1.0) == motion.MAX_POLL
+
+
+def test_simulated_stage_wait():
+    stage = sim.SimulatedStage()
+    stats = motion.MotionStats()
+    records = []
+    predicted = stage.move_to([6, 8, 0], speed=50, acceleration=5)
+    assert stage.is_running()
+    record = motion.wait_for_stop(stage.is_running, predicted, delay=0.01, callback=records.append,
+                                  record_stats=stats)
+    assert records == [record]
+    assert not stage.is_running()
+    assert np.allclose(stage.get_position(), [6, 8, 0])
+    assert record.travel == pytest.approx(predicted, abs=0.02)
+    assert record.settle >= 0.01
+    assert stats.summary()['moves'] == 1
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+from motormag import planner, motion
+
+
+def grid(nx, ny, nz):
+    xm, ym, zm = np.meshgrid(np.arange(nx), np.arange(ny), np.arange(nz), indexing='ij')
+    return np.vstack([xm.flatten(), ym.flatten(), zm.flatten()]).T.astype(float)
+
+
+def test_raster_matches_sort_values():
+    points = grid(3, 4, 2)
+    df = pd.DataFrame(points, columns=['x', 'y', 'z'])
+    assert np.all(planner.raster_order(points, 'zxy') == df.sort_values(['z', 'x', 'y']).index)
+
+
+def test_serpentine_steps_between_neighbours():
+    points = grid(3, 4, 2)
+    ordering = planner.serpentine_order(points, 'zxy')
+    assert sorted(ordering) == list(range(len(points)))
+    steps = np.abs(np.diff(points[ordering], axis=0)).sum(axis=1)
+    assert np.all(steps == 1)
+    assert planner.estimate_time(points, ordering) < planner.estimate_time(points, planner.raster_order(points))
+
+
+def test_nearest_neighbour_and_two_opt():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 100, (60, 3))
+    nn = planner.nearest_neighbour_order(points)
+    improved = planner.two_opt(points, nn)
+    assert sorted(improved) == list(range(len(points)))
+
+    def length(ordering):
+        path = np.vstack([[0, 0, 0], points[ordering]])
+        return np.linalg.norm(np.diff(path, axis=0), axis=1).sum()
+    assert length(improved) <= length(nn)
+    assert length(nn) < length(np.arange(len(points)))
+
+
+def test_estimate_time_matches_motion_model():
+    points = np.array([[10, 0, 0], [10, 20, 5]])
+    expected = motion.predict_move_time([0, 0, 0], points[0]) + motion.predict_move_time(points[0], points[1])
+    assert np.isclose(planner.estimate_time(points), expected)
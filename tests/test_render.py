@@ -0,0 +1,56 @@
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pytest
+from motormag import draw, grid, render
+
+
+def make_grid():
+    axes = [np.linspace(-2, 2, 5), np.linspace(-1, 1, 4), np.linspace(0, 1, 3)]
+    x, y, z = np.meshgrid(*axes, indexing='ij')
+    return grid.FieldGrid(axes, np.array([1 + 0.1 * x, 0.2 * y + 0.05 * z, 5 + z * x]))
+
+
+def test_renderer_matches_draw():
+    field = make_grid()
+    renderer = render.SliceRenderer(field)
+    figure = renderer.render(('z', 1, 'xyz'))
+    mesh, colorbar = renderer._artists
+    # Second slice of the same plane updates the artists instead of making new ones.
+    assert renderer.render(('z', 2)) is figure
+    assert renderer._artists[0] is mesh and renderer._artists[1] is colorbar
+    f, ax, pcm = draw.plot_strength_2d(field, cut_axis='z', cut_index=2)
+    assert np.allclose(mesh.get_array(), pcm.get_array())
+    assert np.allclose(mesh.get_clim(), pcm.get_clim())
+    assert renderer.ax.get_title() == ax.get_title()
+    renderer.render(render.SliceSpec('x', 0, 'xy', 'gradient'))
+    assert renderer._artists[0] is not mesh
+    f, ax, pcm = draw.plot_relative_gradient_2d(field, cut_axis='x', cut_index=0)
+    assert np.allclose(renderer._artists[0].get_array(), pcm.get_array())
+    with pytest.raises(ValueError):
+        renderer.render(('x', 0, 'xy', 'curl'))
+    renderer.close()
+    draw._pyplot().close('all')
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_render_slices(tmp_path, processes):
+    field = make_grid()
+    specs = render.all_slices(field, 'z') + [('y', 1, 'xy', 'gradient')]
+    paths = render.render_slices(field, specs, str(tmp_path), fmt='svg', processes=processes)
+    assert [p.rsplit('/', 1)[1] for p in paths] == ['strength_xyz_z000.svg', 'strength_xyz_z001.svg',
+                                                     'strength_xyz_z002.svg', 'gradient_xy_y001.svg']
+    assert all((tmp_path / p).stat().st_size > 0 for p in paths)
+
+
+def test_reused_gradient_contours(recwarn):
+    axes = [np.linspace(-2, 2, 9), np.linspace(-2, 2, 9), np.linspace(0, 1, 4)]
+    x, y, z = np.meshgrid(*axes, indexing='ij')
+    renderer = render.SliceRenderer(grid.FieldGrid(axes, np.array([x ** 2 + y ** 2, x * y, 1 + 0 * z])), b_zero=2e4)
+    for i in range(4):
+        renderer.render(('z', i, 'xy', 'gradient'))
+    # Labels of the previous slice go with its contours.
+    assert len(renderer._contours.labelTexts) > 0
+    assert len(renderer.ax.texts) == len(renderer._contours.labelTexts)
+    assert not [w for w in recwarn if 'ContourSet' in str(w.message)]
+    renderer.close()
@@ -1,6 +1,6 @@
 import numpy as np
 import pytest
-from motormag import scan
+from motormag import scan, sim
 
 
 def test_range_to_points():
@@ -9,3 +9,130 @@ def test_range_to_points():
     assert np.all(scan.range_to_points([20, 50], step_size=2) == np.linspace(20, 50, 16))
     with pytest.raises(ValueError) as e:
         _ = scan.range_to_points([20, 30], step_size=3)
+
+
+def test_box_scan_simulated():
+    stage = sim.SimulatedStage()
+    meter = sim.SimulatedMeter(stage, field=lambda p: p, period=0.001)
+    box = scan.BoxScan([0, 2], [0, 1], [0, 1], step_size=1, time_wait=0.0, speed=500, acceleration=50,
+                       test_corners=False, stage=stage, meter=meter)
+    df = box.run()
+    assert df is box.data
+    assert df.attrs['lengths'] == [3, 2, 2]
+    assert np.allclose(df.loc[:, ['mag_x', 'mag_y', 'mag_z']].to_numpy(), df.loc[:, ['x', 'y', 'z']].to_numpy())
+    assert np.allclose(df.temp_x, 25.0)
+    assert box.points_done == 12
+    assert box.throughput > 0
+    assert set(box.timings) == {'travel', 'settle', 'read', 'bookkeeping', 'logging'}
+    assert box.timings['travel'] > 0 and box.timings['read'] > 0
+
+
+class _FailingMeter(sim.SimulatedMeter):
+    def __init__(self, stage, fail_after, **kwargs):
+        super().__init__(stage, **kwargs)
+        self.reads_left = fail_after
+
+    def read_once(self, flush=False):
+        self.reads_left -= 1
+        if self.reads_left < 0:
+            raise IOError('probe disconnected')
+        return super().read_once(flush)
+
+
+def test_box_scan_resume(tmp_path):
+    checkpoint = str(tmp_path / 'scan.ckpt')
+    settings = dict(x_range=[0, 2], y_range=[0, 1], z_range=[0, 1], step_size=1, time_wait=0.0, speed=500,
+                    acceleration=50, test_corners=False)
+    stage = sim.SimulatedStage()
+    meter = _FailingMeter(stage, 20, field=lambda p: p, period=0.001)
+    box = scan.BoxScan(**settings, checkpoint=checkpoint, checkpoint_interval=0.0, stage=stage, meter=meter)
+    with pytest.raises(IOError):
+        box.run()
+    assert box.points_done < 12
+
+    stage.multi_absolute_move([5, 5, 5])
+    with pytest.raises(RuntimeError):
+        scan.BoxScan.resume(checkpoint, stage=stage, meter=sim.SimulatedMeter(stage, field=lambda p: p)).run()
+    stage.multi_absolute_move([0, 0, 0])
+    resumed = scan.BoxScan.resume(checkpoint, stage=stage, meter=sim.SimulatedMeter(stage, field=lambda p: p,
+                                                                                     period=0.001))
+    df = resumed.run()
+    assert resumed.points_done == 12
+    assert df.attrs['lengths'] == [3, 2, 2]
+    assert np.allclose(df.loc[:, ['mag_x', 'mag_y', 'mag_z']].to_numpy(), df.loc[:, ['x', 'y', 'z']].to_numpy())
+    # The checkpoint of the finished scan holds all points, resuming it just returns them.
+    done = scan.BoxScan.resume(checkpoint, stage=stage, meter=sim.SimulatedMeter(stage)).run()
+    assert done.equals(df) and done.attrs == df.attrs
+    with pytest.raises(NotImplementedError):
+        scan.AdaptiveScan.resume(checkpoint, stage=stage)
+
+
+def test_adaptive_scan_simulated():
+    def field(p):
+        return np.array([10 * np.tanh(p[0] - 6), 0.1 * p[1], 1.0])
+    stage = sim.SimulatedStage()
+    meter = sim.SimulatedMeter(stage, field=field)
+    box = scan.AdaptiveScan([0, 16], [0, 8], 0, step_size=1, levels=2, tolerance=0.05, time_wait=0.0, speed=5000,
+                            acceleration=500, test_corners=False, stage=stage, meter=meter)
+    df = box.run()
+    assert df.attrs['lengths'] == [17, 9, 1]
+    assert box.points_done == len(box.measured) < len(df)
+    assert set(df.level) == {-1, 0, 1, 2}
+    truth = np.array([field(p) for p in df.loc[:, ['x', 'y', 'z']].to_numpy()])
+    assert np.allclose(df.loc[:, ['mag_x', 'mag_y', 'mag_z']].to_numpy(), truth, atol=0.1)
+    # Refinement happens around the edge only.
+    assert np.all(np.abs(df.x[df.level == 2] - 6) <= 4)
+
+    capped = scan.AdaptiveScan([0, 16], [0, 8], 0, step_size=1, levels=2, max_points=30, time_wait=0.0, speed=5000,
+                               acceleration=500, test_corners=False, stage=stage,
+                               meter=sim.SimulatedMeter(stage, field=field))
+    capped.run()
+    assert 15 <= capped.points_done <= 30
+
+
+def test_settle():
+    def ringing(amplitude, noise=0.0):
+        rng = np.random.default_rng(0)
+        for n in range(100):
+            value = amplitude * 0.5 ** n + rng.normal(0, noise) if noise else amplitude * 0.5 ** n
+            yield float(n), np.array([1 + value, 2.0, 3.0, 25, 25, 25])
+
+    times, values, taken = scan.settle(ringing(8.0), tolerance=0.01, min_reads=3)
+    assert taken == 12 and len(values) == 3
+    assert np.allclose(np.average(values, axis=0)[:3], [1, 2, 3], atol=0.01)
+    times, values, taken = scan.settle(ringing(0.0), tolerance=0.01, min_reads=3)
+    assert taken == len(values) == 3
+    times, values, taken = scan.settle(ringing(0.0, noise=0.1), target_error=0.02, min_reads=5, max_reads=50)
+    assert scan.standard_error(values) <= 0.02 and len(values) >= 5
+    times, values, taken = scan.settle(ringing(0.0, noise=0.1), target_error=1e-6, max_reads=20)
+    assert taken == 20
+
+
+def test_box_scan_adaptive_settle():
+    stage = sim.SimulatedStage()
+    meter = sim.SimulatedMeter(stage, field=lambda p: p, noise=0.01)
+    df = scan.BoxScan([0, 2], [0, 1], 0, step_size=1, time_wait=0.0, speed=500, acceleration=50,
+                      test_corners=False, target_error=0.005, max_reads=30, stage=stage, meter=meter).run()
+    assert np.all(df.reads >= 2) and np.all(df.reads <= 30)
+    assert np.all((df.std_error <= 0.005) | (df.reads == 30))
+    for min_reads, max_reads in [(2, 0), (0, 5), (3, 2)]:
+        with pytest.raises(ValueError):
+            scan.BoxScan([0, 2], 0, 0, step_size=1, min_reads=min_reads, max_reads=max_reads, stage=stage, meter=meter)
+
+
+def test_box_scan_probe_array():
+    from motormag import mag
+    stage = sim.SimulatedStage()
+    probes = mag.ProbeArray([sim.SimulatedMeter(stage, field=lambda p: p, period=0.002, name='front'),
+                             sim.SimulatedMeter(stage, field=lambda p: p, period=0.002, offset=[0, 10, 0],
+                                                name='back')])
+    box = scan.BoxScan([0, 2], [0, 1], 0, step_size=1, time_wait=0.0, speed=500, acceleration=50,
+                       test_corners=False, stage=stage, meter=probes)
+    df = box.run()
+    assert 'mag_y_front' in df and 'temp_z_back' in df
+    assert df.attrs['probes'] == {'front': [0, 0, 0], 'back': [0, 10, 0]}
+    for name in ['front', 'back']:
+        probe = mag.probe_data(df, name)
+        assert probe.attrs['lengths'] == [3, 2, 1]
+        assert np.allclose(probe.loc[:, ['mag_x', 'mag_y', 'mag_z']].to_numpy(), probe.loc[:, ['x', 'y', 'z']].to_numpy())
+    assert np.allclose(mag.probe_data(df, 'back').y, df.y + 10)
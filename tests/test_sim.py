@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from motormag import sim, motor, mag, scan, _mode
+
+
+def test_parse_gcode():
+    target, speed, acceleration, coordinated = sim.parse_gcode('G01X1.0Y-2.5Z3.0F25.0A0.3D0', [5, 5, 5])
+    assert target == [1, -2.5, 3] and speed == [25, 25, 25] and acceleration == 0.3 and coordinated
+    target, speed, acceleration, coordinated = sim.parse_gcode('G80Y5FY20AY0.5D0', [1, 2, 3])
+    assert target == [1, 7, 3] and speed[1] == 20 and acceleration == 0.5 and not coordinated
+    target, _, _, coordinated = sim.parse_gcode('G81X1.0Y1.0Z-1.0F10.0A0.3D0', [1, 2, 3])
+    assert target == [2, 3, 2] and coordinated
+    with pytest.raises(ValueError):
+        sim.parse_gcode('M30', [0, 0, 0])
+
+
+def test_analytic_fields():
+    radius, current, turns = 100.0, 2.0, 50
+    center = sim.helmholtz_field(radius, current, turns)([0, 0, 0])
+    assert np.allclose(center, [0, 0, (4 / 5) ** 1.5 * sim.MU_0 * turns * current / (radius / 1000) * 1e3])
+    # Helmholtz field is flat around the center, a single loop is not.
+    near = sim.helmholtz_field(radius, current, turns)(np.array([[10, 0, 0], [0, 0, 10]]))
+    assert np.allclose(near, center, rtol=1e-3)
+    loop = sim.loop_field(radius, current, turns, axis='x')
+    assert np.allclose(loop([0, 0, 0]), [sim.MU_0 * turns * current / (2 * radius / 1000) * 1e3, 0, 0])
+    dipole = sim.dipole_field([0, 0, 1.0], [0, 0, 0])
+    assert np.allclose(dipole([0, 0, 100]), [0, 0, sim.MU_0 * 2 / (4 * np.pi * 0.1 ** 3) * 1e3])
+    assert np.allclose(dipole([100, 0, 0]), [0, 0, -sim.MU_0 / (4 * np.pi * 0.1 ** 3) * 1e3])
+
+
+def test_ringing():
+    stage = sim.SimulatedStage(ringing=(0.5, 0.05, 20))
+    stage.multi_absolute_move([10, 0, 0], speed=500, acceleration=50)
+    now = stage.clock()
+    assert np.allclose(stage.get_position(), [10, 0, 0])
+    assert abs(stage.probe_position_at(now + 0.0125)[0] - 10) > 0.1
+    assert np.allclose(stage.probe_position_at(now + 1.0), [10, 0, 0])
+
+
+def test_position_history():
+    now = [0.0]
+    stage = sim.SimulatedStage(clock=lambda: now[0])
+    first = stage.move_to([10, 0, 0], speed=10, acceleration=1000)
+    stage.queue_moves([([10, 10, 0], 10, 1000, True, 0.5)])
+    during = stage.position_at(first / 2)
+    now[0] = first + 0.2
+    # The stage is on the queued move by now, the earlier timestamp still gets its place on the first one.
+    assert stage.get_position()[1] > 0
+    assert np.allclose(stage.position_at(first / 2), during)
+    assert np.isclose(during[0], 5, atol=0.1)
+    stage.pause()
+    paused = stage.get_position()
+    now[0] += 1
+    assert stage.get_position() == paused
+    assert np.allclose(stage.position_at(first / 2), during)
+    assert stage.position_at(-1.0) == [0, 0, 0]
+
+
+def test_mock_box_scan(monkeypatch):
+    monkeypatch.setattr(_mode, 'MOCK', True)
+    monkeypatch.setattr(_mode, 'CH3600', True)
+    monkeypatch.setattr(motor, 'controller', motor.controller)
+    monkeypatch.setattr(mag.default, 'serial_port', None)
+    field = sim.dipole_field([0, 0, 1.0], [0, 0, -50])
+    controller = sim.simulate(field=field, period=0.002, limits=([-1, -1, -1], [100, 100, 100]))
+    motor.init(8)
+    mag.init(16)
+    assert mag.serial_port.stage is controller.stage
+    df = scan.BoxScan([0, 10], [0, 10], 0, step_size=10, time_wait=0.0, n_reps=2, speed=500, acceleration=50,
+                      test_corners=False).run()
+    expected = field(df.loc[:, ['x', 'y', 'z']].to_numpy())
+    assert np.allclose(df.loc[:, ['mag_x', 'mag_y', 'mag_z']].to_numpy(), expected, atol=1e-3)
+    assert np.allclose(motor.get_position(), [0, 0, 0])
+    motor.set_position(0, 5.0)
+    assert np.allclose(motor.get_position(), [5, 0, 0])
+    assert not motor.get_input_state().any()
+
+
+def test_absolute_move_remembers_target(monkeypatch):
+    controller = sim.simulate()
+    calls = []
+    get_axis_position = controller.get_axis_position
+    monkeypatch.setattr(controller, 'get_axis_position', lambda: calls.append(1) or get_axis_position())
+    motor.multi_absolute_move([5, 0, 0], speed=500, acceleration=50)
+    # Only the first move, with nothing sent before, asks the controller where the stage is.
+    assert len(calls) == 1
+    motor.multi_absolute_move([5, 5, 0], speed=500, acceleration=50)
+    motor.multi_relative_move([0, -5, 0], speed=500, acceleration=50)
+    motor.multi_absolute_move([0, 0, 0], speed=500, acceleration=50)
+    assert len(calls) == 1
+    motor.set_position(0, 1.0)
+    motor.multi_absolute_move([0, 0, 0], speed=500, acceleration=50)
+    assert len(calls) == 2
+    assert np.allclose(controller.stage.get_position(), [0, 0, 0])
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from scipy.interpolate import griddata
+from motormag import draw, spatial
+from motormag.grid import FieldGrid
+
+
+def linear(x, y, z):
+    return np.array([2 * x + y, y - z, 0.5 * z + 1])
+
+
+def make_grid(zs=(0.0, 1.0, 3.0)):
+    # Descending x axis, uneven z.
+    axes = [np.arange(4.0, -0.5, -1.0), np.arange(0.0, 3.0), np.asarray(zs)]
+    return FieldGrid(axes, linear(*np.meshgrid(*axes, indexing='ij')))
+
+
+def test_grid_index_matches_tree():
+    grid = make_grid()
+    index = grid.spatial_index
+    assert index.kind == 'grid' and grid.spatial_index is index
+    df = grid.to_dataframe().sample(frac=1, random_state=3)
+    coords = df[['x', 'y', 'z']].to_numpy()
+    # Shuffled rows still index as a grid, jittered ones fall back to the tree.
+    assert spatial.get_index(df).kind == 'grid'
+    tree = spatial.SpatialIndex(coords + np.random.default_rng(0).normal(0, 1e-6, coords.shape))
+    assert tree.kind == 'tree'
+    positions = np.random.default_rng(1).uniform([-1, -1, -1], [5, 3, 4], (50, 3))
+    distances, rows = index.nearest(positions)
+    tree_distances, tree_rows = tree.nearest(positions)
+    assert np.allclose(distances, tree_distances, atol=1e-5)
+    assert np.allclose(index.coords[rows], coords[tree_rows], atol=1e-5)
+    assert np.allclose(index.coords, grid.to_dataframe()[['x', 'y', 'z']])
+    for position, radius in [([2.0, 1.0, 1.0], 1.05), ([0.2, 2.1, 2.5], 1.7), ([9, 9, 9], 1.0)]:
+        assert np.allclose(np.sort(index.coords[index.within(position, radius)], axis=0),
+                           np.sort(coords[tree.within(position, radius)], axis=0), atol=1e-5)
+
+
+def test_interpolate():
+    grid = make_grid()
+    values = grid.field.reshape(3, -1).T
+    positions = np.random.default_rng(2).uniform([0, 0, 0], [4, 2, 3], (40, 3))
+    assert np.allclose(grid.spatial_index.interpolate(values, positions), linear(*positions.T).T)
+    assert np.all(np.isnan(grid.spatial_index.interpolate(values[:, 0], [[5, 1, 1]])))
+    # Scattered points: local linear fit reproduces a linear field, and agrees with griddata inside the hull.
+    coords = np.random.default_rng(4).uniform(0, 4, (400, 3))
+    index = spatial.SpatialIndex(coords)
+    inner = positions[np.all((positions > 1) & (positions < 2), axis=1)]
+    scattered = linear(*coords.T).T
+    assert np.allclose(index.interpolate(scattered, inner), griddata(coords, scattered, inner))
+    assert np.isnan(index.interpolate(scattered[:, 0], [[10, 10, 10]], max_distance=1.0)[0])
+    # Planar grid behaves like interp: off the plane is outside.
+    planar = FieldGrid([np.arange(3.0), np.arange(3.0), [2.0]], linear(*np.meshgrid(
+        np.arange(3.0), np.arange(3.0), [2.0], indexing='ij')))
+    result = planar.spatial_index.interpolate(planar.field[0].ravel(), [[0.5, 0.5, 2.0], [0.5, 0.5, 1.0]])
+    assert np.isclose(result[0], 1.5) and np.isnan(result[1])
+
+
+def test_cuts():
+    grid = make_grid()
+    u_points, v_points = np.linspace(-0.5, 0.5, 5), np.linspace(-0.5, 0.5, 4)
+    positions, field = spatial.cut_plane(grid, [2, 1, 1.5], [1, 1, 0], [0, 1, 1], u_points, v_points)
+    assert positions.shape == (5, 4, 3) and field.shape == (5, 4, 3)
+    normal = np.cross([1, 1, 0], [0, 1, 1])
+    assert np.allclose((positions - [2, 1, 1.5]) @ normal, 0)
+    assert np.allclose(field, np.moveaxis(linear(*np.moveaxis(positions, -1, 0)), 0, -1))
+    distance, positions, field = spatial.cut_polyline(grid.to_dataframe(), [[0, 0, 0], [3, 0, 0], [3, 2, 3]], 0.5)
+    assert distance[0] == 0 and np.isclose(distance[-1], 3 + np.sqrt(13))
+    assert np.allclose(np.diff(distance[:7]), 0.5)
+    assert np.allclose(positions[-1], [3, 2, 3])
+    assert np.allclose(field, linear(*positions.T).T)
+    with pytest.raises(ValueError):
+        spatial.plane_positions([0, 0, 0], [1, 0, 0], [2, 0, 0], [0], [0])
+
+
+def test_cut_helpers():
+    df = make_grid().to_dataframe()
+    assert draw.determine_fixed_axes(df) == []
+    df = df[df.z == 1.0].reset_index(drop=True)
+    assert draw.determine_fixed_axes(df) == ['z']
+    coordinates = FieldGrid.from_dataframe(make_grid().to_dataframe()).coordinates
+    assert draw.determine_cut_index(coordinates, 'z', None, 3.0) == (2, 3.0)
+    with pytest.raises(ValueError):
+        draw.determine_cut_index(coordinates, 'z', None, 2.0)
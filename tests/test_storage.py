@@ -0,0 +1,89 @@
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pytest
+from motormag import scan, sim, draw
+
+storage = pytest.importorskip('motormag.storage')
+pytest.importorskip('h5py')
+
+
+def test_box_scan_streams_to_file(tmp_path):
+    stage = sim.SimulatedStage()
+    meter = sim.SimulatedMeter(stage, field=lambda p: [p[0], p[1] * 2, 1.0])
+    path = str(tmp_path / 'scan.h5')
+    box = scan.BoxScan([0, 2], [0, 1], [0, 1], step_size=1, time_wait=0.0, n_reps=2, speed=500, acceleration=50,
+                       test_corners=False, storage=path, stage=stage, meter=meter)
+    df = box.run()
+    with storage.ScanFile(path) as scan_file:
+        assert len(scan_file) == 12
+        assert scan_file.metadata['lengths'] == [3, 2, 2]
+        assert scan_file.metadata['settings']['n_reps'] == 2
+        loaded = scan_file.to_dataframe()
+        assert np.allclose(loaded.to_numpy(), df.to_numpy())
+        assert loaded.attrs['lengths'] == [3, 2, 2]
+        plane = scan_file.plane('y', 1, columns=['x', 'y', 'mag_y'])
+        assert list(plane.columns) == ['x', 'y', 'mag_y']
+        assert np.all(plane.y == 1) and len(plane) == 6
+        times, raw = scan_file.raw(5)
+        assert raw.shape == (2, 6)
+        f, ax, pcm = draw.plot_strength_2d(scan_file, cut_axis='z', field_axis='x')
+
+
+def test_save_load(tmp_path):
+    stage = sim.SimulatedStage()
+    df = scan.BoxScan([0, 1], 0, 0, step_size=1, time_wait=0.0, speed=500, acceleration=50, test_corners=False,
+                      stage=stage, meter=sim.SimulatedMeter(stage)).run()
+    path = str(tmp_path / 'saved.h5')
+    storage.save(df, path)
+    loaded = storage.load(path)
+    assert np.allclose(loaded.to_numpy(), df.to_numpy())
+    assert loaded.attrs['lengths'] == df.attrs['lengths']
+
+
+def test_probe_array_to_file(tmp_path):
+    from motormag import mag
+    stage = sim.SimulatedStage()
+    probes = mag.ProbeArray([sim.SimulatedMeter(stage, field=lambda p: p),
+                             sim.SimulatedMeter(stage, field=lambda p: p, offset=[1, 0, 0])])
+    path = str(tmp_path / 'probes.h5')
+    df = scan.BoxScan([0, 1], 0, 0, step_size=1, time_wait=0.0, speed=500, acceleration=50, test_corners=False,
+                      storage=path, stage=stage, meter=probes).run()
+    loaded = storage.load(path)
+    assert np.allclose(loaded.to_numpy(), df.to_numpy())
+    assert np.allclose(mag.probe_data(loaded, 'p1').mag_x, [1, 2])
+    with storage.ScanFile(path) as scan_file:
+        assert scan_file.raw(0)[1].shape == (3, 12)
+
+
+def test_plot_scan_file_default_cut_axis(tmp_path):
+    stage = sim.SimulatedStage()
+    path = str(tmp_path / 'plane.h5')
+    scan.BoxScan([0, 2], [0, 1], 0, step_size=1, time_wait=0.0, speed=500, acceleration=50, test_corners=False,
+                 storage=path, stage=stage, meter=sim.SimulatedMeter(stage, field=lambda p: [p[0], 1.0, 1.0])).run()
+    with storage.ScanFile(path) as scan_file:
+        f, ax, pcm = draw.plot_strength_2d(scan_file)
+        assert ax.get_title().startswith('Field: xyz, cut position: z=0.0')
+        draw.plot_relative_gradient_2d(scan_file, spatial_axes='xy')
+    draw._pyplot().close('all')
+
+
+def test_plot_scan_file_reads_planes(tmp_path, monkeypatch):
+    stage = sim.SimulatedStage()
+    path = str(tmp_path / 'box.h5')
+    field = sim.dipole_field([0, 0, 1.0], [1, 1, -20])
+    df = scan.BoxScan([0, 4], [0, 3], [0, 4], step_size=1, time_wait=0.0, speed=500, acceleration=50,
+                      path='serpentine', test_corners=False, storage=path, stage=stage,
+                      meter=sim.SimulatedMeter(stage, field=field)).run()
+    with storage.ScanFile(path) as scan_file:
+        # Nothing may load the whole scan.
+        monkeypatch.setattr(storage.ScanFile, 'to_dataframe', None)
+        assert np.allclose(scan_file.axis('z'), np.arange(5))
+        for cut in [dict(cut_axis='z', cut_index=0), dict(cut_axis='y', cut_position=2.0), dict(cut_axis='x',
+                                                                                               cut_index=-1)]:
+            for plot in (draw.plot_strength_2d, draw.plot_relative_gradient_2d):
+                _, ax, pcm = plot(scan_file, **cut)
+                _, expected_ax, expected = plot(df, **cut)
+                assert np.allclose(pcm.get_array(), expected.get_array())
+                assert ax.get_title() == expected_ax.get_title()
+                draw._pyplot().close('all')
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+from motormag import stream, mag, motor, scan, sim, _mode
+
+
+def test_ring_buffer_wraps():
+    buffer = stream.RingBuffer(capacity=8, width=1)
+    buffer.extend(np.arange(5.0), np.arange(5.0))
+    buffer.extend(np.arange(5.0, 12.0), np.arange(5.0, 12.0))
+    assert buffer.count == 12
+    assert buffer.oldest == 4
+    times, values = buffer.window(5.5, 9.0)
+    assert np.all(times == [6, 7, 8, 9])
+    times, values = buffer.after(9.0, 2, timeout=0)
+    assert np.all(values[:, 0] == [10, 11])
+    times, values = buffer.latest(3)
+    assert np.all(times == [9, 10, 11])
+    with pytest.raises(TimeoutError):
+        buffer.after(10.0, 2, timeout=0.01)
+    with pytest.raises(IndexError):
+        buffer.since(0, 1)
+
+
+def test_stream_reader_feed():
+    reader = stream.StreamReader(None, mag.FrameParser(ch3600=True))
+    msg = sim.format_ch3600([1.0, 2.0, 3.0], [25.0, 25.0, 25.0]).encode('ascii')
+    assert reader.feed(msg + msg[:10], 1.0) == 1
+    assert reader.feed(msg[10:] + b'#garbage>\n', 2.0) == 1
+    assert reader.parser.bad_frames == 1
+    times, values = reader.buffer.latest(2)
+    assert np.all(times == [1.0, 2.0])
+    assert np.allclose(values, [[1, 2, 3, 25, 25, 25]] * 2)
+
+
+def test_box_scan_streaming(monkeypatch):
+    monkeypatch.setattr(_mode, 'CH3600', True)
+    stage = sim.SimulatedStage()
+    port = sim.SimulatedSerial(stage, field=lambda p: p, period=0.002, ch3600=True)
+    mag.start_stream(port)
+    try:
+        box = scan.BoxScan([0, 2], [0, 1], 0, step_size=1, time_wait=0.01, n_discards=1, n_reps=3, speed=500,
+                           acceleration=50, test_corners=False, stage=stage, meter=mag)
+        df = box.run()
+        assert len(mag.read_n_times(4)) == 6
+    finally:
+        mag.stop_stream()
+    assert np.allclose(df.loc[:, ['mag_x', 'mag_y', 'mag_z']].to_numpy(), df.loc[:, ['x', 'y', 'z']].to_numpy(),
+                       atol=1e-3)
+
+
+def test_fly_scan_simulated(monkeypatch):
+    monkeypatch.setattr(_mode, 'CH3600', True)
+    stage = sim.SimulatedStage()
+    port = sim.SimulatedSerial(stage, field=lambda p: [p[0], p[1], 1.0], period=0.002, ch3600=True)
+    mag.start_stream(port)
+    try:
+        fly = scan.FlyScan([0, 4], [0, 2], 0, step_size=1, order='zyx', fly_speed=20, speed=200, acceleration=5,
+                           track_period=0.005, stage=stage, meter=mag)
+        df = fly.run()
+        raw = scan.FlyScan([0, 4], 0, 0, step_size=1, order='zyx', fly_speed=20, speed=200, acceleration=5,
+                           regrid=False, stage=stage, meter=mag).run()
+    finally:
+        mag.stop_stream()
+    assert df.attrs['lengths'] == [5, 3, 1]
+    assert fly.samples > 15
+    assert np.allclose(df.mag_x, df.x, atol=0.2)
+    assert np.allclose(df.mag_y, df.y, atol=0.2)
+    assert np.allclose(raw.mag_x, raw.x, atol=0.2)
+    assert raw.x.min() >= 0 and raw.x.max() <= 4
+
+
+def test_fly_scan_limit_switch(monkeypatch):
+    monkeypatch.setattr(_mode, 'CH3600', True)
+    stage = sim.SimulatedStage(limits=([-100, -100, -100], [100, 2, 100]))
+    mag.start_stream(sim.SimulatedSerial(stage, period=0.002, ch3600=True))
+    try:
+        with pytest.raises(motor.LimitSwitchError):
+            scan.FlyScan(0, [0, 4], 0, step_size=1, order='zxy', fly_speed=20, speed=200, acceleration=5,
+                         stage=stage, meter=mag).run()
+    finally:
+        mag.stop_stream()
+    assert 2 <= stage.get_position()[1] < 3
+    assert not stage.is_running()
+
+
+class _BrokenPort(object):
+    in_waiting = 0
+    is_open = True
+
+    def read(self, size):
+        raise OSError('device unplugged')
+
+    def close(self):
+        self.is_open = False
+
+
+def test_stream_errors():
+    meter = mag.Gaussmeter()
+    with pytest.raises(RuntimeError, match='init'):
+        meter.start_stream()
+    with pytest.raises(RuntimeError):
+        meter.samples_after(0.0, 1)
+    meter.start_stream(port=_BrokenPort())
+    # The reader thread's error reaches waiting readers instead of a timeout, and stop.
+    with pytest.raises(OSError, match='unplugged'):
+        meter.samples_after(0.0, 1, timeout=5.0)
+    assert not meter.streaming()
+    with pytest.raises(OSError):
+        meter.stop_stream()
+    assert meter.stream is None
+    # close releases the port even though the dead reader's error surfaces.
+    port = _BrokenPort()
+    meter.serial_port = port
+    meter.start_stream()
+    with pytest.raises(OSError):
+        meter.samples_after(0.0, 1, timeout=5.0)
+    with pytest.raises(OSError, match='unplugged'):
+        meter.close()
+    assert not port.is_open and meter.serial_port is None
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from motormag import motion, motor, sim, trajectory
+
+
+POINTS = [[2, 0, 0], [2, 3, 0], [0, 3, 1.5]]
+
+
+def test_gcode():
+    program = trajectory.Trajectory.through(POINTS, dwell=0.25, speed=10, acceleration=0.5)
+    program.move_to([0, 0, 0], speed=[5, 6, 7], coordinated=False)
+    assert program.gcode() == ['G01X2.0Y0.0Z0.0F10.0A0.5D0', 'G04P0.250',
+                               'G01X2.0Y3.0Z0.0F10.0A0.5D0', 'G04P0.250',
+                               'G01X0.0Y3.0Z1.5F10.0A0.5D0', 'G04P0.250',
+                               'G00X0.0FX5.0AX0.5Y0.0FY6.0AY0.5Z0.0FZ7.0AZ0.5D0']
+    assert program.gcode(1, 2) == ['G01X2.0Y3.0Z0.0F10.0A0.5D0', 'G04P0.250']
+    # Every move reads back as the target it was built from.
+    for line, segment in zip(program.gcode()[::2], program.segments):
+        assert np.allclose(sim.parse_gcode(line, [9, 9, 9])[0], segment.target)
+    with pytest.raises(ValueError):
+        program.move_to([1, 2])
+
+
+def test_schedule():
+    program = trajectory.Trajectory.through(POINTS, dwell=0.25, start=[1, 1, 1], speed=10, acceleration=0.5)
+    schedule = program.schedule()
+    moves = motion.move_times(np.vstack([[1, 1, 1], POINTS[:-1]]), POINTS, 10, 0.5)
+    assert np.allclose(np.diff(schedule, axis=1), 0.25)
+    assert np.allclose(schedule[:, 0], np.cumsum(moves) + 0.25 * np.arange(3))
+    assert program.duration == pytest.approx(moves.sum() + 0.75)
+    assert trajectory.Trajectory().duration == 0.0
+
+
+@pytest.mark.parametrize('lookahead', [None, 1])
+def test_run_trajectory_simulated(lookahead):
+    controller = sim.simulate()
+    program = trajectory.Trajectory.through(POINTS, dwell=0.1, speed=200, acceleration=20)
+    positions = []
+
+    def during_dwell(i, start, end):
+        positions.append(controller.stage.position_at((start + end) / 2))
+
+    windows = motor.run_trajectory(program, lookahead=lookahead, callback=during_dwell)
+    assert np.allclose(np.diff(windows, axis=1), 0.1)
+    assert np.allclose(positions, POINTS)
+    assert np.allclose(motor.get_position(), POINTS[-1])
+    assert not motor.is_running()
+
+
+class _MdiOnly(object):
+    def __init__(self, controller):
+        self.controller = controller
+
+    def __getattr__(self, name):
+        if name == 'send_program':
+            raise AttributeError(name)
+        return getattr(self.controller, name)
+
+
+def test_run_trajectory_without_program_support():
+    controller = sim.simulate()
+    motor.use(_MdiOnly(controller))
+    positions = []
+    windows = motor.run_trajectory(trajectory.Trajectory.through(POINTS, dwell=0.05, speed=200, acceleration=20),
+                                   callback=lambda i, start, end: positions.append(motor.get_position()))
+    assert np.all(np.diff(windows, axis=1) >= 0.05)
+    assert np.allclose(positions, POINTS)
+
+
+def test_run_trajectory_limit_switch():
+    controller = sim.simulate(limits=([-100, -100, -100], [100, 8, 100]))
+    program = trajectory.Trajectory.through([[0, 20, 0], [0, 0, 0]], dwell=0.1, speed=50, acceleration=5)
+    with pytest.raises(motor.LimitSwitchError):
+        motor.run_trajectory(program)
+    assert 8 <= controller.stage.get_position()[1] < 20
+    assert not motor.is_running()
+
+
+@pytest.mark.parametrize('shift', [-0.05, 0.05])
+def test_run_trajectory_confirms_dwells(monkeypatch, shift):
+    controller = sim.simulate()
+    program = trajectory.Trajectory.through(POINTS, dwell=0.1, speed=200, acceleration=20)
+    schedule = program.schedule
+    # Prediction running ahead of or behind the stage, as with a miscalibrated ACCELERATION_SCALE.
+    monkeypatch.setattr(program, 'schedule', lambda start=None: schedule(start) + shift * np.arange(1, 4)[:, None])
+    windows = motor.run_trajectory(program)
+    assert np.all(np.diff(windows, axis=1) >= 0)
+    # Within the default tolerance of run_trajectory.
+    for (start, end), point in zip(windows, POINTS):
+        assert np.allclose(controller.stage.position_at(start), point, atol=0.01)
+        assert np.allclose(controller.stage.position_at(end), point, atol=0.01)